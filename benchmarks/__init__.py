@@ -0,0 +1,4 @@
+"""Performance benchmarks for lala.
+
+The benchmarks are not part of the test suite, run them as modules, e.g.
+``python -m benchmarks.startup``."""
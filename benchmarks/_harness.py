@@ -0,0 +1,145 @@
+"""Runs benchmark cases and compares them to a JSON baseline.
+
+Every case is a function without arguments. It is measured as
+
+- ``ops``: calls per second, from the fastest of ``repeat`` runs of
+  ``number`` calls
+- ``peak_bytes``: the memory allocated at the peak of a single call,
+  measured with :mod:`tracemalloc`
+- ``retained_blocks``: memory blocks still allocated after a call, averaged
+  over ``number`` calls, which reveals caches and leaks
+
+A baseline written with ``--save`` can be compared to with ``--baseline``.
+Cases that got slower or allocate more than ``--threshold`` percent are
+reported as regressions and the process exits with status 1.
+"""
+import argparse
+import gc
+import json
+import platform
+import sys
+import timeit
+import tracemalloc
+
+#: The measurements compared to the baseline and whether higher is better
+METRICS = (("ops", True), ("peak_bytes", False))
+
+
+def measure(func, number, repeat):
+    """Measures ``func``.
+
+    :rtype: dict
+    :return: The measurements, see the module documentation
+    """
+    func()
+    times = timeit.repeat(func, number=number, repeat=repeat)
+
+    gc.collect()
+    before = sys.getallocatedblocks()
+    for _ in range(number):
+        func()
+    gc.collect()
+    retained = (sys.getallocatedblocks() - before) / number
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - start
+    finally:
+        tracemalloc.stop()
+    return {"ops": number / min(times),
+            "peak_bytes": peak,
+            "retained_blocks": retained}
+
+
+def compare(results, baseline, threshold):
+    """Compares ``results`` to ``baseline``.
+
+    :param float threshold: The change in percent that counts as a regression
+    :rtype: list
+    :return: A description of every regression
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for metric, higher_is_better in METRICS:
+            old, new = previous[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) * 100.0 / old
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append("%s: %s changed by %+.1f%% (%.4g -> %.4g)"
+                                   % (name, metric, change, old, new))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as fp:
+        data = json.load(fp)
+    if data.get("python") != platform.python_version():
+        sys.stderr.write("The baseline was measured with Python %s, this is "
+                         "%s\n" % (data.get("python"),
+                                   platform.python_version()))
+    return data["results"]
+
+
+def save_baseline(path, results):
+    with open(path, "w") as fp:
+        json.dump({"python": platform.python_version(),
+                   "results": results}, fp, indent=2, sort_keys=True)
+        fp.write("\n")
+
+
+def write_table(results, baseline=None):
+    sys.stdout.write("%-32s%14s%14s%14s%10s\n" % (
+        "case", "ops/s", "peak [B]", "retained", "vs base"))
+    for name, result in sorted(results.items()):
+        previous = (baseline or {}).get(name)
+        if previous and previous["ops"]:
+            relative = "%+.1f%%" % ((result["ops"] - previous["ops"]) * 100.0 /
+                                    previous["ops"])
+        else:
+            relative = ""
+        sys.stdout.write("%-32s%14.0f%14i%14.2f%10s\n" % (
+            name, result["ops"], result["peak_bytes"],
+            result["retained_blocks"], relative))
+
+
+def main(description, cases, number=10000, repeat=5):
+    """Parses the command line, runs ``cases`` and compares them to the
+    baseline.
+
+    :param cases: A function returning a dict mapping case names to functions,
+                  called after the arguments are parsed
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--number", type=int, default=number,
+                        help="Calls per run")
+    parser.add_argument("--repeat", type=int, default=repeat,
+                        help="Runs per case, the fastest counts")
+    parser.add_argument("--filter", default="",
+                        help="Only run cases whose name contains this")
+    parser.add_argument("--baseline", help="Compare to this JSON file")
+    parser.add_argument("--save", help="Write the results to this JSON file")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="Percent of change that counts as a regression")
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in sorted(cases().items()):
+        if args.filter in name:
+            results[name] = measure(func, args.number, args.repeat)
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+    write_table(results, baseline)
+    if args.save:
+        save_baseline(args.save, results)
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            sys.stdout.write("REGRESSION %s\n" % regression)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,98 @@
+"""Measures the overhead of timing callbacks with dispatch observers.
+
+A trivial command, a trivial regex and a command returning an already fired
+Deferred are dispatched with :func:`lala.pluginmanager._handle_message`
+while
+
+- ``none``: no dispatch observer is registered
+- ``noop``: an observer doing nothing is registered
+- ``prometheus``: the observer of the prometheus plugin is registered
+
+The cases are named ``<observer>:<callback>``. Every call installs the
+observers of its case, which costs the same in all of them.
+
+Usage::
+
+    python -m benchmarks.dispatch [--number N] [--repeat N] [--filter NAME]
+                                  [--save FILE] [--baseline FILE]
+                                  [--threshold PERCENT]
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from benchmarks import _harness
+
+MESSAGES = (("command", "!bench text"),
+            ("regex", "a benchmark message"),
+            ("deferred", "!deferred text"))
+
+
+class _Bot(object):
+    def msg(self, target, message, log=True):
+        pass
+
+
+def _noop(*args):
+    pass
+
+
+def setup(directory):
+    import lala.config
+    import lala.util
+
+    from twisted.internet.defer import succeed
+
+    configfile = os.path.join(directory, "config")
+    with open(configfile, "w") as fp:
+        fp.write("[base]\n")
+    lala.config._initialize(configfile)
+    lala.util._BOT = _Bot()
+
+    lala.util.command(command="bench")(lambda user, channel, text: None)
+    lala.util.command(command="deferred")(
+        lambda user, channel, text: succeed(None))
+    lala.util.regex("^a benchmark")(lambda user, channel, text, match: None)
+
+
+def observers():
+    """Returns a dict mapping the observer modes to the lists of observers
+    registered in them."""
+    import lala.pluginmanager
+    # Importing the plugin registers its metrics, init() would start a web
+    # server
+    from lala.plugins.prometheus import observe_callback
+    # Only measure the observer, not the plugin's own callbacks
+    lala.pluginmanager._regexes = {
+        regex: func for regex, func in lala.pluginmanager._regexes.items()
+        if func.plugin != "prometheus"}
+    return {"none": [], "noop": [_noop], "prometheus": [observe_callback]}
+
+
+def cases():
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    setup(directory)
+
+    import lala.pluginmanager
+
+    def dispatch(registered, message):
+        lala.pluginmanager._dispatch_observers = registered
+        lala.pluginmanager._handle_message("user", "#channel", message)
+
+    result = {}
+    for mode, registered in observers().items():
+        for name, message in MESSAGES:
+            result["%s:%s" % (mode, name)] = (
+                lambda registered=registered, message=message:
+                dispatch(registered, message))
+    return result
+
+
+def main():
+    _harness.main(__doc__.splitlines()[0], cases, number=20000)
+
+
+if __name__ == "__main__":
+    main()
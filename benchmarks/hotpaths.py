@@ -0,0 +1,143 @@
+"""Measures the hot paths of the bot.
+
+- ``handle_message``: :func:`lala.pluginmanager._handle_message` with the
+  bundled plugins loaded, for a chat message only matched by their regexes,
+  a trivial command and an unknown command
+- ``config``: :func:`lala.config.get` as called by plugins and
+  :func:`lala.config._get`
+- ``msg``: :func:`lala.util.msg` with a string, a list and a generator
+- ``decode``: :meth:`lala.bot.Lala._decode_if_required` with a str, UTF-8
+  and a message that needs the fallback encoding
+- ``is_admin``: :func:`lala.pluginmanager.is_admin` for an admin and a user
+
+Messages are sent through a real bot with a transport that discards them and
+without a line rate. Logging goes to a file at the INFO level, like the bot's
+does by default. The prometheus plugin, which listens on a port, and plugins
+whose dependencies are not installed are left out.
+
+Usage::
+
+    python -m benchmarks.hotpaths [--number N] [--repeat N] [--filter NAME]
+                                  [--save FILE] [--baseline FILE]
+                                  [--threshold PERCENT]
+"""
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+
+from benchmarks import _harness
+from importlib import import_module
+
+PLUGINS = ("birthday", "calendar", "decide", "down", "fortune", "httptitle",
+           "iw", "last", "log", "quotes", "roulette")
+
+MESSAGES = (("chat", "hello everyone, how is it going?"),
+            ("command", "!bench some text"),
+            ("unknown_command", "!doesnotexist some text"))
+
+
+def _plugins():
+    plugins = []
+    for name in PLUGINS:
+        try:
+            import_module("lala.plugins.%s" % name)
+        except ImportError as exc:
+            sys.stderr.write("Skipping %s: %s\n" % (name, exc))
+            continue
+        plugins.append(name)
+    return plugins
+
+
+def configure(directory):
+    """Writes a config file enabling the bundled plugins to ``directory``,
+    reads it and makes the root logger log to a file there."""
+    import lala.config
+    import lala.logqueue
+
+    lala.logqueue.log_to_file(os.path.join(directory, "lala.log"))
+
+    configfile = os.path.join(directory, "config")
+    with open(configfile, "w") as fp:
+        fp.write("[base]\n"
+                 "plugins = %s\n"
+                 "admins = admin,other\n"
+                 "fallback_encoding = iso-8859-1\n"
+                 "[log]\n"
+                 "log_file = %s\n"
+                 "log_folder = %s\n"
+                 "[quotes]\n"
+                 "database_path = %s\n"
+                 "[hotpaths]\n"
+                 "answer = 42\n"
+                 % (",".join(_plugins()),
+                    os.path.join(directory, "chat.log"),
+                    os.path.join(directory, "logs"),
+                    os.path.join(directory, "quotes.sqlite3")))
+    lala.config._initialize(configfile)
+
+
+def setup(directory):
+    """Configures and starts a bot with the bundled plugins.
+
+    :return: The bot
+    """
+    import lala.factory
+    import lala.util
+
+    from twisted.internet.testing import StringTransport
+
+    configure(directory)
+
+    class NullTransport(StringTransport):
+        def write(self, data):
+            pass
+
+    bot = lala.factory.LalaFactory("#lala", "lala").buildProtocol(None)
+    bot.lineRate = None
+    bot.makeConnection(NullTransport())
+    lala.util._BOT = bot
+    lala.util.command(command="bench")(lambda user, channel, text: None)
+    return bot
+
+
+def cases():
+    directory = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, directory)
+    bot = setup(directory)
+
+    import lala.config
+    import lala.pluginmanager
+    import lala.util
+
+    lines = ["line %i" % i for i in range(5)]
+
+    result = {
+        "config:get": lambda: lala.config.get("answer"),
+        "config:_get": lambda: lala.config._get("base", "encoding"),
+        "msg:str": lambda: lala.util.msg("#lala", "a message"),
+        "msg:list": lambda: lala.util.msg("#lala", lines),
+        "msg:generator": lambda: lala.util.msg("#lala",
+                                               (line for line in lines)),
+        "decode:str": lambda: bot._decode_if_required("a message"),
+        "decode:utf-8": lambda: bot._decode_if_required(
+            "ein \xfcberraschender Text".encode("utf-8")),
+        "decode:fallback": lambda: bot._decode_if_required(
+            "ein \xfcberraschender Text".encode("iso-8859-1")),
+        "is_admin:admin": lambda: lala.pluginmanager.is_admin("other"),
+        "is_admin:user": lambda: lala.pluginmanager.is_admin("user"),
+    }
+    for name, message in MESSAGES:
+        result["handle_message:%s" % name] = (
+            lambda message=message: lala.pluginmanager._handle_message(
+                "user", "#lala", message))
+    return result
+
+
+def main():
+    _harness.main(__doc__.splitlines()[0], cases)
+
+
+if __name__ == "__main__":
+    main()
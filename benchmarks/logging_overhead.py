@@ -0,0 +1,235 @@
+"""Measures what logging costs the reactor thread per received message.
+
+A bot with the ``log`` plugin receives ``--messages`` chat messages through
+:meth:`lala.bot.Lala.privmsg`. Every message is logged to the bot's log file
+(only at the DEBUG level) and to the chat log. This is measured with the root
+logger at the INFO and at the DEBUG level, and with the log files written
+
+- ``sync``: by :class:`logging.FileHandler` and
+  :class:`logging.handlers.TimedRotatingFileHandler` in the calling thread,
+  flushing after every record
+- ``queue``: by the writer thread of :mod:`lala.logqueue`
+
+Reported are the microseconds per message
+
+- ``caller``: the calling thread spends with messages sent back to back, the
+  fastest of ``--repeat`` runs. The writer thread competes with it for the
+  interpreter then.
+- ``written``: until the writer thread has written everything as well
+- ``paced``: the calling thread spends with ``--paced`` messages arriving
+  every ``--interval`` milliseconds, the median. This is closer to a bot,
+  whose reactor thread waits for the network most of the time while the
+  writer thread catches up.
+
+Two more rows compare formatting a message eagerly, ``logging.debug("%s" %
+message)``, to passing the arguments, ``logging.debug("%s", message)``, with
+DEBUG messages being dropped.
+
+Usage::
+
+    python -m benchmarks.logging_overhead [--messages N] [--repeat N]
+                                          [--paced N] [--interval MS]
+                                          [--json FILE]
+"""
+import argparse
+import json
+import logging
+import logging.handlers
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+
+from time import perf_counter, sleep
+
+LEVELS = (("info", logging.INFO), ("debug", logging.DEBUG))
+
+WRITERS = ("sync", "queue")
+
+
+def setup(directory):
+    """Configures and starts a bot with the ``log`` plugin.
+
+    :return: The bot
+    """
+    import lala.config
+    import lala.logqueue
+
+    # install() replaces it
+    lala.logqueue.log_to_file(os.devnull)
+
+    configfile = os.path.join(directory, "config")
+    with open(configfile, "w") as fp:
+        fp.write("[base]\n"
+                 "plugins = log\n"
+                 "[log]\n"
+                 "log_file = %s\n"
+                 "log_folder = %s\n"
+                 % (os.path.join(directory, "chat.log"),
+                    os.path.join(directory, "logs")))
+    lala.config._initialize(configfile)
+
+    import lala.factory
+    import lala.util
+
+    from twisted.internet.testing import StringTransport
+
+    class NullTransport(StringTransport):
+        def write(self, data):
+            pass
+
+    bot = lala.factory.LalaFactory("#lala", "lala").buildProtocol(None)
+    bot.lineRate = None
+    bot.makeConnection(NullTransport())
+    lala.util._BOT = bot
+    return bot
+
+
+def install(directory, writer):
+    """Makes the root logger and the chat log write to files in
+    ``directory`` with ``writer``."""
+    import lala.logqueue
+
+    root = logging.getLogger("")
+    chatlog = logging.getLogger("MessageLog")
+    for logger in (root, chatlog):
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+    lala.logqueue.stop()
+
+    queued = writer == "queue"
+    module = lala.logqueue if queued else logging
+    handler = module.FileHandler(os.path.join(directory, "lala.log"),
+                                 encoding="utf-8")
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s %(levelname)s %(filename)s: %(funcName)s:%(lineno)d"
+        " %(message)s"))
+    module = lala.logqueue if queued else logging.handlers
+    chathandler = module.TimedRotatingFileHandler(
+        os.path.join(directory, "chat.log"), when="midnight",
+        encoding="utf-8")
+    chathandler.setFormatter(
+        logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d %H:%M"))
+    for logger, target in ((root, handler), (chatlog, chathandler)):
+        if queued:
+            lala.logqueue.attach(logger, target)
+        else:
+            logger.addHandler(target)
+
+
+def measure(func, messages, repeat):
+    """Calls ``func`` ``messages`` times per run.
+
+    :rtype: tuple
+    :return: The fastest of ``repeat`` runs in microseconds per call, for the
+             calling thread and until the queued records have been written
+    """
+    import lala.logqueue
+
+    caller = written = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        for i in range(messages):
+            func(i)
+        called = perf_counter()
+        lala.logqueue.flush()
+        done = perf_counter()
+        caller = min(caller, (called - start) / messages * 1e6)
+        written = min(written, (done - start) / messages * 1e6)
+    return caller, written
+
+
+def measure_paced(func, messages, interval):
+    """Calls ``func`` ``messages`` times, every ``interval`` seconds.
+
+    :return: The median of the calls in microseconds
+    """
+    import lala.logqueue
+
+    durations = []
+    for i in range(messages):
+        start = perf_counter()
+        func(i)
+        durations.append(perf_counter() - start)
+        sleep(interval)
+    lala.logqueue.flush()
+    return statistics.median(durations) * 1e6
+
+
+def run(directory, messages, repeat, paced, interval):
+    """Measures every combination of level and writer.
+
+    :rtype: dict
+    :return: Maps names like ``debug:queue`` to (caller, written, paced)
+             tuples
+    """
+    bot = setup(directory)
+    root = logging.getLogger("")
+    results = {}
+
+    def privmsg(i):
+        bot.privmsg("user!user@example.com", "#lala", "message number %i" % i)
+
+    for writer in WRITERS:
+        install(directory, writer)
+        for level_name, level in LEVELS:
+            root.setLevel(level)
+            results["%s:%s" % (level_name, writer)] = measure(
+                privmsg, messages, repeat) + (
+                measure_paced(privmsg, paced, interval),)
+
+    root.setLevel(logging.INFO)
+    user, message = "user", "a message"
+    for name, func in (
+            ("format:eager",
+             lambda i: logging.debug("%s: %s" % (user, message))),
+            ("format:lazy", lambda i: logging.debug("%s: %s", user, message))):
+        results[name] = measure(func, messages, repeat) + (
+            measure_paced(func, paced, interval),)
+
+    import lala.logqueue
+    lala.logqueue.stop()
+    return results
+
+
+def report(results):
+    write = sys.stdout.write
+    write("%-16s%14s%14s%14s\n" % ("case", "caller [us]", "written [us]",
+                                   "paced [us]"))
+    for name in sorted(results):
+        write("%-16s%14.2f%14.2f%14.2f\n" % ((name,) + results[name]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="Messages per run")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Runs per case, the fastest counts")
+    parser.add_argument("--paced", type=int, default=2000,
+                        help="Messages of the paced run")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="Milliseconds between the paced messages")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        results = run(directory, args.messages, args.repeat, args.paced,
+                      args.interval / 1000)
+    finally:
+        shutil.rmtree(directory)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({name: dict(zip(("caller", "written", "paced"),
+                                      result))
+                       for name, result in results.items()},
+                      fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
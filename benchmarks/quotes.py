@@ -0,0 +1,245 @@
+"""Measures how the commands of the quotes plugin scale with the database.
+
+Databases with 10,000, 100,000 and 1,000,000 quotes (and five votes per
+quote) are built with :func:`test._quotesdata.build`. Every command is then
+sent ``--repeat`` times through :func:`lala.pluginmanager._handle_message`
+and :func:`lala.pluginmanager.on_join` for each of them:
+
+- ``qget``: a random quote by its ID
+- ``qsearch``: a random word
+- ``qrandom``
+- ``qtop``
+- ``qstats``
+- ``join``: the quote shown when a random user joins
+
+The queries run in the calling thread on a single connection, so the latency
+is that of the database without the hop to the plugin's thread pool.
+
+Reported are the median and the maximum latency per command and size, and
+how the median grows from one size to the next: ``x1.0`` per tenfold
+increase of the database is linear scaling, anything above it is marked as
+a scaling cliff.
+
+Building the databases takes a while, ``--cache`` keeps them for later runs.
+
+Usage::
+
+    python -m benchmarks.quotes [--sizes N,N,...] [--repeat N] [--cache DIR]
+                                [--json FILE]
+"""
+import argparse
+import json
+import math
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+
+from time import perf_counter
+
+SIZES = (10000, 100000, 1000000)
+
+#: The growth of the median per tenfold increase above which a command is
+#: marked
+CLIFF = 1.5
+
+
+class _Bot(object):
+    def msg(self, target, message, log=True):
+        pass
+
+
+class SynchronousPool(object):
+    """Runs the queries of :mod:`lala.plugins.quotes` right away instead of
+    in a thread pool like :class:`twisted.enterprise.adbapi.ConnectionPool`
+    does."""
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+
+    def runQuery(self, query, args=()):  # noqa: N802
+        from twisted.internet.defer import succeed
+        return succeed(self.connection.execute(query, args).fetchall())
+
+    def runInteraction(self, func, *args):  # noqa: N802
+        from twisted.internet.defer import succeed
+        result = func(self.connection.cursor(), *args)
+        self.connection.commit()
+        return succeed(result)
+
+    def close(self):
+        self.connection.close()
+
+
+def setup(directory):
+    """Configures the quotes plugin and makes it send messages nowhere.
+
+    :return: The plugin module
+    """
+    import lala.config
+    import lala.logqueue
+    import lala.util
+
+    lala.logqueue.log_to_file(os.path.join(directory, "lala.log"))
+
+    from lala.plugins import quotes
+
+    configfile = os.path.join(directory, "config")
+    with open(configfile, "w") as fp:
+        fp.write("[base]\n")
+    lala.config._initialize(configfile)
+    lala.config._set_default_options("quotes", quotes.DEFAULT_OPTIONS)
+    lala.util._BOT = _Bot()
+    return quotes
+
+
+def database(directory, size):
+    """Returns the path of the database with ``size`` quotes in ``directory``,
+    building it if it doesn't exist yet."""
+    from test._quotesdata import build
+
+    path = os.path.join(directory, "quotes-%i.sqlite3" % size)
+    if not os.path.exists(path):
+        sys.stderr.write("Building a database with %i quotes\n" % size)
+        start = perf_counter()
+        build(path + ".tmp", size)
+        os.rename(path + ".tmp", path)
+        sys.stderr.write("Built in %.1f s\n" % (perf_counter() - start))
+    return path
+
+
+def commands(quotes, size, rng):
+    """Returns a dict mapping the command names to functions calling them
+    with random arguments."""
+    import lala.pluginmanager
+
+    from test._quotesdata import WORDS, nick
+
+    def message(text):
+        return lambda: lala.pluginmanager._handle_message("user", "#lala",
+                                                          text())
+
+    users = max(1, size // 200)
+    return {
+        "qget": message(lambda: "!qget %i" % rng.randint(1, size)),
+        "qsearch": message(lambda: "!qsearch %s" % rng.choice(WORDS)),
+        "qrandom": message(lambda: "!qrandom"),
+        "qtop": message(lambda: "!qtop"),
+        "qstats": message(lambda: "!qstats"),
+        "join": lambda: lala.pluginmanager.on_join(
+            nick(rng.randrange(users)), "#lala"),
+    }
+
+
+def run(quotes, sizes, repeat, directory):
+    """Runs every command ``repeat`` times per size.
+
+    :rtype: dict
+    :return: Maps command names to dicts mapping sizes to the latencies in
+             seconds
+    """
+    results = {}
+    rng = random.Random(0)
+    for size in sizes:
+        quotes.db_connection = SynchronousPool(database(directory, size))
+        try:
+            for name, func in sorted(commands(quotes, size, rng).items()):
+                # Warms up SQLite's page cache
+                func()
+                latencies = []
+                for _ in range(repeat):
+                    start = perf_counter()
+                    func()
+                    latencies.append(perf_counter() - start)
+                results.setdefault(name, {})[size] = latencies
+        finally:
+            quotes.db_connection.close()
+            quotes.db_connection = None
+    return results
+
+
+def growth(results, sizes):
+    """Returns the factor the median latency of every command grows by per
+    tenfold increase of the database from one size to the next.
+
+    :rtype: dict
+    :return: Maps command names to lists with one factor per pair of sizes
+    """
+    factors = {}
+    for name, latencies in results.items():
+        factors[name] = []
+        for smaller, larger in zip(sizes, sizes[1:]):
+            before = statistics.median(latencies[smaller])
+            after = statistics.median(latencies[larger])
+            tenfolds = math.log10(larger / smaller)
+            factors[name].append(
+                (after / before) ** (1 / tenfolds) / 10 if before else 0.0)
+    return factors
+
+
+def report(results, sizes):
+    write = sys.stdout.write
+    factors = growth(results, sizes)
+    write("%-10s" % "command")
+    for size in sizes:
+        write("%24s" % ("%i quotes" % size))
+    for smaller, larger in zip(sizes, sizes[1:]):
+        write("%12s" % ("%s->%s" % (_short(smaller), _short(larger))))
+    write("\n")
+    for name in sorted(results):
+        write("%-10s" % name)
+        for size in sizes:
+            latencies = results[name][size]
+            write("%24s" % ("%.2f / %.2f ms" % (
+                statistics.median(latencies) * 1000,
+                max(latencies) * 1000)))
+        for factor in factors[name]:
+            write("%12s" % ("x%.1f%s" % (factor,
+                                         " !" if factor > CLIFF else "")))
+        write("\n")
+    write("\nLatencies are median / maximum. x1.0 means linear scaling, ! "
+          "marks growth above x%.1f.\n" % CLIFF)
+
+
+def _short(size):
+    for factor, suffix in ((1000000, "M"), (1000, "k")):
+        if size >= factor and size % factor == 0:
+            return "%i%s" % (size // factor, suffix)
+    return str(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="Comma separated numbers of quotes")
+    parser.add_argument("--repeat", type=int, default=20,
+                        help="Runs per command and size")
+    parser.add_argument("--cache",
+                        help="Keep the databases in this directory")
+    parser.add_argument("--json", help="Write the latencies to this file")
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+
+    directory = tempfile.mkdtemp()
+    try:
+        quotes = setup(directory)
+        if args.cache:
+            if not os.path.isdir(args.cache):
+                os.makedirs(args.cache)
+        results = run(quotes, sizes, args.repeat, args.cache or directory)
+    finally:
+        shutil.rmtree(directory)
+    report(results, sizes)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({name: {str(size): latencies
+                              for size, latencies in by_size.items()}
+                       for name, by_size in results.items()},
+                      fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""Measures the time it takes to import and set up all bundled plugins.
+
+Every run happens in a fresh interpreter so module imports are not cached.
+Three modes are compared:
+
+- ``eager``: every plugin is imported during setup
+- ``lazy-cold``: ``lazy_plugins`` is enabled, but there is no manifest yet,
+  so plugins are imported and the manifest is written
+- ``lazy-warm``: ``lazy_plugins`` is enabled and the manifest is up to date
+
+Plugins whose dependencies are not installed are skipped.
+
+Usage::
+
+    python -m benchmarks.startup [--repeat N]
+"""
+import argparse
+import json
+import os
+import pkgutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from importlib import import_module
+from time import perf_counter
+
+MODES = ("eager", "lazy-cold", "lazy-warm")
+
+
+def _child(configfile):
+    start = perf_counter()
+    import lala.config
+    import lala.pluginmanager
+    imported = perf_counter()
+    lala.config._initialize(configfile)
+    lala.pluginmanager.setup()
+    done = perf_counter()
+    sys.stdout.write(json.dumps({"import": imported - start,
+                                 "setup": done - imported,
+                                 "total": done - start}))
+
+
+def available_plugins():
+    """Returns the names of all bundled plugins that can be imported."""
+    import lala.plugins
+    plugins = []
+    for module in pkgutil.iter_modules(lala.plugins.__path__):
+        if module.name == "base":
+            continue
+        try:
+            import_module("lala.plugins.%s" % module.name)
+        except ImportError as exc:
+            sys.stderr.write("Skipping %s: %s\n" % (module.name, exc))
+            continue
+        plugins.append(module.name)
+    return plugins
+
+
+def write_config(directory, plugins, lazy):
+    path = os.path.join(directory, "config-%s" % ("lazy" if lazy else "eager"))
+    with open(path, "w") as fp:
+        fp.write("[base]\n")
+        fp.write("plugins = %s\n" % ",".join(plugins))
+        fp.write("lazy_plugins = %s\n" % ("true" if lazy else "false"))
+        fp.write("plugin_manifest = %s\n" % os.path.join(directory,
+                                                         "manifest.json"))
+        fp.write("[quotes]\ndatabase_path = :memory:\n")
+        fp.write("[log]\nlog_file = %s\nlog_folder = %s\n" % (
+            os.path.join(directory, "chat.log"),
+            os.path.join(directory, "logs")))
+        fp.write("[prometheus]\nport = 0\n")
+        fp.write("[websocket]\nport = 0\n")
+    return path
+
+
+def run_child(configfile):
+    output = subprocess.check_output(
+        [sys.executable, "-m", "benchmarks.startup", "--child", configfile])
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child)
+        return
+
+    plugins = available_plugins()
+    sys.stdout.write("Plugins: %s\n" % ", ".join(plugins))
+    results = {mode: [] for mode in MODES}
+    with tempfile.TemporaryDirectory() as directory:
+        eager = write_config(directory, plugins, lazy=False)
+        lazy = write_config(directory, plugins, lazy=True)
+        manifest = os.path.join(directory, "manifest.json")
+        for _ in range(args.repeat):
+            results["eager"].append(run_child(eager))
+            if os.path.exists(manifest):
+                os.remove(manifest)
+            results["lazy-cold"].append(run_child(lazy))
+            results["lazy-warm"].append(run_child(lazy))
+
+    sys.stdout.write("%-10s %12s %12s %12s\n"
+                     % ("mode", "import [ms]", "setup [ms]", "total [ms]"))
+    for mode in MODES:
+        row = [statistics.median(r[key] for r in results[mode]) * 1000
+               for key in ("import", "setup", "total")]
+        sys.stdout.write("%-10s %12.1f %12.1f %12.1f\n"
+                         % ((mode,) + tuple(row)))
+
+
+if __name__ == "__main__":
+    main()
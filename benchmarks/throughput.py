@@ -0,0 +1,177 @@
+"""Floods a bot with traffic from a fake IRC server on localhost.
+
+The bot, with the bundled plugins and a command echoing its argument, connects
+to :class:`test._ircserver.FakeIRCServer` over TCP. Once it has joined all
+channels, :class:`test._ircserver.LoadGenerator` sends chat messages,
+commands, joins, parts and quits at the given rates for ``--duration``
+seconds. Afterwards, answers are waited for another ``--drain`` seconds.
+
+Reported are
+
+- the lines per second the bot handled and how far it fell behind the server
+- the percentiles of the time from sending a command until its answer arrived
+- the length of the bot's send queue, which grows whenever the bot wants to
+  send more than its line rate allows
+
+Usage::
+
+    python -m benchmarks.throughput [--channels N] [--users N]
+                                    [--privmsg-rate N] [--command-rate N]
+                                    [--join-rate N] [--part-rate N]
+                                    [--quit-rate N] [--line-rate SECONDS]
+                                    [--duration SECONDS] [--drain SECONDS]
+                                    [--json FILE]
+"""
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+
+from benchmarks.hotpaths import configure
+
+KINDS = ("privmsg", "command", "join", "part", "quit")
+
+
+def run(args):
+    import lala.bot
+    import lala.factory
+    import lala.util
+
+    from test._ircserver import FakeIRCServer, LoadGenerator, percentile
+    from twisted.internet import reactor
+    from twisted.internet.task import LoopingCall
+
+    lala.util.command(command="echo")(
+        lambda user, channel, text: lala.util.msg(channel, text))
+
+    handled = [0]
+
+    class CountingLala(lala.bot.Lala):
+        def lineReceived(self, line):  # noqa: N802
+            handled[0] += 1
+            lala.bot.Lala.lineReceived(self, line)
+
+    if args.line_rate is not None:
+        CountingLala.lineRate = args.line_rate or None
+
+    server = FakeIRCServer(channels=args.channels, users=args.users)
+    port = reactor.listenTCP(0, server, interface="127.0.0.1")
+    factory = lala.factory.LalaFactory(",".join(server.channels), "lala")
+    factory.protocol = CountingLala
+    reactor.connectTCP("127.0.0.1", port.getHost().port, factory)
+
+    rates = {kind: getattr(args, "%s_rate" % kind) for kind in KINDS}
+    generator = LoadGenerator(server, rates)
+    samples = []
+    result = {}
+
+    def sample():
+        samples.append((reactor.seconds(), len(lala.util._BOT._queue),
+                        sum(generator.sent.values()), handled[0]))
+
+    sampler = LoopingCall(sample)
+
+    def wait_for_join():
+        if not all(server.joined(channel) for channel in server.channels):
+            reactor.callLater(0.1, wait_for_join)
+            return
+        handled[0] = 0
+        result["start"] = reactor.seconds()
+        generator.start()
+        sampler.start(0.1)
+        reactor.callLater(args.duration, stop_load)
+
+    def stop_load():
+        generator.stop()
+        result["end"] = reactor.seconds()
+        result["handled"] = handled[0]
+        reactor.callLater(args.drain, finish)
+
+    def finish():
+        sampler.stop()
+        reactor.stop()
+
+    reactor.callLater(0, wait_for_join)
+    reactor.run()
+
+    duration = result["end"] - result["start"]
+    sent = sum(generator.sent.values())
+    queue = [length for _, length, _, _ in samples]
+    behind = [lines - done for _, _, lines, done in samples]
+    latencies = sorted(generator.latencies)
+    return {
+        "duration": duration,
+        "sent": generator.sent,
+        "handled_per_second": result["handled"] / duration,
+        "sent_per_second": sent / duration,
+        "max_behind": max(behind or [0]),
+        "answered": len(latencies),
+        "unanswered": generator.unanswered,
+        "latency": {str(p): percentile(latencies, p)
+                    for p in (50, 90, 99, 100)},
+        "queue_max": max(queue or [0]),
+        "queue_final": queue[-1] if queue else 0,
+        "queue_growth_per_second": ((queue[-1] - queue[0]) /
+                                    (samples[-1][0] - samples[0][0])
+                                    if len(samples) > 1 else 0.0),
+    }
+
+
+def _milliseconds(seconds):
+    return "-" if seconds is None else "%.1f ms" % (seconds * 1000)
+
+
+def report(results):
+    write = sys.stdout.write
+    write("sent:         %s\n" % ", ".join(
+        "%i %s" % (results["sent"][kind], kind) for kind in KINDS))
+    write("throughput:   %.0f lines/s sent, %.0f lines/s handled, at most "
+          "%i lines behind\n" % (results["sent_per_second"],
+                                 results["handled_per_second"],
+                                 results["max_behind"]))
+    write("answers:      %i answered, %i unanswered\n"
+          % (results["answered"], results["unanswered"]))
+    write("latency:      p50 %s, p90 %s, p99 %s, max %s\n" % tuple(
+        _milliseconds(results["latency"][p])
+        for p in ("50", "90", "99", "100")))
+    write("send queue:   %i lines at most, %i at the end, %+.1f lines/s\n"
+          % (results["queue_max"], results["queue_final"],
+             results["queue_growth_per_second"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--channels", type=int, default=5)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--privmsg-rate", type=float, default=200,
+                        help="Chat messages per second")
+    parser.add_argument("--command-rate", type=float, default=2,
+                        help="Commands per second")
+    parser.add_argument("--join-rate", type=float, default=5)
+    parser.add_argument("--part-rate", type=float, default=4)
+    parser.add_argument("--quit-rate", type=float, default=1)
+    parser.add_argument("--line-rate", type=float,
+                        help="Seconds between two lines the bot sends, 0 "
+                             "for no limit. Defaults to the bot's")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--drain", type=float, default=2,
+                        help="Seconds to wait for answers afterwards")
+    parser.add_argument("--json", help="Write the results to this file")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        configure(directory)
+        results = run(args)
+    finally:
+        shutil.rmtree(directory)
+    report(results)
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+            fp.write("\n")
+
+
+if __name__ == "__main__":
+    main()
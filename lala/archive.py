@@ -0,0 +1,175 @@
+"""A full text search archive of the chat log
+
+The ``log`` plugin adds every message to an SQLite database if its
+``archive_file`` option is set. The messages are stored in the ``message``
+table and indexed by the FTS5 table ``message_fts``, which triggers keep up
+to date.
+
+The rows are added by the writer thread of :mod:`lala.logqueue`, one
+transaction per batch of records, so bursts of messages cost a single commit.
+Searches use a connection of the calling thread; the database is in WAL mode,
+so they don't wait for the writer. :meth:`Archive.close` closes the
+connections of all threads.
+"""
+import sqlite3
+import threading
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS message (
+    id INTEGER PRIMARY KEY,
+    time REAL NOT NULL,
+    channel TEXT NOT NULL,
+    nick TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_time ON message (time);
+CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5(
+    text, content='message', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS message_insert AFTER INSERT ON message BEGIN
+    INSERT INTO message_fts (rowid, text) VALUES (new.id, new.text);
+END;
+CREATE TRIGGER IF NOT EXISTS message_delete AFTER DELETE ON message BEGIN
+    INSERT INTO message_fts (message_fts, rowid, text)
+        VALUES ('delete', old.id, old.text);
+END;
+"""
+
+
+def _match(terms):
+    """Returns an FTS5 query matching messages containing all ``terms``.
+    Every term is quoted, so FTS5's operators are searched for literally. A
+    trailing ``*`` matches words starting with the term.
+
+    :raises ValueError: If there are no terms to search for
+    """
+    phrases = []
+    for term in terms:
+        prefix = term.endswith("*")
+        term = term.rstrip("*")
+        if not term:
+            continue
+        phrases.append('"%s"%s' % (term.replace('"', '""'),
+                                   "*" if prefix else ""))
+    if not phrases:
+        raise ValueError("Nothing to search for")
+    return " ".join(phrases)
+
+
+class Archive(object):
+    """The archive in the SQLite database ``path``."""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.executescript(_SCHEMA)
+
+    def connection(self):
+        """Returns the calling thread's connection to the database."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # close() closes it from another thread
+            connection = self._local.connection = sqlite3.connect(
+                self.path, check_same_thread=False)
+            with self._lock:
+                self._connections.append(connection)
+            # Durable enough in WAL mode, a crash loses only the last
+            # transactions
+            connection.execute("PRAGMA synchronous = NORMAL;")
+        return connection
+
+    def add(self, messages, first_id=None):
+        """Adds ``messages``, (time, channel, nick, text) tuples, in one
+        transaction.
+
+        :param int first_id: The id of the first message, the others get the
+                             following ones. By default, they get ids after
+                             the newest message's.
+        """
+        if first_id is None:
+            query = ("INSERT INTO message (time, channel, nick, text) "
+                     "VALUES (?, ?, ?, ?);")
+            rows = ((time, channel.lower(), nick, text)
+                    for time, channel, nick, text in messages)
+        else:
+            query = ("INSERT INTO message (id, time, channel, nick, text) "
+                     "VALUES (?, ?, ?, ?, ?);")
+            rows = ((id_, time, channel.lower(), nick, text)
+                    for id_, (time, channel, nick, text)
+                    in enumerate(messages, first_id))
+        with self.connection() as connection:
+            connection.executemany(query, rows)
+
+    def ids_before(self, count):
+        """Returns the first of ``count`` ids below those of all messages.
+        Messages older than all others have to get them, the search relies
+        on the ids growing with the time."""
+        lowest = self.connection().execute(
+            "SELECT min(id) FROM message;").fetchone()[0]
+        return (1 if lowest is None else lowest) - count
+
+    def prune(self, before):
+        """Removes the messages older than the timestamp ``before``.
+
+        :return: The number of removed messages
+        """
+        with self.connection() as connection:
+            return connection.execute("DELETE FROM message WHERE time < ?;",
+                                      (before,)).rowcount
+
+    def remove(self, first_id, end_id):
+        """Removes the messages with ids from ``first_id`` up to, but not
+        including, ``end_id``.
+
+        :return: The number of removed messages
+        """
+        with self.connection() as connection:
+            return connection.execute(
+                "DELETE FROM message WHERE id >= ? AND id < ?;",
+                (first_id, end_id)).rowcount
+
+    def oldest(self, channel):
+        """Returns the time of the oldest message of ``channel``, None if
+        there is none."""
+        return self.connection().execute(
+            "SELECT min(time) FROM message WHERE channel = ?;",
+            (channel.lower(),)).fetchone()[0]
+
+    def search(self, terms, channel=None, nick=None, limit=10):
+        """Returns the newest ``limit`` messages containing all ``terms`` as
+        (time, channel, nick, text) tuples, the oldest first.
+
+        :param str channel: Only search the messages of this channel
+        :param str nick: Only search the messages of this nick
+        :raises ValueError: If there are no terms to search for
+        """
+        query = ["SELECT message.time, message.channel, message.nick, "
+                 "message.text FROM message_fts "
+                 "JOIN message ON message.id = message_fts.rowid "
+                 "WHERE message_fts MATCH ?"]
+        args = [_match(terms)]
+        if channel is not None:
+            query.append("AND message.channel = ?")
+            args.append(channel.lower())
+        if nick is not None:
+            query.append("AND message.nick = ? COLLATE NOCASE")
+            args.append(nick)
+        # The rowids grow with the time, FTS5 walks them backwards and stops
+        # at the limit
+        query.append("ORDER BY message_fts.rowid DESC LIMIT ?;")
+        args.append(limit)
+        rows = self.connection().execute(" ".join(query), args).fetchall()
+        rows.reverse()
+        return rows
+
+    def close(self):
+        """Closes the connections of all threads. Using the archive
+        afterwards opens new ones."""
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._local = threading.local()
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,393 @@
+"""Backfilling the chat log's indexes from its files
+
+The channel segments of :mod:`lala.segments` and the archive of
+:mod:`lala.archive` only contain the messages received since they were
+enabled. This feeds the chat log the ``log`` plugin wrote before, including
+the rotated and compressed files, to their handlers::
+
+    python -m lala.backfill [--config FILE] [--channel CHANNEL]
+                            [--targets TARGETS] [--batch N]
+                            [--checkpoint FILE] [--progress SECONDS]
+
+The files are streamed, the oldest first, through a pipeline of generators:
+their lines are parsed to the records :func:`lala.plugins.log.chatlog` logs,
+which are passed to the handlers in batches, like the writer thread of
+:mod:`lala.logqueue` does while the bot runs. The archive adds every batch in
+one transaction.
+
+The chat log doesn't record the channel of a message, the messages are
+attributed to ``--channel``, which defaults to the only channel in the
+config. Every target only gets the messages from before its oldest one, the
+days the segments start on and the minute of the oldest archived message of
+the channel, so nothing is added twice. The archived messages get ids below
+those of all others, see :meth:`lala.archive.Archive.ids_before`. Messages
+older than ``max_log_days`` are skipped, the plugin would remove them anyway.
+
+After every batch, the position in the chat log, the times the targets start
+at, the size of the segment being written and the next archive id are saved
+to the checkpoint, ``<log_file>.backfill`` by default. An interrupted run
+continues from there, after truncating the segment and removing the archived
+messages added since, see :func:`rewind`; remove it to start over. The bot
+must not write the channel's segments meanwhile.
+"""
+import argparse
+import datetime
+import json
+import lala.archive
+import lala.config as config
+import lala.logqueue
+import lala.segments
+import logging
+import os
+import re
+import sys
+import time
+
+from time import perf_counter
+
+#: The targets that can be backfilled
+TARGETS = ("segments", "archive")
+
+#: A line of the chat log, see :func:`lala.plugins.log.init`
+_LINE = re.compile(r"^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}) (.*?): (.*)$")
+
+_CHECKPOINT_SUFFIX = ".backfill"
+
+#: The ids reserved for the messages added to the archive by a run
+_ARCHIVE_IDS = 1 << 40
+
+
+def _option(key):
+    """Returns the value of the ``log`` plugin's option ``key``. Unlike
+    :func:`lala.config.get`, this doesn't write the defaults to the config
+    file."""
+    # Importing a plugin registers its commands, it's imported on demand
+    from lala.plugins import log
+    default = config._CFG.defaults().get(key, log.DEFAULT_OPTIONS.get(key))
+    return str(config._CFG.get("log", key, fallback=default))
+
+
+def files(logfile):
+    """Yields the chat log ``logfile`` and its rotated files, the oldest
+    first, as (day, path) tuples. The current file's day is the one it was
+    last written on, it becomes the stamp of the rotated file."""
+    from lala.plugins import log
+    prefix = len(os.path.basename(logfile)) + 1
+    for path in reversed(log._rotated(logfile)):
+        yield os.path.basename(path)[prefix:prefix + 10], path
+    if os.path.exists(logfile):
+        yield (datetime.date.fromtimestamp(
+            os.path.getmtime(logfile)).isoformat(), logfile)
+
+
+def lines(paths, start=None):
+    """Yields the lines of the (day, path) tuples ``paths`` as (day, number,
+    line) tuples, the lines numbered from 1 per file.
+
+    :param tuple start: (day, number) of the last line to skip
+    """
+    from lala.plugins import log
+    for day, path in paths:
+        if start is not None and day < start[0]:
+            continue
+        skip = start[1] if start is not None and day == start[0] else 0
+        try:
+            fp = log._open(path)
+        except FileNotFoundError:
+            # Compressed since listing the directory
+            fp = log._open(path + log._GZIP_SUFFIX)
+        with fp:
+            for number, line in enumerate(fp, 1):
+                if number > skip:
+                    yield day, number, line.rstrip("\n")
+
+
+def records(lines, channel):
+    """Yields (day, number, record) tuples for the (day, number, line)
+    tuples ``lines``, with the records :func:`lala.plugins.log.chatlog`
+    logs. Lines that aren't messages yield None instead of a record."""
+    logger = logging.getLogger("MessageLog")
+    for day, number, line in lines:
+        match = _LINE.match(line)
+        if match is None:
+            yield day, number, None
+            continue
+        stamp, nick, text = match.groups()
+        record = logger.makeRecord(
+            logger.name, logging.INFO, __file__, 0, "%s: %s",
+            (nick, text), None, "chatlog",
+            {"channel": channel, "nick": nick, "text": text})
+        record.created = time.mktime(time.strptime(stamp, "%Y-%m-%d %H:%M"))
+        record.msecs = 0
+        yield day, number, record
+
+
+def retained(records, days):
+    """Replaces the records older than ``days`` days with None. 0 keeps all
+    of them."""
+    if days <= 0:
+        yield from records
+        return
+    oldest = time.mktime((datetime.date.today() -
+                          datetime.timedelta(days=days)).timetuple())
+    for day, number, record in records:
+        if record is not None and record.created < oldest:
+            record = None
+        yield day, number, record
+
+
+def batches(items, size):
+    """Yields lists of up to ``size`` of ``items``."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _before(cutoff):
+    """Returns a filter for records from before the timestamp ``cutoff``,
+    which may be None to let all through."""
+    return lambda record: cutoff is None or record.created < cutoff
+
+
+def _cutoffs(targets, channel, folder, archive):
+    """Returns a dict mapping ``targets`` to the time their oldest message of
+    ``channel`` is from, None if they don't have any."""
+    cutoffs = {}
+    if "segments" in targets:
+        existing = lala.segments.segments(folder, channel)
+        cutoffs["segments"] = None if not existing else time.mktime(
+            time.strptime(existing[0][0], "%Y-%m-%d"))
+    if "archive" in targets:
+        oldest = archive.oldest(channel)
+        # The chat log only has the minutes
+        cutoffs["archive"] = None if oldest is None else oldest - oldest % 60
+    return cutoffs
+
+
+def load_checkpoint(path):
+    """Returns the checkpoint saved to ``path``, None if there is none."""
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, checkpoint):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as fp:
+        json.dump(checkpoint, fp)
+    os.replace(tmp, path)
+
+
+def _cutoff_day(cutoff):
+    return None if cutoff is None else time.strftime("%Y-%m-%d",
+                                                     time.localtime(cutoff))
+
+
+def _backfilled_segments(folder, channel, cutoff):
+    """Returns the (day, path) tuples of the segments of ``channel`` from
+    before the timestamp ``cutoff`` of the segments target, those a backfill
+    writes."""
+    day = _cutoff_day(cutoff)
+    return [(segment_day, path) for segment_day, path
+            in lala.segments.segments(folder, channel)
+            if day is None or segment_day < day]
+
+
+def _segment_state(folder, channel, cutoff):
+    """Returns the day, size and index size of the newest segment a
+    backfill wrote, None if there is none."""
+    written = _backfilled_segments(folder, channel, cutoff)
+    if not written:
+        return None
+    day, path = written[-1]
+    if path.endswith(lala.segments._GZIP_SUFFIX):
+        # Finished before the checkpoint, nothing was appended since
+        return (day, None, None)
+    return (day, os.path.getsize(path),
+            os.path.getsize(path + lala.segments._INDEX_SUFFIX))
+
+
+def rewind(checkpoint, channel, handlers):
+    """Removes what an interrupted backfill added after saving
+    ``checkpoint``: the lines appended to the segments and the messages
+    added to the archive."""
+    segments = handlers.get("segments")
+    if segments is not None:
+        state = checkpoint["segment"]
+        for day, path in _backfilled_segments(
+                segments.folder, channel, checkpoint["cutoffs"]["segments"]):
+            if state is None or day > state[0]:
+                lala.segments.discard(path)
+            elif day == state[0] and state[1] is not None:
+                lala.segments.truncate(
+                    os.path.join(os.path.dirname(path),
+                                 day + lala.segments._SUFFIX),
+                    state[1], state[2])
+    archive = handlers.get("archive")
+    if archive is not None:
+        archive.archive.remove(checkpoint["next_id"], checkpoint["end_id"])
+
+
+class _Progress(object):
+    """Writes the progress to ``stream`` every ``interval`` seconds."""
+    def __init__(self, stream, interval):
+        self.stream = stream
+        self.interval = interval
+        self.started = self.reported = perf_counter()
+        self.lines = self.messages = 0
+
+    def update(self, day, number, lines, messages):
+        self.lines += lines
+        self.messages += messages
+        now = perf_counter()
+        if self.interval and now - self.reported >= self.interval:
+            self.reported = now
+            self.stream.write("%s line %i: %i messages, %.0f lines/s\n" % (
+                day, number, self.messages,
+                self.lines / (now - self.started)))
+            self.stream.flush()
+
+
+def backfill(logfile, channel, handlers, checkpoint, checkpoint_file,
+             days=0, size=lala.logqueue.BATCH_SIZE, progress=None):
+    """Passes the messages of the chat log ``logfile`` to ``handlers``, a
+    dict mapping target names to :class:`logging.Handler` objects.
+
+    :param dict checkpoint: ``position``, the (day, number) of the last line
+                            passed on or None, ``cutoffs``, see
+                            :func:`_cutoffs`, ``segment``, see
+                            :func:`_segment_state`, and ``next_id`` and
+                            ``end_id``, the ids left for the archive. Saved
+                            to ``checkpoint_file`` after every batch.
+    :param _Progress progress:
+    :rtype: tuple
+    :return: The number of lines read and of messages passed on to at
+             least one handler
+    """
+    rewind(checkpoint, channel, handlers)
+    for name, handler in handlers.items():
+        handler.addFilter(_before(checkpoint["cutoffs"].get(name)))
+    segments = handlers.get("segments")
+    archive = handlers.get("archive")
+    if archive is not None:
+        archive.next_id = checkpoint["next_id"]
+    targets = tuple(handlers.values())
+    position = checkpoint["position"]
+    pipeline = retained(records(lines(files(logfile), position), channel),
+                        days)
+    read = passed = 0
+    for batch in batches(pipeline, size):
+        messages = [(targets, record) for _, _, record in batch
+                    if record is not None and
+                    any(handler.filter(record) for handler in targets)]
+        lala.logqueue._write(messages)
+        day, number, _ = batch[-1]
+        checkpoint["position"] = (day, number)
+        if segments is not None:
+            checkpoint["segment"] = _segment_state(
+                segments.folder, channel, checkpoint["cutoffs"]["segments"])
+        if archive is not None:
+            checkpoint["next_id"] = archive.next_id
+        save_checkpoint(checkpoint_file, checkpoint)
+        read += len(batch)
+        passed += len(messages)
+        if progress is not None:
+            progress.update(day, number, len(batch), len(messages))
+    return read, passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", help="The bot's config file")
+    parser.add_argument("--channel",
+                        help="The channel of the messages. Defaults to the "
+                             "only channel in the config")
+    parser.add_argument("--targets", default=",".join(TARGETS),
+                        help="What to backfill, of %s. The archive is only "
+                             "backfilled if archive_file is set"
+                             % ", ".join(TARGETS))
+    parser.add_argument("--batch", type=int,
+                        default=lala.logqueue.BATCH_SIZE,
+                        help="Messages per transaction")
+    parser.add_argument("--checkpoint",
+                        help="The checkpoint file. Defaults to the log "
+                             "file's name with %s appended"
+                             % _CHECKPOINT_SUFFIX)
+    parser.add_argument("--progress", type=float, default=5.0,
+                        help="Seconds between progress reports, 0 for none")
+    args = parser.parse_args(argv)
+    from lala.plugins import log
+
+    logging.basicConfig(level=logging.WARNING)
+    config._initialize(args.config)
+    logfile = _option("log_file")
+    folder = _option("log_folder")
+    archive_file = _option("archive_file")
+    days = int(_option("max_log_days"))
+    channel = args.channel
+    if channel is None:
+        channels = [name for name in
+                    config._get("base", "channels").split(",") if name]
+        if len(channels) != 1:
+            parser.error("--channel is required unless the config has "
+                         "exactly one channel")
+        channel = channels[0]
+    targets = [name for name in args.targets.split(",") if name]
+    unknown = set(targets) - set(TARGETS)
+    if unknown:
+        parser.error("Unknown targets: %s" % ", ".join(sorted(unknown)))
+    if not archive_file and "archive" in targets:
+        targets.remove("archive")
+    checkpoint_file = args.checkpoint or logfile + _CHECKPOINT_SUFFIX
+
+    archive = lala.archive.Archive(archive_file) if "archive" in targets \
+        else None
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint is None:
+        next_id = None if archive is None \
+            else archive.ids_before(_ARCHIVE_IDS)
+        checkpoint = {"channel": channel, "targets": targets,
+                      "position": None,
+                      "cutoffs": _cutoffs(targets, channel, folder, archive),
+                      "segment": None,
+                      "next_id": next_id,
+                      "end_id": None if archive is None
+                      else next_id + _ARCHIVE_IDS}
+        # The cutoffs have to survive an interrupted first batch
+        save_checkpoint(checkpoint_file, checkpoint)
+    elif (checkpoint["channel"], checkpoint["targets"]) != (channel, targets):
+        parser.error("%s is the checkpoint of backfilling %s of %s" % (
+            checkpoint_file, ", ".join(checkpoint["targets"]),
+            checkpoint["channel"]))
+    handlers = {}
+    if "segments" in targets:
+        handlers["segments"] = log._SegmentHandler(folder, days)
+    if archive is not None:
+        handlers["archive"] = log._ArchiveHandler(archive, days)
+
+    start = perf_counter()
+    try:
+        read, passed = backfill(logfile, channel, handlers, checkpoint,
+                                checkpoint_file, days, args.batch,
+                                _Progress(sys.stderr, args.progress))
+    finally:
+        for handler in handlers.values():
+            handler.close()
+    duration = perf_counter() - start
+    sys.stdout.write(
+        "backfilled: %s with %i messages of %i lines of %s in %.1f s, "
+        "%.0f lines/s\n"
+        % (", ".join(handlers) or "nothing", passed, read, logfile, duration,
+           read / duration if duration else 0))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
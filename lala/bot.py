@@ -1,6 +1,10 @@
 import logging
+import lala.capture
+import lala.latency
 import lala.pluginmanager
+import lala.startup
 
+from collections import deque
 from twisted.words.protocols import irc
 from lala import config, __version__
 
@@ -17,6 +21,9 @@ class Lala(irc.IRCClient):
 
     def __init__(self, *args, **kwargs):
         self.identified_admins = []
+        # The lala.latency.Request of every line in the send queue
+        self._line_requests = deque()
+        self._sending = None
 
     @property
     def nickname(self):
@@ -26,14 +33,25 @@ class Lala(irc.IRCClient):
     def nickname(self, value):
         self.factory.nickname = value
 
+    def connectionMade(self):  # noqa: N802
+        lala.startup.end("connect")
+        lala.startup.begin("registration")
+        irc.IRCClient.connectionMade(self)
+
     def signedOn(self):  # noqa: N802
         """ Called after a connection to the server has been established.
 
         Joins all configured channels and identifies with Nickserv."""
         self.factory.resetDelay()
-        logging.debug("Joining %s" % self.factory.channel)
+        lala.startup.end("registration")
+        logging.debug("Joining %s", self.factory.channel)
         if self.factory.channel:
+            for channel in self.factory.channel.split(
+                    config._LIST_SEPARATOR):
+                lala.startup.begin("join", channel)
             self.join(self.factory.channel)
+        else:
+            lala.startup.finish()
         if self.factory.nspassword is not None:
             logging.info("Identifying with Nickserv")
             self.msg("Nickserv", "identify %s" % self.factory.nspassword,
@@ -45,11 +63,14 @@ class Lala(irc.IRCClient):
 
     def joined(self, channel):
         """ Called after joining a channel."""
-        logging.info("Successfully joined %s" % channel)
+        logging.info("Successfully joined %s", channel)
+        if lala.startup.end("join", channel) and \
+                not lala.startup.running("join"):
+            lala.startup.finish()
 
     def userJoined(self, user, channel):  # noqa: N802
         """ Handles join events."""
-        logging.debug("%s joined %s" % (user, channel))
+        logging.debug("%s joined %s", user, channel)
         lala.pluginmanager.on_join(user, channel)
 
     def privmsg(self, user, channel, message):
@@ -59,9 +80,17 @@ class Lala(irc.IRCClient):
             # This is true if the bot was queried
             channel = user
         message = self._decode_if_required(message)
-        logging.debug("%s: %s" % (user, message))
+        logging.debug("%s: %s", user, message)
         lala.pluginmanager._handle_message(user, channel, message)
 
+    def lineReceived(self, line):  # noqa: N802
+        lala.capture.record(line)
+        lala.latency.line_received()
+        try:
+            irc.IRCClient.lineReceived(self, line)
+        finally:
+            lala.latency.line_handled()
+
     def msg(self, channel, message, log, length=None):
         """ Sends ``message`` to ``channel``.
 
@@ -70,23 +99,42 @@ class Lala(irc.IRCClient):
         Do not use this method from plugins, use :meth:`lala.util.msg` instead.
         """
         if log:
-            logging.debug("%s: %s" % (self.nickname, message))
-        irc.IRCClient.msg(self, channel, message, length)
+            logging.debug("%s: %s", self.nickname, message)
+        self._sending = lala.latency.request_for(channel)
+        try:
+            irc.IRCClient.msg(self, channel, message, length)
+        finally:
+            self._sending = None
+
+    def sendLine(self, line):  # noqa: N802
+        self._line_requests.append(self._sending)
+        irc.IRCClient.sendLine(self, line)
+
+    def _reallySendLine(self, line):  # noqa: N802
+        request = (self._line_requests.popleft() if self._line_requests
+                   else None)
+        irc.IRCClient._reallySendLine(self, line)
+        if request is not None:
+            lala.latency.sent(request)
+
+    def connectionLost(self, reason):  # noqa: N802
+        irc.IRCClient.connectionLost(self, reason)
+        self._line_requests.clear()
 
     def action(self, user, channel, data):
         """ Called when a user performs an ACTION on a channel."""
         user = user.split("!")[0]
-        logging.info("ACTION: %s %s" % (user, data))
+        logging.info("ACTION: %s %s", user, data)
 
     def noticed(self, user, channel, message):
         """ Same as :py:meth:`lala.bot.Lala.privmsg` for NOTICEs."""
         user = user.split("!")[0]
         message = self._decode_if_required(message)
-        logging.info("NOTICE: %s: %s" % (user, message))
+        logging.info("NOTICE: %s: %s", user, message)
 
     def irc_RPL_WHOISREGNICK(self, prefix, params):  # noqa: N802
         user = params[1]
-        logging.debug("%s is a registered nick" % user)
+        logging.debug("%s is a registered nick", user)
         if (self.factory.nspassword is not None and
             user in self._list_of_admins()):
             self.identified_admins.append(user)
@@ -106,7 +154,7 @@ class Lala(irc.IRCClient):
         """
         if self.factory.nspassword is not None and set and user == "Chanserv"\
            and user in self._list_of_admins():
-            logging.info("Assuming %s is identified" % user)
+            logging.info("Assuming %s is identified", user)
             self.identified_admins.append(user)
 
     def _potential_admin_left(self, user):
@@ -116,7 +164,7 @@ class Lala(irc.IRCClient):
         if not config._CFG.getboolean("base", "nickserv_admin_tracking"):
             return
         if user in self._list_of_admins() and user in self.identified_admins:
-            logging.debug("Removing %s from the admin list" % user)
+            logging.debug("Removing %s from the admin list", user)
             self.identified_admins.remove(user)
 
     def _potential_admin_joined(self, user):
@@ -124,7 +172,7 @@ class Lala(irc.IRCClient):
             return
         if (user in self._list_of_admins() and
             user not in self.identified_admins):
-            logging.debug("WHOISing %s" % user)
+            logging.debug("WHOISing %s", user)
             self.whois(user)
 
     @staticmethod
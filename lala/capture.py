@@ -0,0 +1,159 @@
+"""Capturing the lines received from the server
+
+If the ``capture_file`` option of the "base" section is set, every line the
+bot receives is appended to that file, exactly as it was received, together
+with the time since the previous line. The file is rotated once it is larger
+than ``capture_max_bytes``, keeping ``capture_backups`` old files, like
+:class:`logging.handlers.RotatingFileHandler` does.
+
+Every time a file is opened, a header with the current time is written::
+
+    # lala-capture 1 1700000000.123456
+
+followed by one line per received line::
+
+    <microseconds since the previous line> <raw line>
+
+:func:`read` merges the captured files again, :mod:`lala.replay` feeds them
+into a bot.
+"""
+import lala.config
+import logging
+import os
+import time
+
+from twisted.internet import reactor
+
+HEADER = b"# lala-capture 1 "
+
+_CAPTURE = None
+
+
+class Capture(object):
+    """Appends lines to ``path``.
+
+    :param int max_bytes: The size after which the file is rotated, 0 never
+                          rotates it
+    :param int backups: The number of rotated files to keep
+    """
+    def __init__(self, path, max_bytes, backups, clock=time.monotonic,
+                 wall_clock=time.time):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.fp = None
+        self.size = 0
+        self.last = None
+        self._open()
+
+    def _open(self):
+        self.fp = open(self.path, "ab")
+        self.size = self.fp.tell()
+        self.last = self.clock()
+        self._write(b"%s%.6f\n" % (HEADER, self.wall_clock()))
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+
+    def record(self, line):
+        """Appends ``line``, which must not contain a newline."""
+        now = self.clock()
+        self._write(b"%i %s\n" % ((now - self.last) * 1000000, line))
+        self.last = now
+        if self.max_bytes and self.size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.fp.close()
+        if self.backups > 0:
+            for i in range(self.backups - 1, 0, -1):
+                source = "%s.%i" % (self.path, i)
+                if os.path.exists(source):
+                    os.replace(source, "%s.%i" % (self.path, i + 1))
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def close(self):
+        if not self.fp.closed:
+            self.fp.close()
+
+
+def record(line):
+    """Called by the bot with every line it receives."""
+    if _CAPTURE is not None:
+        _CAPTURE.record(line)
+
+
+def start():
+    """Starts capturing if ``capture_file`` is set."""
+    global _CAPTURE
+    path = lala.config._get("base", "capture_file")
+    if not path or _CAPTURE is not None:
+        return
+    path = os.path.expanduser(path)
+    _CAPTURE = Capture(path,
+                       int(lala.config._get("base", "capture_max_bytes")),
+                       int(lala.config._get("base", "capture_backups")))
+    logging.info("Capturing the lines from the server to %s", path)
+    reactor.addSystemEventTrigger("before", "shutdown", stop)
+
+
+def stop():
+    """Stops capturing."""
+    global _CAPTURE
+    if _CAPTURE is not None:
+        _CAPTURE.close()
+        _CAPTURE = None
+
+
+def _read_file(path):
+    """Yields (wall time, seconds, line) tuples for the lines of a captured
+    file, the seconds counting from its first header."""
+    with open(path, "rb") as fp:
+        start = None
+        offset = 0.0
+        for data in fp:
+            data = data.rstrip(b"\n")
+            if data.startswith(HEADER):
+                wall = float(data[len(HEADER):])
+                if start is None:
+                    start = wall
+                # Monotonic time doesn't survive restarts, so the time
+                # between two headers is taken from the wall clock
+                offset = max(offset, wall - start)
+                continue
+            if start is None:
+                raise ValueError("%s is not a capture file" % path)
+            delta, _, line = data.partition(b" ")
+            offset += int(delta) / 1000000.0
+            yield start, offset, line
+
+
+def read(paths):
+    """Yields (seconds, line) tuples for the lines captured in ``paths``,
+    which are sorted by the time they were written, the seconds counting
+    from the first line.
+
+    :param paths: The paths of captured files, for example a capture file and
+                  its rotated backups in any order
+    """
+    def first_header(path):
+        with open(path, "rb") as fp:
+            data = fp.readline()
+        if not data.startswith(HEADER):
+            raise ValueError("%s is not a capture file" % path)
+        return float(data[len(HEADER):])
+
+    paths = sorted(paths, key=first_header)
+    first = None
+    for path in paths:
+        for file_start, offset, line in _read_file(path):
+            offset += file_start
+            if first is None:
+                first = offset
+            yield offset - first, line
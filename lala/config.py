@@ -32,7 +32,28 @@ _CONFIG_DEFAULTS = {
     "encoding": "utf-8",
     "fallback_encoding": "utf-8",
     "max_log_days": 2,
-    "nickserv_admin_tracking": "false"
+    "nickserv_admin_tracking": "false",
+    "lazy_plugins": "false",
+    "plugin_manifest": expanduser("~/.lala/plugin_manifest.json"),
+    "plugin_threads": "4",
+    "worker_plugins": "",
+    "workers": "0",
+    "worker_timeout": "30",
+    "command_timeout": "60",
+    "reactor": "default",
+    "user_rate_limit": "",
+    "channel_rate_limit": "",
+    "command_rate_limits": "",
+    "watchdog_threshold": "0",
+    "profile_dir": expanduser("~/.lala/profiles"),
+    "profile_top": "10",
+    "memory_interval": "0",
+    "memory_frames": "10",
+    "memory_top": "10",
+    "capture_file": "",
+    "capture_max_bytes": "10485760",
+    "capture_backups": "5",
+    "plugin_init_timeout": "30"
 }
 
 
@@ -94,7 +115,7 @@ def get(key, converter=None):
     :param key: The key to lookup
     """
     plugin = _find_current_plugin_name()
-    logging.info("%s wants to get the value of %s" % (plugin, key))
+    logging.info("%s wants to get the value of %s", plugin, key)
     value = None
     value = _CFG.get(plugin, key)
     if converter is not None:
@@ -121,7 +142,7 @@ def set(key, value, plugin=None):
     plugin = _find_current_plugin_name()
     if not isinstance(value, string_types):
         value = str(value)
-    logging.info("%s wants to set the value of %s to %s" % (plugin, key, value))
+    logging.info("%s wants to set the value of %s to %s", plugin, key, value)
     _set(plugin, key, value)
 
 
@@ -1,4 +1,5 @@
 import lala.pluginmanager
+import lala.startup
 
 from twisted.internet import protocol
 from lala.bot import Lala
@@ -15,7 +16,16 @@ class LalaFactory(protocol.ReconnectingClientFactory):
             self.nspassword = config._get("base", "nickserv_password")
         except Exception:
             self.nspassword = None
-        lala.pluginmanager.setup()
+        #: Fires once all plugins have been initialized
+        self.ready = lala.pluginmanager.setup()
+
+    def startedConnecting(self, connector):  # noqa: N802
+        lala.startup.begin("connect")
+
+    def clientConnectionFailed(self, connector, reason):  # noqa: N802
+        lala.startup.end("connect")
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
 
     def buildProtocol(self, addr):  # noqa: N802
         prot = protocol.ReconnectingClientFactory.buildProtocol(self, addr)
@@ -0,0 +1,135 @@
+"""End-to-end latency of commands and regexes
+
+Every line received from the server is timestamped. When it triggers a
+command or regex, a :class:`Request` is created and made the current one
+while the callback runs. :mod:`contextvars` carry it into coroutines and
+:func:`twisted.internet.defer.inlineCallbacks` functions. Messages sent from
+other callbacks, threads or worker processes are attributed to the oldest
+request of their target whose Deferreds haven't fired yet.
+
+The bot remembers the request of every line it sends and tells the observers
+registered with :func:`add_observer` how long after the receipt of the
+request the line was actually written to the socket, which includes the time
+it waited because of the bot's line rate.
+"""
+import logging
+import time
+
+from collections import defaultdict
+from contextvars import ContextVar
+
+_now = time.monotonic
+
+#: The request whose callback is currently running
+_current = ContextVar("lala_request", default=None)
+
+#: When the line that is currently being handled was received
+_line_received = None
+
+#: Maps targets to the requests with unfired Deferreds, the oldest first
+_open = defaultdict(list)
+
+#: Functions called for every line sent in response to a request
+_observers = []
+
+
+class Request(object):
+    """A line from the server that triggered ``trigger`` in ``channel``."""
+    __slots__ = ("trigger", "channel", "received", "replied")
+
+    def __init__(self, trigger, channel, received=None):
+        self.trigger = trigger
+        self.channel = channel
+        self.received = received if received is not None else _now()
+        self.replied = False
+
+
+def add_observer(observer):
+    """Registers ``observer`` to be called with the trigger of a request, the
+    seconds between its receipt and the transmission of a line sent in
+    response to it, and whether that line was the first one."""
+    _observers.append(observer)
+
+
+def remove_observer(observer):
+    """Unregisters an observer registered with :func:`add_observer`."""
+    _observers.remove(observer)
+
+
+def line_received():
+    """Called by the bot before handling a line from the server."""
+    global _line_received
+    _line_received = _now()
+
+
+def line_handled():
+    """Called by the bot after handling a line from the server."""
+    global _line_received
+    _line_received = None
+
+
+def begin(trigger, channel):
+    """Returns a new :class:`Request` for the line that is currently being
+    handled.
+
+    :rtype: :class:`Request`
+    """
+    return Request(trigger, channel, _line_received)
+
+
+def activate(request):
+    """Makes ``request`` the current request.
+
+    :return: A token to pass to :func:`deactivate`
+    """
+    return _current.set(request)
+
+
+def deactivate(token):
+    """Restores the current request from before :func:`activate` returned
+    ``token``."""
+    _current.reset(token)
+
+
+def current():
+    """Returns the current :class:`Request`, if any."""
+    return _current.get()
+
+
+def track(request, d):
+    """Makes ``request`` the fallback for messages to its channel until ``d``
+    has fired."""
+    requests = _open[request.channel]
+    requests.append(request)
+
+    def fired(result):
+        requests.remove(request)
+        if not requests:
+            _open.pop(request.channel, None)
+        return result
+    d.addBoth(fired)
+
+
+def request_for(target):
+    """Returns the request a message to ``target`` is sent in response to,
+    if any."""
+    request = _current.get()
+    if request is not None:
+        return request
+    requests = _open.get(target)
+    if requests:
+        return requests[0]
+    return None
+
+
+def sent(request):
+    """Called by the bot when a line sent in response to ``request`` has been
+    written to the socket."""
+    first = not request.replied
+    request.replied = True
+    latency = _now() - request.received
+    for observer in list(_observers):
+        try:
+            observer(request.trigger, latency, first)
+        except Exception:
+            logging.exception("The latency observer %r failed", observer)
@@ -0,0 +1,245 @@
+"""Writes log records in a separate thread
+
+Writing to a log file blocks the calling thread until the operating system
+has the data, and the bot logs from the reactor thread. :func:`attach` puts a
+:class:`logging.handlers.QueueHandler` in front of handlers instead: the
+calling thread merely puts the records into a queue and a writer thread,
+started on the first call, passes them on to the handlers.
+
+The writer thread takes all records that are waiting at once and flushes the
+handlers once per batch. The handlers format the records there as well, only
+messages with arguments that might change until then, like lists, are merged
+in the calling thread. :class:`FileHandler` and
+:class:`TimedRotatingFileHandler` only flush their file then, instead of
+after every record like their counterparts in :mod:`logging`.
+
+The root logger's file and the chat log of the ``log`` plugin are written this
+way. :func:`flush` waits until the records queued so far have been written,
+:func:`detach` closes the handlers of one logger after that and :func:`stop`
+writes the rest and stops the thread when the bot exits.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+
+#: The most records passed on to the handlers before they are flushed
+BATCH_SIZE = 500
+
+_LISTENER = None
+
+#: Types of message arguments that are left for the writer thread to merge
+_IMMUTABLE = (str, int, float, bool, bytes, type(None))
+
+
+class _FlushPerBatch(object):
+    """Makes a :class:`logging.StreamHandler` leave flushing its stream to
+    the writer thread."""
+    _emitting = False
+
+    def emit(self, record):
+        self._emitting = True
+        try:
+            super(_FlushPerBatch, self).emit(record)
+        finally:
+            self._emitting = False
+
+    def flush(self):
+        if not self._emitting:
+            super(_FlushPerBatch, self).flush()
+
+
+class FileHandler(_FlushPerBatch, logging.FileHandler):
+    """A :class:`logging.FileHandler` for :func:`attach`."""
+
+
+class TimedRotatingFileHandler(_FlushPerBatch,
+                               logging.handlers.TimedRotatingFileHandler):
+    """A :class:`logging.handlers.TimedRotatingFileHandler` for
+    :func:`attach`."""
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records for ``handlers``. Once the writer thread has been
+    stopped, the records are written right away."""
+    def __init__(self, handlers):
+        logging.handlers.QueueHandler.__init__(self, None)
+        self.handlers = handlers
+
+    def prepare(self, record):
+        # Unlike QueueHandler.prepare, this neither formats nor copies the
+        # record, the handlers format it. Only arguments that might be
+        # changed until the writer thread gets to the record are merged.
+        args = record.args
+        if (type(record.msg) is not str or
+                args and (type(args) is not tuple or
+                          not all(type(arg) in _IMMUTABLE for arg in args))):
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record):
+        listener = _LISTENER
+        if listener is None:
+            _write([(self.handlers, record)])
+        else:
+            listener.queue.put_nowait((self.handlers, record))
+
+
+class _Close(object):
+    """Queued by :func:`detach`, the writer thread closes ``handlers`` once
+    the records before it have been written."""
+    def __init__(self, handlers):
+        self.handlers = handlers
+
+
+class _Listener(object):
+    """The writer thread, it passes every record to the handlers of the
+    :class:`_QueueHandler` that queued it. :func:`flush` queues an
+    :class:`threading.Event`, which is set once the records before it have
+    been written."""
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, name="lala-log",
+                                       daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stops the thread after it has written the records queued so
+        far."""
+        self.queue.put_nowait(None)
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not _write(batch):
+                return
+
+
+def _write(batch):
+    """Passes the records in ``batch`` to their handlers and flushes them.
+
+    :param list batch: (handlers, record) tuples, events queued by
+                       :func:`flush`, which are set afterwards, handlers to
+                       close queued by :func:`detach` and None, the sentinel
+                       :meth:`_Listener.stop` queues
+    :return: Whether the writer thread should keep running
+    """
+    used = []
+    events = []
+    closing = []
+    running = True
+    for item in batch:
+        if item is None:
+            running = False
+            continue
+        if isinstance(item, threading.Event):
+            events.append(item)
+            continue
+        if isinstance(item, _Close):
+            closing.extend(item.handlers)
+            continue
+        handlers, record = item
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+                if handler not in used:
+                    used.append(handler)
+    for handler in used:
+        handler.flush()
+    for handler in closing:
+        handler.close()
+    for event in events:
+        event.set()
+    return running
+
+
+def attach(logger, *handlers):
+    """Makes ``logger`` pass its records to ``handlers`` in the writer
+    thread.
+
+    :param logging.Logger logger:
+    :rtype: logging.Handler
+    :return: The handler added to ``logger``
+    """
+    start()
+    handler = _QueueHandler(handlers)
+    logger.addHandler(handler)
+    return handler
+
+
+def log_to_file(path, level=logging.INFO):
+    """Makes the root logger write to the file ``path`` right away, for tools
+    running parts of the bot. It has to be called before anything is logged,
+    :func:`logging.info` would add a handler writing to stderr otherwise.
+
+    :rtype: logging.Handler
+    :return: The added handler
+    """
+    handler = logging.FileHandler(path)
+    root = logging.getLogger("")
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
+
+
+def detach(logger, handler):
+    """Removes ``handler``, returned by :func:`attach`, from ``logger`` and
+    closes its handlers in the writer thread. Blocks until the records queued
+    before have been written and the handlers are closed.
+    """
+    logger.removeHandler(handler)
+    listener = _LISTENER
+    if listener is None:
+        _write([_Close(handler.handlers)])
+    else:
+        listener.queue.put_nowait(_Close(handler.handlers))
+        flush()
+
+
+def start():
+    """Starts the writer thread if it isn't running yet."""
+    global _LISTENER
+    if _LISTENER is not None:
+        return
+    _LISTENER = _Listener()
+    _LISTENER.start()
+    # Runs before logging's own handler, which closes the files
+    atexit.register(stop)
+
+
+def flush():
+    """Blocks until the records queued so far have been written."""
+    listener = _LISTENER
+    if listener is not None:
+        written = threading.Event()
+        listener.queue.put_nowait(written)
+        written.wait()
+
+
+def stop():
+    """Writes the queued records and stops the writer thread."""
+    global _LISTENER
+    listener = _LISTENER
+    if listener is None:
+        return
+    listener.stop()
+    _LISTENER = None
+    atexit.unregister(stop)
+    # Records queued while the thread was stopping
+    remaining = []
+    while True:
+        try:
+            remaining.append(listener.queue.get_nowait())
+        except queue.Empty:
+            break
+    _write(remaining)
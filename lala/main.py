@@ -1,7 +1,7 @@
 import logging
+import sys
 
-from lala import config
-from lala.factory import LalaFactory
+from lala import config, startup
 from twisted.application import service, internet
 from twisted.python import log
 from twisted.python.usage import Options
@@ -13,19 +13,107 @@ class LalaOptions(Options):
     ]
 
 
+def _install_reactor(name):
+    """Installs the reactor called ``name``, which is either ``default`` or
+    ``asyncio``.
+
+    This has to happen before anything imports
+    :mod:`twisted.internet.reactor`.
+    """
+    if name == "default":
+        return
+    if name != "asyncio":
+        raise ValueError("Unknown reactor %s" % name)
+
+    from twisted.internet import asyncioreactor
+    if "twisted.internet.reactor" in sys.modules:
+        from twisted.internet import reactor
+        if not isinstance(reactor, asyncioreactor.AsyncioSelectorReactor):
+            raise RuntimeError("Another reactor has already been installed, "
+                               "use twistd --reactor=asyncio")
+        return
+    asyncioreactor.install()
+
+
+class _Gate(service.MultiService):
+    """Starts the service ``client`` once ``ready`` has fired, but at most
+    ``timeout`` seconds after the gate has been started.
+
+    :param ready: A :class:`twisted.internet.defer.Deferred`
+    :param float timeout: 0 starts ``client`` right away
+    :param client: A :class:`twisted.application.service.Service`
+    """
+    def __init__(self, ready, timeout, client, reactor=None):
+        service.MultiService.__init__(self)
+        self.ready = ready
+        self.timeout = timeout
+        self.client = client
+        self.reactor = reactor
+        self._timeout_call = None
+        self._waiting = False
+
+    def startService(self):  # noqa: N802
+        service.MultiService.startService(self)
+        if self.timeout <= 0 or self.ready.called:
+            self._start_client()
+            return
+        from twisted.internet import reactor
+        self._waiting = True
+        startup.begin("wait")
+        self._timeout_call = (self.reactor or reactor).callLater(
+            self.timeout, self._timed_out)
+        self.ready.addBoth(self._ready)
+
+    def _ready(self, result):
+        if self._waiting:
+            self._timeout_call.cancel()
+            self._start_client()
+        return result
+
+    def _timed_out(self):
+        logging.warning("The plugins haven't been initialized after %s "
+                        "seconds, connecting anyway", self.timeout)
+        self._start_client()
+
+    def _start_client(self):
+        self._waiting = False
+        startup.end("wait")
+        if self.running and self.client.parent is None:
+            # Starts it, the gate is running
+            self.client.setServiceParent(self)
+
+    def stopService(self):  # noqa: N802
+        if self._waiting:
+            self._waiting = False
+            self._timeout_call.cancel()
+        return service.MultiService.stopService(self)
+
+
 def getService(options):  # noqa: N802
+    startup.start()
     observer = log.PythonLoggingObserver(loggerName="")
     observer.start()
 
     # Set up the config
-    config._initialize()
+    with startup.phase("config"):
+        config._initialize()
+
+    _install_reactor(config._get("base", "reactor"))
+    with startup.phase("modules"):
+        # This imports the reactor
+        from lala.factory import LalaFactory
+        from twisted.internet import reactor
+        import lala.capture
+        import lala.logqueue
+        import lala.memory
+        import lala.watchdog
 
     # Set the default logging level so we can already log messages
     logging.getLogger("").setLevel(logging.INFO)
 
     # Set up logging
-    handler = logging.FileHandler(filename=config._get("base", "log_file"),
-                                  encoding="utf-8")
+    handler = lala.logqueue.FileHandler(
+        filename=config._get("base", "log_file"), encoding="utf-8")
     if options["verbose"] or config._CFG.getboolean("base", "debug"):
         logging.getLogger("").setLevel(logging.DEBUG)
         handler.setFormatter(logging.Formatter(
@@ -33,14 +121,20 @@ def getService(options):  # noqa: N802
             " %(message)s"))
     else:
         handler.setFormatter(logging.Formatter("%(message)s"))
-    logging.getLogger("").addHandler(handler)
+    lala.logqueue.attach(logging.getLogger(""), handler)
 
+    lala.memory.start()
+    lala.capture.start()
+    startup.trace_resolver(reactor)
     f = LalaFactory(config._get("base", "channels"),
                     config._get("base", "nick"))
+    lala.watchdog.start()
 
-    return internet.TCPClient(config._get("base", "server"),
-                              int(config._get("base", "port")),
-                              f)
+    client = internet.TCPClient(config._get("base", "server"),
+                                int(config._get("base", "port")),
+                                f)
+    return _Gate(f.ready, float(config._get("base", "plugin_init_timeout")),
+                 client)
 
 
 def getApplication():  # noqa: N802
@@ -0,0 +1,268 @@
+"""Memory accounting per plugin
+
+While memory is tracked, :mod:`tracemalloc` records where every block of
+memory that is still allocated was allocated. A :class:`Measurement`
+attributes each block to the plugin owning the innermost frame of its
+traceback that belongs to a plugin, to ``lala`` if only the bot's own code is
+involved or to ``other``, and counts the objects tracked by the garbage
+collector by type. Comparing it to the measurement taken when tracking started
+and to the previous one shows which plugins and types keep growing.
+
+Tracking is started by the ``memory`` command of the base plugin or, if
+``memory_interval`` of the "base" section is set to a number of seconds, when
+the bot starts, in which case the growth is logged every ``memory_interval``
+seconds. ``memory_frames`` frames of every allocation are stored, allocations
+made by plugins more deeply nested in library code are attributed to
+``other``.
+
+Tracing slows down every allocation and a measurement blocks the reactor for
+a while if the bot uses a lot of memory. Plugins running in worker processes
+are not included.
+"""
+import gc
+import lala.config
+import lala.pluginmanager
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+
+from collections import Counter
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+#: The measurement taken when tracking started
+_BASELINE = None
+
+#: The most recent measurement
+_LAST = None
+
+#: Whether tracemalloc was started by :func:`start_tracking`
+_STARTED_TRACING = False
+
+_LOOP = None
+
+#: Whether Snapshot.traces keeps the raw traces in ``_traces``, as
+#: (domain, size, frames) tuples, which Python 3.9 appended the total number
+#: of frames to
+_RAW_TRACES = (platform.python_implementation() == "CPython" and
+               sys.version_info < (3, 14))
+
+
+class MemoryTrackingError(Exception):
+    """Raised when starting to track memory while it is already tracked or
+    when stopping or reporting while it is not."""
+
+
+class Measurement(object):
+    """The memory used by every plugin and the number of objects of every
+    type at one point in time."""
+    __slots__ = ("time", "plugins", "types")
+
+    def __init__(self, time, plugins, types):
+        self.time = time
+        #: Maps plugin names, ``lala`` and ``other`` to bytes
+        self.plugins = plugins
+        #: Maps type names to the number of objects
+        self.types = types
+
+
+def _owners():
+    """Returns a dict mapping the filenames of loaded modules to the plugin
+    or ``lala``."""
+    prefix = lala.pluginmanager.PLUGIN_PACKAGE + "."
+    owners = {}
+    for name, module in list(sys.modules.items()):
+        filename = getattr(module, "__file__", None)
+        if filename is None:
+            continue
+        if name.startswith(prefix):
+            owners[filename] = name[len(prefix):].split(".")[0]
+        elif name == "lala" or name.startswith("lala."):
+            owners[filename] = "lala"
+    return owners
+
+
+def _owner(frames, owners):
+    """Returns the owner of an allocation made in ``frames``, a tuple of
+    (filename, line) tuples sorted from the most recent to the oldest
+    frame."""
+    owner = "other"
+    for filename, _ in frames:
+        found = owners.get(filename)
+        if found is None:
+            continue
+        if found != "lala":
+            return found
+        owner = "lala"
+    return owner
+
+
+def _type_name(cls):
+    if cls.__module__ == "builtins":
+        return cls.__qualname__
+    return "%s.%s" % (cls.__module__, cls.__qualname__)
+
+
+def _traces(snapshot):
+    """Returns the traces of ``snapshot`` as (size, frames) tuples, the
+    frames being (filename, line) tuples sorted from the most recent to the
+    oldest frame.
+
+    Snapshot.statistics() creates objects for every trace, which takes
+    seconds on a large heap. The raw traces of the snapshot are used instead
+    on the CPython versions known to have them, see :data:`_RAW_TRACES`.
+    """
+    if _RAW_TRACES:
+        return ((trace[1], trace[2]) for trace in snapshot.traces._traces)
+    return [(statistic.size,
+             tuple((frame.filename, frame.lineno)
+                   for frame in reversed(statistic.traceback)))
+            for statistic in snapshot.statistics("traceback")]
+
+
+def measure():
+    """Takes a :class:`Measurement`. Memory has to be tracked.
+
+    :rtype: :class:`Measurement`
+    """
+    snapshot = tracemalloc.take_snapshot()
+    owners = _owners()
+    sizes = {}
+    tracebacks = {}
+    # Adding up the sizes one by one takes long as well, because every new
+    # int is traced. Instead, they're collected in a list per owner and added
+    # up by sum(), which doesn't create ints for the intermediate results.
+    for size, frames in _traces(snapshot):
+        owner = tracebacks.get(frames)
+        if owner is None:
+            owner = tracebacks[frames] = sizes.setdefault(
+                _owner(frames, owners), [])
+        owner.append(size)
+    plugins = Counter({owner: sum(sizes[owner]) for owner in sizes})
+    types = Counter(_type_name(type(obj)) for obj in gc.get_objects())
+    return Measurement(time.time(), plugins, types)
+
+
+def start_tracking(frames=None):
+    """Starts tracking memory and takes the baseline measurement.
+
+    :param int frames: The number of frames to store per allocation, defaults
+                       to ``memory_frames``
+    :raises MemoryTrackingError: If memory is already tracked
+    """
+    global _BASELINE, _LAST, _STARTED_TRACING
+    if _BASELINE is not None:
+        raise MemoryTrackingError("Memory is already tracked")
+    if frames is None:
+        frames = int(lala.config._get("base", "memory_frames"))
+    # PYTHONTRACEMALLOC may have started it already
+    _STARTED_TRACING = not tracemalloc.is_tracing()
+    if _STARTED_TRACING:
+        tracemalloc.start(frames)
+    logging.info("Tracking memory with %i frames per allocation",
+                 tracemalloc.get_traceback_limit())
+    _BASELINE = _LAST = measure()
+
+
+def stop_tracking():
+    """Stops tracking memory.
+
+    :raises MemoryTrackingError: If memory is not tracked
+    """
+    global _BASELINE, _LAST, _STARTED_TRACING
+    if _BASELINE is None:
+        raise MemoryTrackingError("Memory is not tracked")
+    if _STARTED_TRACING:
+        tracemalloc.stop()
+    _BASELINE = _LAST = None
+    _STARTED_TRACING = False
+    logging.info("Stopped tracking memory")
+
+
+def tracking():
+    """Returns whether memory is tracked.
+
+    :rtype: bool
+    """
+    return _BASELINE is not None
+
+
+def _format_size(size, sign=False):
+    for unit in ("B", "KiB", "MiB"):
+        if abs(size) < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = "GiB"
+    if unit == "B":
+        return "%+i B" % size if sign else "%i B" % size
+    return ("%+.1f %s" if sign else "%.1f %s") % (size, unit)
+
+
+def report(count):
+    """Takes a measurement and describes the ``count`` plugins and types that
+    have grown the most since tracking started.
+
+    :rtype: list
+    :return: One line per plugin or type
+    :raises MemoryTrackingError: If memory is not tracked
+    """
+    global _LAST
+    if _BASELINE is None:
+        raise MemoryTrackingError("Memory is not tracked")
+    previous = _LAST
+    current = _LAST = measure()
+    lines = ["%i minutes since tracking started, %s traced" % (
+        (current.time - _BASELINE.time) // 60,
+        _format_size(sum(current.plugins.values())))]
+
+    def top(attribute):
+        now = getattr(current, attribute)
+        start = getattr(_BASELINE, attribute)
+        growth = Counter(now)
+        growth.subtract(start)
+        return [(key, now[key], delta, now[key] -
+                 getattr(previous, attribute)[key])
+                for key, delta in growth.most_common(count)]
+
+    for plugin, size, since_start, since_last in top("plugins"):
+        lines.append("%s: %s (%s since start, %s since the last report)" % (
+            plugin, _format_size(size), _format_size(since_start, True),
+            _format_size(since_last, True)))
+    for name, objects, since_start, since_last in top("types"):
+        lines.append("%s: %i objects (%+i since start, %+i since the last "
+                     "report)" % (name, objects, since_start, since_last))
+    return lines
+
+
+def plugin_statistics():
+    """Returns a dict mapping plugin names, ``lala`` and ``other`` to the
+    bytes they had allocated when the most recent measurement was taken, or
+    an empty dict if memory is not tracked."""
+    if _LAST is None:
+        return {}
+    return dict(_LAST.plugins)
+
+
+def _log_report():
+    if _BASELINE is None:
+        return
+    count = int(lala.config._get("base", "memory_top"))
+    logging.info("Memory growth:\n%s", "\n".join(report(count)))
+
+
+def start():
+    """Starts tracking memory and logging its growth every
+    ``memory_interval`` seconds if it is set. Called before the plugins are
+    loaded so their allocations are included."""
+    global _LOOP
+    interval = float(lala.config._get("base", "memory_interval"))
+    if interval <= 0 or _LOOP is not None:
+        return
+    if _BASELINE is None:
+        start_tracking()
+    _LOOP = LoopingCall(_log_report)
+    _LOOP.start(interval, now=False)
+    reactor.addSystemEventTrigger("before", "shutdown", _LOOP.stop)
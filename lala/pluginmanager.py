@@ -1,33 +1,137 @@
-import imp
+import importlib
+import importlib.util
+import json
 import logging
 import lala.config
+import lala.latency
+import lala.ratelimit
+import lala.startup
+import lala.threadpool
 import lala.util
+import lala.workers
+import os
+import re
+import sys
+import time
 
+from collections import Counter
 from functools import partial
-from twisted.internet.defer import Deferred
+from inspect import iscoroutine
+from itertools import count
+from twisted.internet import defer, reactor
+from twisted.internet.defer import (Deferred, DeferredList,
+                                    DeferredSemaphore, fail, gatherResults,
+                                    maybeDeferred)
+from twisted.python.failure import Failure
 from types import GeneratorType
 
 
 __all__ = ("disable", "enable", "is_admin", "PluginFunc", "load_plugin")
 
 DEFAULT_OPTIONS_VARIABLE = "DEFAULT_OPTIONS"
+DEPENDENCIES_VARIABLE = "DEPENDENCIES"
+LAZY_VARIABLE = "LAZY"
 MODULE_INIT_FUNC = "init"
+MODULE_TEARDOWN_FUNC = "teardown"
+PLUGIN_PACKAGE = "lala.plugins"
 
 _callbacks = {}
 _join_callbacks = list()
 _regexes = {}
 _cbprefix = "!"
 
+#: Names of plugins whose triggers have been registered from the manifest but
+#: whose module has not been imported yet
+_lazy_plugins = set()
+
+#: Maps the names of lazily loaded plugins whose init function is running to
+#: the Deferreds of the calls waiting for it, see :func:`_import_lazy_plugin`
+_lazy_inits = {}
+
+#: While plugins are being (re)loaded, their registrations are collected in
+#: these tables instead of the live ones, see :func:`_staged`
+_staging = None
+
+#: Maps job ids to the :class:`_Job` objects of all Deferreds returned by
+#: commands and regexes that have not fired yet
+_jobs = {}
+_job_ids = count(1)
+
+#: Counts how often each command or regex has timed out
+_timeouts = Counter()
+
+#: Functions called after every call of a command, regex or join callback,
+#: see :func:`add_dispatch_observer`
+_dispatch_observers = []
+
+#: The kind, plugin and trigger of the callback that is currently being
+#: called, if any. Read by :mod:`lala.watchdog` from another thread.
+_dispatching = None
+
+
+class _Tables(object):
+    """A set of empty dispatch tables."""
+    def __init__(self):
+        self.callbacks = {}
+        self.regexes = {}
+        self.join_callbacks = []
+
+
+#: The options of a :class:`PluginFunc` that are stored in the manifest
+_DESCRIBED_OPTIONS = ("threaded", "max_concurrency", "max_queue", "timeout",
+                      "rate_limit")
+
 
 class PluginFunc(object):
-    def __init__(self, func, enabled=True, admin_only=False, aliases=None):
+    def __init__(self, func, enabled=True, admin_only=False, aliases=None,
+                 plugin=None, threaded=False, max_concurrency=None,
+                 max_queue=0, timeout=None, rate_limit=None, trigger=None):
         self.enabled = enabled
         self.func = func
         self.admin_only = admin_only
         self.aliases = aliases or []
+        self.plugin = plugin if plugin is not None else _plugin_name(func)
+        self.threaded = threaded
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        #: The name of the command, which its aliases share, None for regexes
+        self.trigger = trigger
+        if max_concurrency is not None:
+            self.semaphore = DeferredSemaphore(max_concurrency)
+        else:
+            self.semaphore = None
 
+    def options(self):
+        """Returns the options of this function that are stored in the
+        manifest."""
+        return {option: getattr(self, option)
+                for option in _DESCRIBED_OPTIONS}
 
-def _make_pluginfunc(func, cmd=None, admin_only=False, aliases=None):
+
+def _plugin_name(func):
+    """Returns the name of the plugin in which ``func`` has been defined."""
+    module = getattr(func, "__module__", None) or ""
+    return module.rpartition(".")[2]
+
+
+def _join_callback_plugin(cb):
+    """Returns the name of the plugin that registered the join callback
+    ``cb``."""
+    return getattr(cb, "_lala_plugin", None) or _plugin_name(cb)
+
+
+def _tables():
+    """Returns the callback, regex and join callback tables registrations
+    currently go to."""
+    if _staging is not None:
+        return _staging.callbacks, _staging.regexes, _staging.join_callbacks
+    return _callbacks, _regexes, _join_callbacks
+
+
+def _make_pluginfunc(func, cmd=None, admin_only=False, aliases=None,
+                     **options):
     if aliases is not None:
         triggers = [cmd]
         triggers.extend(aliases)
@@ -38,7 +142,8 @@ def _make_pluginfunc(func, cmd=None, admin_only=False, aliases=None):
         else:
             func.__doc__ += "\n"
             func.__doc__ += extradoc
-    return PluginFunc(func, admin_only=admin_only, aliases=aliases)
+    return PluginFunc(func, admin_only=admin_only, aliases=aliases,
+                      trigger=cmd, **options)
 
 
 def is_admin(user):
@@ -59,42 +164,502 @@ def is_admin(user):
 
 
 def load_plugin(name):
-    logging.debug("Trying to load %s" % name)
+    """Imports the plugin ``name`` and calls its init function.
+
+    :return: What the init function returned, which may be a
+             :class:`twisted.internet.defer.Deferred`
+    """
+    return _init_plugin(name, _import_plugin(name))
+
+
+def _import_plugin(name, fresh=False):
+    """Imports the plugin ``name`` and sets its default options.
+
+    :param bool fresh: Whether to import a new copy of the module without
+                       replacing the one in :data:`sys.modules`, see
+                       :func:`_replace_module`
+    :return: The module of the plugin
+    """
+    logging.debug("Trying to load %s", name)
     if not lala.config._CFG.has_section(name):
         lala.config._CFG.add_section(name)
-    modname = "lala/plugins/%s" % name
-    (f, p, d) = imp.find_module(modname)
-    mod = imp.load_module(modname, f, p, d)
+    modname = "%s.%s" % (PLUGIN_PACKAGE, name)
+    with lala.startup.phase("import", name):
+        if fresh:
+            spec = importlib.util.find_spec(modname)
+            if spec is None:
+                raise ImportError("No plugin named %s" % name, name=modname)
+            mod = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(mod)
+        elif modname in sys.modules:
+            # Loading an already imported plugin means reloading it
+            mod = importlib.reload(sys.modules[modname])
+        else:
+            mod = importlib.import_module(modname)
     if hasattr(mod, DEFAULT_OPTIONS_VARIABLE):
         lala.config._set_default_options(name,
                                          getattr(mod, DEFAULT_OPTIONS_VARIABLE))
-    if hasattr(mod, MODULE_INIT_FUNC):
-        initf = getattr(mod, MODULE_INIT_FUNC)
-        if callable(initf):
-            initf()
-        else:
-            raise TypeError("module init function is not callable")
+    if not callable(getattr(mod, MODULE_INIT_FUNC, _init_plugin)):
+        raise TypeError("module init function is not callable")
+    return mod
+
+
+def _replace_module(name, mod):
+    """Makes ``mod`` the module of the plugin ``name``. None removes it."""
+    modname = "%s.%s" % (PLUGIN_PACKAGE, name)
+    package = sys.modules[PLUGIN_PACKAGE]
+    if mod is None:
+        sys.modules.pop(modname, None)
+        if hasattr(package, name):
+            delattr(package, name)
+    else:
+        sys.modules[modname] = mod
+        setattr(package, name, mod)
+
+
+def _init_plugin(name, mod):
+    initf = getattr(mod, MODULE_INIT_FUNC, None)
+    if initf is None:
+        return None
+    return lala.startup.timed("init", name, initf)
+
+
+def _dependencies(mod):
+    """Returns the names of the plugins the plugin ``mod`` depends on."""
+    return tuple(getattr(mod, DEPENDENCIES_VARIABLE, ()))
+
+
+def _check_dependencies(modules):
+    """Makes sure the dependencies of ``modules``, a dict mapping the names of
+    plugins to their modules, are among them and don't form a cycle.
+
+    :raises ValueError: If they aren't or do
+    """
+    done = set()
+
+    def visit(name, path):
+        if name in done:
+            return
+        if name in path:
+            raise ValueError("The plugins %s depend on each other" %
+                             " -> ".join(path[path.index(name):] + [name]))
+        for dependency in _dependencies(modules[name]):
+            if dependency not in modules:
+                raise ValueError("%s depends on %s, which is not enabled or "
+                                 "runs in worker processes"
+                                 % (name, dependency))
+            visit(dependency, path + [name])
+        done.add(name)
+
+    for name in modules:
+        visit(name, [])
+
+
+def _init_plugins(modules):
+    """Calls the init functions of ``modules``, a dict mapping the names of
+    plugins to their modules.
+
+    The init function of a plugin is called as soon as those of the plugins
+    in its ``DEPENDENCIES`` have finished, so init functions returning
+    Deferreds run concurrently unless one depends on the other. Plugins
+    without dependencies are initialized right away. If initializing a plugin
+    fails, the plugins depending on it are not initialized.
+
+    :raises ValueError: See :func:`_check_dependencies`
+    :rtype: :class:`twisted.internet.defer.Deferred` firing with the names of
+            the plugins that have been initialized once all init functions
+            have finished
+    """
+    _check_dependencies(modules)
+    inits = {}
+
+    def failed(name, failure):
+        logging.error("Initializing %s failed:\n%s", name,
+                      failure.getTraceback())
+        return False
+
+    def init(name):
+        if name in inits:
+            return inits[name]
+        dependencies = _dependencies(modules[name])
 
+        def call(initialized):
+            missing = [dependency for dependency, ok
+                       in zip(dependencies, initialized) if not ok]
+            if missing:
+                logging.error("Not initializing %s because initializing %s "
+                              "failed", name, ", ".join(missing))
+                return False
+            d = maybeDeferred(_init_plugin, name, modules[name])
+            return d.addCallbacks(lambda _: True, partial(failed, name))
 
-def register_callback(trigger, func, admin_only=False, aliases=None):
-    """ Adds ``func`` to the callbacks for ``trigger``."""
-    logging.debug("Registering callback for %s" % trigger)
-    f = _make_pluginfunc(func, trigger, admin_only, aliases)
+        d = gatherResults([init(dependency) for dependency in dependencies])
+        inits[name] = d.addCallback(call)
+        return inits[name]
+
+    names = list(modules)
+    d = gatherResults([init(name) for name in names])
+    return d.addCallback(lambda initialized: [
+        name for name, ok in zip(names, initialized) if ok])
+
+
+def register_callback(trigger, func, admin_only=False, aliases=None,
+                      **options):
+    """ Adds ``func`` to the callbacks for ``trigger``.
+
+    ``options`` are passed on to :class:`PluginFunc`."""
+    logging.debug("Registering callback for %s", trigger)
+    callbacks = _tables()[0]
+    f = _make_pluginfunc(func, trigger, admin_only, aliases, **options)
     if aliases is not None:
         for alias in aliases:
-            _callbacks[alias] = f
-    _callbacks[trigger] = f
+            callbacks[alias] = f
+    callbacks[trigger] = f
 
 
 def register_join_callback(func):
     """ Registers ``func`` as a callback for join events."""
-    _join_callbacks.append(func)
+    _tables()[2].append(func)
 
 
-def register_regex(regex, func):
+def register_regex(regex, func, **options):
     """ Registers ``func`` as a callback for every message that matches
-    ``regex``."""
-    _regexes[regex] = _make_pluginfunc(func)
+    ``regex``.
+
+    ``options`` are passed on to :class:`PluginFunc`."""
+    _tables()[1][regex] = _make_pluginfunc(func, **options)
+
+
+def _plugin_source(name):
+    """Returns the path of the file containing the plugin ``name`` without
+    importing it."""
+    spec = importlib.util.find_spec("%s.%s" % (PLUGIN_PACKAGE, name))
+    if spec is None or spec.origin is None:
+        raise ImportError("No plugin named %s" % name)
+    return spec.origin
+
+
+def _describe_plugin(name):
+    """Returns a manifest entry describing everything the already loaded
+    plugin ``name`` registered."""
+    source = _plugin_source(name)
+    stat = os.stat(source)
+    mod = sys.modules.get("%s.%s" % (PLUGIN_PACKAGE, name))
+    callbacks, regexes, join_callbacks = _tables()
+    commands = []
+    for trigger, func in callbacks.items():
+        if func.plugin == name and trigger not in func.aliases:
+            commands.append({"trigger": trigger,
+                             "aliases": func.aliases,
+                             "admin_only": func.admin_only,
+                             "doc": func.func.__doc__,
+                             "options": func.options()})
+    return {"source": source,
+            "mtime": stat.st_mtime,
+            "size": stat.st_size,
+            "dependencies": list(_dependencies(mod)),
+            "lazy": bool(getattr(mod, LAZY_VARIABLE, True)),
+            "commands": commands,
+            "regexes": [{"pattern": regex.pattern,
+                         "flags": regex.flags,
+                         "options": func.options()}
+                        for regex, func in regexes.items()
+                        if func.plugin == name],
+            "join_callbacks": [cb.__name__ for cb in join_callbacks
+                               if _plugin_name(cb) == name]}
+
+
+def _manifest_entry_is_fresh(name, entry):
+    """Checks whether the manifest ``entry`` still describes the source file
+    of the plugin ``name``."""
+    try:
+        source = _plugin_source(name)
+        stat = os.stat(source)
+    except (ImportError, OSError):
+        return False
+    return (entry.get("source") == source and
+            entry.get("mtime") == stat.st_mtime and
+            entry.get("size") == stat.st_size)
+
+
+def _manifest_path():
+    return os.path.expanduser(lala.config._get("base", "plugin_manifest"))
+
+
+def _load_manifest():
+    path = _manifest_path()
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError) as exc:
+        logging.info("Not using the plugin manifest %s: %s", path, exc)
+        return {}
+
+
+def _save_manifest(manifest):
+    path = _manifest_path()
+    try:
+        with open(path, "w") as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True)
+    except OSError as exc:
+        logging.warning("Unable to write the plugin manifest %s: %s",
+                        path, exc)
+
+
+def _import_lazy_plugin(name):
+    """Replaces the placeholders registered for the lazy plugin ``name`` by
+    importing it.
+
+    :return: None if the plugin has been initialized already, otherwise a
+             :class:`twisted.internet.defer.Deferred` firing once its init
+             function has finished
+    """
+    if name in _lazy_inits:
+        waiting = Deferred()
+        _lazy_inits[name].append(waiting)
+        return waiting
+    if name not in _lazy_plugins:
+        return None
+    logging.info("Importing lazily loaded plugin %s", name)
+    _lazy_plugins.discard(name)
+    waiters = _lazy_inits[name] = []
+    try:
+        staging, result = _collect(partial(load_plugin, name))
+    except Exception:
+        result = Failure()
+
+    def initialized(result):
+        del _lazy_inits[name]
+        if isinstance(result, Failure):
+            logging.error("Initializing %s failed:\n%s", name,
+                          result.getTraceback())
+            # The placeholders are still registered, the next call tries
+            # again
+            _lazy_plugins.add(name)
+        else:
+            # Until now, the placeholders made the calls wait for the init
+            # function
+            _install(staging, [name])
+        for waiting in waiters:
+            if isinstance(result, Failure):
+                waiting.errback(result)
+            else:
+                waiting.callback(result)
+
+    # Calls waiting for the init function continue in the order they came in
+    first = Deferred()
+    waiters.append(first)
+    maybeDeferred(lambda: result).addBoth(initialized)
+    return first
+
+
+def _resolve(plugin, kind, key):
+    """Finds what ``plugin`` registered for ``key`` after it has been
+    imported: the :class:`PluginFunc` of a command or regex or the join
+    callback."""
+    if kind == "command":
+        func = _callbacks.get(key)
+        if func is not None and func.plugin == plugin:
+            return func
+    elif kind == "regex":
+        for regex, func in list(_regexes.items()):
+            if func.plugin == plugin and regex.pattern == key:
+                return func
+    else:
+        for cb in _join_callbacks:
+            if _plugin_name(cb) == plugin and cb.__name__ == key:
+                return cb
+    return None
+
+
+def _chainable(user, channel, ret):
+    """Makes the return value ``ret`` of a callback called in a callback of a
+    Deferred chainable to it. Coroutines are wrapped in Deferreds and the
+    Deferreds of generators get errbacks."""
+    if isinstance(ret, GeneratorType):
+        return _auto_add_errback(user, channel, ret)
+    if iscoroutine(ret):
+        return defer.ensureDeferred(ret)
+    return ret
+
+
+def _make_lazy_func(plugin, kind, key, doc=None):
+    def call(args):
+        func = _resolve(plugin, kind, key)
+        if func is None:
+            logging.warning("%s no longer provides the %s %s", plugin,
+                            kind, key)
+            return None
+        if kind == "join":
+            return func(*args)
+        # Runs it in the thread pool if it's threaded
+        return _call(func, *args)
+
+    def lazy(*args):
+        initialized = _import_lazy_plugin(plugin)
+        if initialized is None:
+            return call(args)
+        # The arguments start with the user and the channel for all kinds
+        d = initialized.addCallback(
+            lambda _: _chainable(args[0], args[1], call(args)))
+        if kind == "join":
+            # Nothing else handles the failures of join callbacks
+            d.addErrback(lambda failure: logging.error(
+                "A join callback failed:\n%s", failure.getTraceback()))
+        return d
+    lazy.__doc__ = doc
+    lazy.__name__ = str(key)
+    return lazy
+
+
+def _register_described(name, entry, make_func, ignored_options=()):
+    """Registers placeholders for all callbacks described by the manifest
+    ``entry`` of the plugin ``name``.
+
+    :param make_func: Called with the kind of callback (``command``, ``regex``
+                      or ``join``), its trigger, pattern or name and its
+                      docstring. Returns the function to register for it.
+    :param ignored_options: Names of options from the manifest that should not
+                            be applied to the placeholders
+    """
+    def options(described):
+        return {option: value
+                for option, value in described.get("options", {}).items()
+                if option not in ignored_options}
+
+    if not lala.config._CFG.has_section(name):
+        lala.config._CFG.add_section(name)
+    callbacks, regexes, join_callbacks = _tables()
+    for command in entry["commands"]:
+        trigger = command["trigger"]
+        func = PluginFunc(make_func("command", trigger, command["doc"]),
+                          admin_only=command["admin_only"],
+                          aliases=command["aliases"],
+                          plugin=name,
+                          trigger=trigger,
+                          **options(command))
+        for alias in func.aliases:
+            callbacks[alias] = func
+        callbacks[trigger] = func
+    for regex in entry["regexes"]:
+        pattern = regex["pattern"]
+        regexes[re.compile(pattern, regex["flags"])] = PluginFunc(
+            make_func("regex", pattern, None), plugin=name, **options(regex))
+    for cb_name in entry["join_callbacks"]:
+        cb = make_func("join", cb_name, None)
+        cb._lala_plugin = name
+        join_callbacks.append(cb)
+
+
+def _register_lazy(name, entry):
+    """Registers placeholders for all callbacks described by the manifest
+    ``entry`` of the plugin ``name``. The plugin itself is imported as soon
+    as one of them is called."""
+    logging.debug("Registering %s from the plugin manifest", name)
+    _lazy_plugins.add(name)
+    # The plugin is imported and initialized on the reactor thread, the
+    # placeholders hand off to the thread pool after that
+    _register_described(name, entry, partial(_make_lazy_func, name),
+                        ignored_options=("threaded",))
+
+
+def _staged(load, plugins=None):
+    """Calls ``load`` with registrations going to fresh tables and then
+    replaces the registrations of ``plugins`` (of all plugins if it's None) in
+    the live tables with them.
+
+    The live tables are never modified, they're replaced as a whole, so no
+    message is ever dispatched against partially filled tables. If ``load``
+    raises an exception, the live tables are left alone.
+
+    :return: What ``load`` returned
+    """
+    staging, result = _collect(load)
+    _install(staging, plugins)
+    return result
+
+
+def _collect(load, staging=None):
+    """Calls ``load`` with registrations going to fresh tables.
+
+    :param _Tables staging: The tables to use instead of fresh ones
+    :return: The tables and what ``load`` returned
+    :rtype: tuple
+    """
+    global _staging
+    if staging is None:
+        staging = _Tables()
+    _staging = staging
+    try:
+        result = load()
+    finally:
+        _staging = None
+    return staging, result
+
+
+def _install(staging, plugins=None):
+    """Replaces the registrations of ``plugins`` (of all plugins if it's
+    None) in the live tables with those in the tables ``staging``."""
+    global _callbacks, _regexes, _join_callbacks
+    if plugins is None:
+        callbacks, regexes, join_callbacks = {}, {}, []
+    else:
+        callbacks = {trigger: func for trigger, func in _callbacks.items()
+                     if func.plugin not in plugins}
+        regexes = {regex: func for regex, func in _regexes.items()
+                   if func.plugin not in plugins}
+        join_callbacks = [cb for cb in _join_callbacks
+                          if _join_callback_plugin(cb) not in plugins]
+    for trigger, func in staging.callbacks.items():
+        _keep_semaphore(_callbacks.get(trigger), func)
+    callbacks.update(staging.callbacks)
+    regexes.update(staging.regexes)
+    join_callbacks.extend(staging.join_callbacks)
+    _callbacks, _regexes, _join_callbacks = callbacks, regexes, join_callbacks
+
+
+def _keep_semaphore(old, new):
+    """Makes the :class:`PluginFunc` ``new`` share the semaphore of ``old``,
+    which it replaces, if both have the same ``max_concurrency``. The calls
+    running or waiting for the semaphore keep counting against the limit."""
+    if (old is not None and old.semaphore is not None and
+            new.max_concurrency == old.max_concurrency):
+        new.semaphore = old.semaphore
+
+
+def _teardown(name):
+    """Calls the teardown function of the plugin ``name`` if it has been
+    imported and has one, so it can release its resources before being
+    loaded again.
+
+    :rtype: The return value of the teardown function, which may be a
+            :class:`twisted.internet.defer.Deferred`
+    """
+    if name in _get_worker_plugins():
+        return lala.workers.stop()
+    mod = sys.modules.get("%s.%s" % (PLUGIN_PACKAGE, name))
+    if mod is None or name in _lazy_plugins:
+        return None
+    teardownf = getattr(mod, MODULE_TEARDOWN_FUNC, None)
+    if teardownf is None:
+        return None
+    logging.debug("Tearing down %s", name)
+    return teardownf()
+
+
+class _Job(object):
+    """A Deferred returned by a command or regex that has not fired yet."""
+    def __init__(self, trigger, user, channel, deferred):
+        self.id = next(_job_ids)
+        self.trigger = trigger
+        self.user = user
+        self.channel = channel
+        self.deferred = deferred
+        self.started = time.time()
+
+    def age(self):
+        """Returns the number of seconds since this job was started."""
+        return time.time() - self.started
 
 
 def _generic_errback(user, channel, failure):
@@ -104,15 +669,242 @@ def _generic_errback(user, channel, failure):
     return failure
 
 
-def _auto_add_errback(user, channel, d):
+def _cancelled_errback(user, channel, trigger, failure):
+    if failure.check(defer.TimeoutError):
+        logging.warning("%s timed out", trigger)
+        _timeouts[trigger] += 1
+        lala.util.msg(channel, "%s: sorry, %s took too long and has been "
+                      "cancelled" % (user, trigger))
+    elif failure.check(defer.CancelledError):
+        lala.util.msg(channel, "%s: %s has been cancelled" % (user, trigger))
+    else:
+        return failure
+
+
+def _get_timeout(func):
+    if func is not None and func.timeout is not None:
+        return func.timeout
+    return float(lala.config._get("base", "command_timeout"))
+
+
+def _track(user, channel, func, trigger, d):
+    """Registers ``d`` as a job and cancels it once the timeout of the
+    :class:`PluginFunc` ``func`` has passed."""
+    job = _Job(trigger, user, channel, d)
+    _jobs[job.id] = job
+    request = lala.latency.current()
+    if request is not None:
+        lala.latency.track(request, d)
+
+    def finished(result):
+        del _jobs[job.id]
+        return result
+
+    d.addBoth(finished)
+    # Deferreds that have already fired, like those of succeed(), don't need
+    # a timeout scheduled and cancelled right away
+    timeout = 0 if d.called else _get_timeout(func)
+    if timeout > 0:
+        d.addTimeout(timeout, reactor)
+    d.addErrback(partial(_cancelled_errback, user, channel, trigger))
+
+
+def _auto_add_errback(user, channel, d, func=None, trigger=None):
+    """Adds an errback to ``d`` if it's a Deferred or a coroutine or to all
+    Deferreds it generates if it's a generator.
+
+    If ``trigger`` is given, the Deferreds are registered as jobs and
+    cancelled after the timeout of ``func``.
+
+    :return: ``d``, a Deferred wrapping it if it's a coroutine or, if it's a
+             generator, a :class:`twisted.internet.defer.DeferredList` of the
+             generated Deferreds
+    """
     cb = partial(_generic_errback,
                  user,
                  channel)
+    if iscoroutine(d):
+        d = defer.ensureDeferred(d)
     if isinstance(d, GeneratorType):
+        deferreds = []
         for deferred in d:
+            if trigger is not None:
+                _track(user, channel, func, trigger, deferred)
             deferred.addErrback(cb)
+            deferreds.append(deferred)
+        return DeferredList(deferreds)
     elif isinstance(d, Deferred):
+        if trigger is not None:
+            _track(user, channel, func, trigger, d)
         d.addErrback(cb)
+    return d
+
+
+def jobs():
+    """Returns the :class:`_Job` objects of all Deferreds returned by commands
+    and regexes that have not fired yet, the oldest first."""
+    return sorted(_jobs.values(), key=lambda job: job.id)
+
+
+def cancel_job(job_id):
+    """Cancels the job with the id ``job_id``.
+
+    :rtype: bool
+    :return: Whether a job with that id was running
+    """
+    job = _jobs.get(job_id)
+    if job is None:
+        return False
+    job.deferred.cancel()
+    return True
+
+
+def timeout_statistics():
+    """Returns a dict mapping commands and regexes to the number of times they
+    have timed out."""
+    return dict(_timeouts)
+
+
+def _call(func, *args):
+    """Calls the :class:`PluginFunc` ``func`` with ``args``.
+
+    If ``func`` has been registered with ``threaded=True``, it's called in the
+    plugin thread pool and a :class:`twisted.internet.defer.Deferred` firing
+    with its return value is returned instead."""
+    if func.threaded:
+        return lala.threadpool.run_in_thread(func.func, *args)
+    return func.func(*args)
+
+
+def add_dispatch_observer(observer):
+    """Registers ``observer`` to be called after every call of a command,
+    regex or join callback with
+
+    - the kind of callback: ``command``, ``regex`` or ``join``
+    - the name of its plugin
+    - its trigger, pattern or function name
+    - the seconds the call took
+    - the seconds until all Deferreds the callback returned fired, which is
+      the same as the previous value if it didn't return any
+    - whether it raised an exception or one of its Deferreds failed
+
+    Observers are only called from the reactor thread and should be fast.
+    """
+    _dispatch_observers.append(observer)
+
+
+def remove_dispatch_observer(observer):
+    """Unregisters an observer registered with
+    :func:`add_dispatch_observer`."""
+    _dispatch_observers.remove(observer)
+
+
+def _notify(kind, plugin, trigger, sync, total, failed):
+    for observer in list(_dispatch_observers):
+        try:
+            observer(kind, plugin, trigger, sync, total, failed)
+        except Exception:
+            logging.exception("The dispatch observer %r failed", observer)
+
+
+def _failed(result):
+    if isinstance(result, Failure):
+        return True
+    # The result of the DeferredList of a generator
+    return (isinstance(result, list) and
+            any(not success for success, _ in result))
+
+
+def _observed(kind, plugin, trigger, f, *args):
+    """Calls ``f`` with ``args`` and returns its result. If there are dispatch
+    observers, they are told about the call, see
+    :func:`add_dispatch_observer`."""
+    global _dispatching
+    _dispatching = (kind, plugin, trigger)
+    try:
+        return _call_observed(kind, plugin, trigger, f, *args)
+    finally:
+        _dispatching = None
+
+
+def _call_observed(kind, plugin, trigger, f, *args):
+    if not _dispatch_observers:
+        return f(*args)
+    start = time.perf_counter()
+    try:
+        ret = f(*args)
+    except Exception:
+        duration = time.perf_counter() - start
+        _notify(kind, plugin, trigger, duration, duration, True)
+        raise
+    sync = time.perf_counter() - start
+    if isinstance(ret, Deferred):
+        def fired(result):
+            _notify(kind, plugin, trigger, sync, time.perf_counter() - start,
+                    _failed(result))
+            return result
+        ret.addBoth(fired)
+    else:
+        _notify(kind, plugin, trigger, sync, sync, False)
+    return ret
+
+
+def _dispatch(kind, func, trigger, user, channel, *args, request=None):
+    """Calls the :class:`PluginFunc` ``func`` with :func:`_call`, adds the
+    errbacks to its result and tells the dispatch observers about it.
+
+    :param request: The :class:`lala.latency.Request` to make the current one
+                    during the call
+    """
+    def call():
+        ret = _call(func, user, channel, *args)
+        return _auto_add_errback(user, channel, ret, func, trigger)
+    if request is None:
+        return _observed(kind, func.plugin, trigger, call)
+    token = lala.latency.activate(request)
+    try:
+        return _observed(kind, func.plugin, trigger, call)
+    finally:
+        lala.latency.deactivate(token)
+
+
+def _call_limited(func, trigger, user, channel, *args, request=None):
+    """Calls the :class:`PluginFunc` ``func`` like :func:`_dispatch`, but only
+    once a token of its semaphore is available. The token is held until all
+    Deferreds ``func`` returned have fired."""
+    def call():
+        try:
+            return _dispatch("command", func, trigger, user, channel, *args,
+                             request=request)
+        except Exception:
+            return _auto_add_errback(user, channel, fail())
+    return func.semaphore.run(call)
+
+
+def _queue_is_full(func):
+    """Checks whether another call of the :class:`PluginFunc` ``func`` would
+    exceed its ``max_queue``."""
+    semaphore = func.semaphore
+    return semaphore.tokens == 0 and len(semaphore.waiting) >= func.max_queue
+
+
+def concurrency_statistics():
+    """Returns a dict mapping the commands registered with
+    ``max_concurrency`` to dicts with the following keys:
+
+    - ``limit``: the maximum number of concurrent calls
+    - ``in_flight``: the number of calls currently running
+    - ``queued``: the number of calls waiting to be run
+    """
+    stats = {}
+    for trigger, func in _callbacks.items():
+        if func.semaphore is None or trigger in func.aliases:
+            continue
+        semaphore = func.semaphore
+        stats[trigger] = {"limit": semaphore.limit,
+                          "in_flight": semaphore.limit - semaphore.tokens,
+                          "queued": len(semaphore.waiting)}
+    return stats
 
 
 def _handle_message(user, channel, message):
@@ -126,41 +918,58 @@ def _handle_message(user, channel, message):
                         not func.admin_only):
                     stripped_message = message[len(_cbprefix) +
                                                len(command) + 1:]
-                    ret = _callbacks[command].func(
-                        user,
-                        channel,
-                        stripped_message)
-                    _auto_add_errback(user, channel, ret)
+                    if not lala.ratelimit.allow(user, channel, command, func):
+                        return
+                    request = lala.latency.begin(command, channel)
+                    if func.semaphore is None:
+                        _dispatch("command", func, command, user, channel,
+                                  stripped_message, request=request)
+                    elif _queue_is_full(func):
+                        lala.util.msg(channel,
+                                      "Sorry %s, too many people are using "
+                                      "%s right now, please try again later"
+                                      % (user, command))
+                    else:
+                        _call_limited(func, command, user, channel,
+                                      stripped_message, request=request)
                 else:
                     lala.util.msg(channel,
                                   "Sorry %s, you're not allowed to do that"
                                   % user)
             else:
                 lala.util.msg(channel, "%s is not enabled" % command)
-                logging.info("%s is not enabled" % command)
+                logging.info("%s is not enabled", command)
         return
 
-    for regex in _regexes:
+    # Calling a lazily loaded plugin modifies _regexes, so iterate over a copy
+    for regex, func in list(_regexes.items()):
         match = regex.search(message)
         if match is not None:
-            func = _regexes[regex]
             if func.enabled:
-                logging.info("%s matched %s" % (message, regex))
-                _regexes[regex].func(
-                    user,
-                    channel,
-                    message,
-                    match)
+                logging.info("%s matched %s", message, regex)
+                _dispatch("regex", func, regex.pattern, user, channel,
+                          message, match,
+                          request=lala.latency.begin(regex.pattern, channel))
             else:
-                logging.info("%s is not enabled" % regex.pattern)
+                logging.info("%s is not enabled", regex.pattern)
 
 
 def on_join(user, channel):
     """ Calls all callbacks for on_join events that were previously
     registered with :meth:`lala.util.on_join`.
     """
-    for cb in _join_callbacks:
-        cb(user, channel)
+    for cb in list(_join_callbacks):
+        _observed("join", _join_callback_plugin(cb), cb.__name__,
+                  _call_join_callback, cb, user, channel)
+
+
+def _call_join_callback(cb, user, channel):
+    ret = cb(user, channel)
+    if iscoroutine(ret):
+        ret = defer.ensureDeferred(ret).addErrback(
+            lambda failure: logging.error(
+                "A join callback failed:\n%s", failure.getTraceback()))
+    return ret
 
 
 def disable(trigger):
@@ -196,28 +1005,181 @@ def enable(trigger):
 def _get_enabled_plugins():
     """Returns a list of all the enabled plugins.
     """
-    return lala.config._get("base",
-                            "plugins").split(lala.config._LIST_SEPARATOR)
+    plugins = lala.config._get("base",
+                               "plugins").split(lala.config._LIST_SEPARATOR)
+    return [plugin.strip() for plugin in plugins if plugin.strip()]
+
+
+def _get_worker_plugins():
+    """Returns a list of the enabled plugins running in worker processes.
+    """
+    plugins = lala.config._get("base", "worker_plugins").split(
+        lala.config._LIST_SEPARATOR)
+    enabled = _get_enabled_plugins()
+    return [plugin.strip() for plugin in plugins if plugin.strip() in enabled]
 
 
 def _reload():
     """Reloads all enabled plugins.
+
+    The new code of every plugin is imported first. If that works, every
+    plugin is torn down and loaded again. The callbacks of the reloaded
+    plugins replace all current ones at once, after their init functions
+    have finished.
+
+    :rtype: :class:`twisted.internet.defer.Deferred` firing once the plugins
+            have been initialized again
     """
     logging.debug("Reloading plugins")
-    global _join_callbacks
-    _join_callbacks = []
-    _regexes.clear()
-    _callbacks.clear()
-    # Call setup to load the modules again.
-    # Important: this works because when using imp.load_module to load an
-    # already imported module, the second import is equivalent to a reload() of
-    # that module.
-    setup()
+    plugins = _get_enabled_plugins() + ["base"]
+    worker_plugins = _get_worker_plugins()
+    try:
+        # The plugins keep running if one of them is broken
+        for plugin in plugins:
+            if plugin not in worker_plugins:
+                _collect(partial(_import_plugin, plugin, True))
+    except Exception:
+        return fail()
+
+    def teardown_failed(plugin, failure):
+        logging.error("Tearing down %s failed: %s", plugin,
+                      failure.getErrorMessage())
+
+    teardowns = [maybeDeferred(_teardown, plugin)
+                 .addErrback(partial(teardown_failed, plugin))
+                 for plugin in plugins]
+    d = gatherResults(teardowns)
+
+    def load(_):
+        _lazy_plugins.clear()
+        # load_plugin reloads modules that have already been imported.
+        staging, ready = _collect(setup)
+
+        def install(result):
+            # The workers have registered their callbacks in the live tables
+            # already, everything else is replaced
+            live = ({func.plugin for func in _callbacks.values()} |
+                    {func.plugin for func in _regexes.values()} |
+                    {_join_callback_plugin(cb) for cb in _join_callbacks})
+            _install(staging, live - set(worker_plugins))
+            return result
+        return ready.addBoth(install)
+    return d.addCallback(load)
+
+
+def _reload_plugin(name):
+    """Reloads only the plugin ``name``.
+
+    All other plugins keep their callbacks, state and resources. The new code
+    of ``name`` is imported before the current one is torn down, its
+    callbacks replace the current ones once its init function has finished.
+    If importing or initializing it fails, the current module is initialized
+    again and keeps its callbacks. Reloading a plugin that runs in worker
+    processes restarts the workers.
+
+    :rtype: :class:`twisted.internet.defer.Deferred` firing once the plugin
+            has been initialized again
+    """
+    logging.debug("Reloading %s", name)
+    worker_plugins = _get_worker_plugins()
+    if name in worker_plugins:
+        return maybeDeferred(_teardown, name).addCallback(
+            lambda _: lala.workers.start(worker_plugins))
+    old = sys.modules.get("%s.%s" % (PLUGIN_PACKAGE, name))
+    lazy = name in _lazy_plugins
+    try:
+        staging, mod = _collect(partial(_import_plugin, name, True))
+    except Exception:
+        return fail()
+
+    def load(_):
+        _lazy_plugins.discard(name)
+        _replace_module(name, mod)
+        return _collect(partial(_init_plugin, name, mod), staging)[1]
+
+    def install(result):
+        _install(staging, [name])
+        return result
+
+    def restore(failure):
+        logging.error("Reloading %s failed, keeping the current version:\n%s",
+                      name, failure.getTraceback())
+        _replace_module(name, old)
+        if lazy:
+            _lazy_plugins.add(name)
+        elif old is not None:
+            maybeDeferred(_init_plugin, name, old).addErrback(
+                lambda failure: logging.error(
+                    "Initializing %s again failed:\n%s", name,
+                    failure.getTraceback()))
+        return failure
+
+    return maybeDeferred(_teardown, name).addCallback(
+        lambda _: maybeDeferred(load, None).addCallbacks(install, restore))
 
 
 def setup():
     """Loads all enabled plugins
+
+    Plugins are imported one after the other. Their init functions may
+    return Deferreds and are called as soon as those of the plugins named in
+    their ``DEPENDENCIES`` have finished, see :func:`_init_plugins`.
+
+    If the ``lazy_plugins`` option is enabled, the callbacks of plugins
+    described by an up to date entry in the plugin manifest are registered
+    without importing the plugin. Its module is imported the first time one
+    of them is called, which waits for its init function. Plugins other
+    plugins depend on and plugins setting ``LAZY = False``, like those
+    starting servers in their init function, are always imported.
+
+    Plugins in the ``worker_plugins`` option are loaded in worker processes,
+    see :mod:`lala.workers`. Their callbacks are registered once the workers
+    have started.
+
+    :rtype: :class:`twisted.internet.defer.Deferred` firing once all plugins
+            have been initialized and the workers have started
     """
-    for plugin in _get_enabled_plugins():
-        load_plugin(plugin)
-    load_plugin("base")
+    with lala.startup.phase("plugins"):
+        lazy = lala.config._CFG.getboolean("base", "lazy_plugins")
+        manifest = _load_manifest() if lazy else {}
+        manifest_changed = False
+        worker_plugins = _get_worker_plugins()
+        enabled = [plugin for plugin in _get_enabled_plugins()
+                   if plugin not in worker_plugins]
+        described = {}
+        for plugin in enabled:
+            entry = manifest.get(plugin)
+            if (entry is not None and entry.get("lazy", True) and
+                    _manifest_entry_is_fresh(plugin, entry)):
+                described[plugin] = entry
+        required = set()
+        for entry in described.values():
+            required.update(entry.get("dependencies", ()))
+
+        modules = {}
+        pending = [plugin for plugin in enabled
+                   if plugin not in described or plugin in required]
+        while pending:
+            plugin = pending.pop(0)
+            if plugin in modules:
+                continue
+            modules[plugin] = _import_plugin(plugin)
+            if lazy:
+                manifest[plugin] = _describe_plugin(plugin)
+                manifest_changed = True
+            pending.extend(dependency
+                           for dependency in _dependencies(modules[plugin])
+                           if dependency in described)
+        for plugin in enabled:
+            if plugin not in modules:
+                _register_lazy(plugin, described[plugin])
+        modules["base"] = _import_plugin("base")
+        if manifest_changed:
+            _save_manifest(manifest)
+        ready = [_init_plugins(modules)]
+    if worker_plugins:
+        ready.append(lala.startup.timed(
+            "workers", None, lala.workers.start, worker_plugins).addErrback(
+            lambda failure: logging.error("Starting the workers failed: %s",
+                                          failure.getErrorMessage())))
+    return gatherResults(ready).addCallback(lambda _: None)
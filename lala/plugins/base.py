@@ -1,8 +1,13 @@
 import lala.config as config
 import lala.util as util
 import logging
+import lala.memory
 import lala.pluginmanager
+import lala.profiling
+import lala.ratelimit
+import lala.threadpool
 
+from functools import partial
 from lala.util import command, msg
 from twisted.internet import reactor
 
@@ -10,14 +15,14 @@ from twisted.internet import reactor
 @command(admin_only=True)
 def part(user, channel, text):
     """Part a channel"""
-    logging.debug("Parting %s" % channel)
+    logging.debug("Parting %s", channel)
     util._BOT.part(channel.encode("utf-8"))
 
 
 @command(admin_only=True)
 def join(user, channel, chan):
     """Join a channel"""
-    logging.debug("Joining %s" % chan)
+    logging.debug("Joining %s", chan)
     util._BOT.join(chan.encode("utf-8"))
 
 
@@ -101,7 +106,7 @@ def help(user, channel, cmd):
 def enable(user, channel, command):
     """Enables a command or regular expression
     """
-    logging.info("Enabling %s" % command)
+    logging.info("Enabling %s", command)
     lala.pluginmanager.enable(command)
 
 
@@ -109,14 +114,154 @@ def enable(user, channel, command):
 def disable(user, channel, command):
     """disables a command.
     """
-    logging.info("Disabling %s" % command)
+    logging.info("Disabling %s", command)
     lala.pluginmanager.disable(command)
 
 
+@command(admin_only=True)
+def threadpool(user, channel, text):
+    """Show the state of the plugin thread pool"""
+    msg(channel, "%(busy)i of %(size)i threads busy, %(idle)i idle, "
+                 "%(queued)i callbacks queued" % lala.threadpool.statistics())
+
+
+@command(admin_only=True)
+def concurrency(user, channel, text):
+    """Show the state of all commands with a concurrency limit"""
+    stats = lala.pluginmanager.concurrency_statistics()
+    if not stats:
+        msg(channel, "No command has a concurrency limit")
+        return
+    msg(channel, ["%s: %i of %i running, %i queued"
+                  % (trigger, stat["in_flight"], stat["limit"], stat["queued"])
+                  for trigger, stat in sorted(stats.items())])
+
+
+@command(admin_only=True)
+def ratelimits(user, channel, text):
+    """Show how often commands have been dropped because of rate limits"""
+    stats = lala.ratelimit.drop_statistics()
+    if not stats:
+        msg(channel, "No command has been dropped")
+        return
+    lines = []
+    for trigger, scopes in sorted(stats.items()):
+        drops = ["%i by the %s limit" % (count, scope)
+                 for scope, count in sorted(scopes.items())]
+        lines.append("%s: %s" % (trigger, ", ".join(drops)))
+    msg(channel, lines)
+
+
+@command(admin_only=True)
+def jobs(user, channel, text):
+    """List running commands and regexes, show how often they have timed out
+    with ``jobs timeouts`` or cancel one with ``jobs cancel <id>``"""
+    args = text.split()
+    if not args:
+        running = lala.pluginmanager.jobs()
+        if not running:
+            msg(channel, "No jobs are running")
+            return
+        msg(channel, ["%i: %s by %s in %s, running for %is"
+                      % (job.id, job.trigger, job.user, job.channel,
+                         job.age())
+                      for job in running])
+    elif args[0] == "timeouts":
+        timeouts = lala.pluginmanager.timeout_statistics()
+        if not timeouts:
+            msg(channel, "Nothing has timed out yet")
+            return
+        msg(channel, ["%s: %i timeouts" % item
+                      for item in sorted(timeouts.items())])
+    elif args[0] == "cancel" and len(args) == 2 and args[1].isdigit():
+        if lala.pluginmanager.cancel_job(int(args[1])):
+            msg(channel, "Job %s has been cancelled" % args[1])
+        else:
+            msg(channel, "There is no job %s" % args[1])
+    else:
+        msg(channel, "Usage: jobs [timeouts|cancel <id>]")
+
+
+def _send_profile(user, path, summary):
+    if path is None:
+        msg(user, "Profiling finished, but writing the results failed")
+    else:
+        msg(user, "Profiling finished, the results are in %s" % path)
+    msg(user, summary)
+
+
+@command(admin_only=True)
+def profile(user, channel, text):
+    """Profile the bot with ``profile start [seconds] [cprofile|sampling]``
+    and ``profile stop``. The results are sent in a query."""
+    args = text.split()
+    if args[:1] == ["start"]:
+        seconds = 30
+        mode = "sampling"
+        for arg in args[1:]:
+            if arg.isdigit():
+                seconds = int(arg)
+            elif arg in lala.profiling.MODES:
+                mode = arg
+            else:
+                msg(channel, "Unknown argument %s" % arg)
+                return
+        try:
+            lala.profiling.start(mode, seconds,
+                                 partial(_send_profile, user))
+        except lala.profiling.ProfilingError as exc:
+            msg(channel, str(exc))
+            return
+        msg(channel, "Profiling with %s for at most %i seconds"
+            % (mode, min(seconds, lala.profiling.MAX_SECONDS)))
+    elif args == ["stop"]:
+        try:
+            lala.profiling.stop()
+        except lala.profiling.ProfilingError as exc:
+            msg(channel, str(exc))
+    else:
+        msg(channel, "Usage: profile start [seconds] [cprofile|sampling] or "
+                     "profile stop")
+
+
+@command(admin_only=True)
+def memory(user, channel, text):
+    """Track the memory used by every plugin with ``memory start``, show its
+    growth in a query with ``memory`` and stop with ``memory stop``."""
+    args = text.split()
+    try:
+        if args == ["start"]:
+            lala.memory.start_tracking()
+            msg(channel, "Tracking memory, use memory to see its growth")
+        elif args == ["stop"]:
+            lala.memory.stop_tracking()
+            msg(channel, "Stopped tracking memory")
+        elif not args:
+            msg(user, lala.memory.report(
+                int(config._get("base", "memory_top"))))
+        else:
+            msg(channel, "Usage: memory [start|stop]")
+    except lala.memory.MemoryTrackingError as exc:
+        msg(channel, str(exc))
+
+
 @command(admin_only=True)
 def pluginupdate(user, channel, text):
-    """Reloads all plugins. Plugins that are not enabled in the configuration
-    file will be disabled by calling this!
+    """Reloads all plugins or, if a plugin name is given, only that one.
+    Plugins that are not enabled in the configuration file will be disabled
+    by reloading all plugins!
     """
-    lala.pluginmanager._reload()
-    msg(channel, "All enabled plugins have been reloaded.")
+    name = text.strip()
+    if not name:
+        d = lala.pluginmanager._reload()
+        d.addCallback(lambda _: msg(channel,
+                                    "All enabled plugins have been reloaded."))
+        return d
+
+    enabled_plugins = lala.pluginmanager._get_enabled_plugins()
+    if name != "base" and name not in enabled_plugins:
+        msg(channel, "%s is not an enabled plugin" % name)
+        return
+    d = lala.pluginmanager._reload_plugin(name)
+    d.addCallback(lambda _: msg(channel, "%s has been reloaded." % name))
+    return d
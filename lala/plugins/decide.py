@@ -27,7 +27,7 @@ def decide(user, channel, text):
     msg(channel, "%s: %s" % (user, choice(s_text)))
 
 
-@command
+@command(threaded=True, rate_limit="5/60")
 def decide_real_hard(user, channel, text):
     """Pick one choice in an arbitrary list of choices separated by a slash,
     deluxe version"""
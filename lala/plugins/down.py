@@ -21,7 +21,7 @@ from twisted.internet.defer import inlineCallbacks
 DFEOOJM_URL = "https://www.downforeveryoneorjustme.com/%s"
 
 
-@command
+@command(max_concurrency=4, max_queue=4)
 @inlineCallbacks
 def isitdown(user, channel, text):
     website = DFEOOJM_URL % text
@@ -35,13 +35,13 @@ DEFAULT_OPTIONS = {"fortune_path": "/usr/bin/fortune",
                    "fortune_files": "fortunes"}
 
 
-@command
+@command(rate_limit="5/60")
 def fortune(user, channel, text):
     """Show a random, hopefully interesting, adage"""
     return _call_fortune(user, channel, _get_fortune_file_from_text(text))
 
 
-@command
+@command(rate_limit="5/60")
 def ofortune(user, channel, text):
     """Show a random, hopefully interesting, offensive adage"""
     return _call_fortune(user, channel, ["-o"] +
@@ -20,6 +20,8 @@ Options
 
 """
 from lala.util import command, msg
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 from scrapy.crawler import Crawler
 from scrapy import signals
 from ilmwetter import settings as iw_settings
@@ -35,7 +37,7 @@ def item_scraped(item, response, spider):
                    item["humidity"]))
 
 
-@command(aliases=["iw"])
+@command(aliases=["iw"], max_concurrency=1, max_queue=2, timeout=120)
 def iweather(user, channel, text):
     """Show the current weather in Ilmenau."""
 
@@ -49,4 +51,16 @@ def iweather(user, channel, text):
                             signal=signals.item_scraped)
     crawler.configure()
     crawler.crawl(spider)
-    return crawler.start()
+
+    # Stop the crawl if the command is cancelled or times out
+    result = Deferred(lambda _: crawler.stop())
+
+    def finished(value):
+        if not result.called:
+            if isinstance(value, Failure):
+                result.errback(value)
+            else:
+                result.callback(value)
+
+    crawler.start().addBoth(finished)
+    return result
@@ -10,57 +10,416 @@ Options
 - ``log_file``
     The location of the log file.
 
+- ``log_folder``
+    The folder for the logs of the individual channels, see
+    :mod:`lala.segments`.
+
 - ``max_log_days``
     The number of days for which logs are kept. Set this to zero to keep them
     indefinitely.
+
+- ``archive_file``
+    The SQLite database of the full text search archive, see
+    :mod:`lala.archive`. Empty disables the archive.
+
+- ``grep_results``
+    The most messages ``grep`` shows.
+
+The log file is rotated at midnight. The rotated files and the finished
+segments of the channels are compressed with gzip in a background thread,
+``last`` reads them as well:
+
+- ``last [<lines>]`` shows the last lines of the log file
+- ``last <lines> <channel>`` shows the last lines of a channel
+- ``last since [YYYY-MM-DD] [HH:MM] [<channel>]`` shows the lines of a
+  channel, by default the current one, from then on
+
+If the archive is enabled, ``grep <terms> [<channel> [<nick>]]`` shows the
+newest messages of a channel containing all terms. The channel defaults to the
+current one, ``*`` searches all channels. A term ending with ``*`` matches
+words starting with it.
 """
-import codecs
+import datetime
+import gzip
+import lala.archive
 import lala.config
+import lala.logqueue
+import lala.segments
 import logging
-import logging.handlers
+import os
+import re
+import shutil
+import threading
+import time
 
+from collections import deque
 from lala.util import command, msg, regex
+from time import perf_counter
 
 __all__ = ()
 
 chatlogger = None
 
+#: The :class:`lala.archive.Archive`, None if it's disabled
+_archive = None
+
+#: The handler :func:`init` attached to the chat logger
+_handler = None
+
+#: The suffix TimedRotatingFileHandler appends to rotated files
+_STAMP = re.compile(r"^\d{4}-\d{2}-\d{2}$")
 
-DEFAULT_OPTIONS = {"max_lines": 30}
+_GZIP_SUFFIX = ".gz"
+_TMP_SUFFIX = ".tmp"
 
+#: The first characters of channel names
+_CHANNEL_PREFIXES = "#&+!"
 
-@command
+#: Seconds between two removals of expired messages from the archive
+_PRUNE_INTERVAL = 3600
+
+#: The rotated files being compressed right now
+_compressing = set()
+_compressing_lock = threading.Lock()
+
+
+DEFAULT_OPTIONS = {"max_lines": 30,
+                   "archive_file": "",
+                   "grep_results": "10"}
+
+
+@command(threaded=True)
 def last(user, channel, text):
-    """Show the last lines from the log"""
+    """Show the last lines from the log, of a channel or since a time"""
     max_lines = lala.config.get_int("max_lines")
-    s_text = text.split()
+    folder = lala.config.get("log_folder")
+    args = text.split()
+    target = None
+    if args and args[-1][0] in _CHANNEL_PREFIXES:
+        target = args.pop()
+    if args and args[0] == "since":
+        try:
+            start = _parse_time(args[1:])
+        except ValueError:
+            msg(user, "Usage: last since [YYYY-MM-DD] [HH:MM] [<channel>]",
+                log=False)
+            return
+        # The chat log is written in a separate thread
+        lala.logqueue.flush()
+        lines = lala.segments.since(folder, target or channel, start,
+                                    max_lines)
+    else:
+        try:
+            count = min(max_lines, int(args[0]))
+        except (IndexError, ValueError):
+            count = max_lines
+        lala.logqueue.flush()
+        if target is None:
+            lines = _last_lines(lala.config.get("log_file"), count)
+        else:
+            lines = lala.segments.last(folder, target, count)
+    msg(user, lines, log=False)
+
+
+@command(threaded=True)
+def grep(user, channel, text):
+    """Search the archive for the newest messages containing all terms"""
+    if _archive is None:
+        msg(user, "The archive is disabled", log=False)
+        return
+    args = text.split()
+    # Private messages search all channels
+    target = channel if channel[0] in _CHANNEL_PREFIXES else None
+    nick = None
+    if len(args) > 2 and _is_channel(args[-2]):
+        nick = args.pop()
+        target = args.pop()
+    elif len(args) > 1 and _is_channel(args[-1]):
+        target = args.pop()
+    if target == "*":
+        target = None
+    # The archive is written in a separate thread
+    lala.logqueue.flush()
     try:
-        lines = min(max_lines, int(s_text[1]))
-    except IndexError:
-        lines = max_lines
-    logfile = lala.config.get("log_file")
-    with codecs.open(logfile, "r", "utf-8") as _file:
-        _lines = _file.readlines()
-    lines = min(lines, len(_lines))
-    msg(user, _lines[-lines:], log=False)
+        rows = _archive.search(args, target, nick,
+                               lala.config.get_int("grep_results"))
+    except ValueError:
+        msg(user, "Usage: grep <terms> [<channel> [<nick>]]", log=False)
+        return
+    if not rows:
+        msg(user, "No messages found", log=False)
+        return
+    msg(user, ["%s %s <%s> %s" % (
+        datetime.datetime.fromtimestamp(when).strftime("%Y-%m-%d %H:%M"),
+        where, who, message) for when, where, who, message in rows],
+        log=False)
+
+
+def _is_channel(arg):
+    return arg == "*" or arg[0] in _CHANNEL_PREFIXES
+
+
+def _parse_time(args):
+    """Returns the timestamp of ``args``, ``[YYYY-MM-DD] [HH:MM]``. The date
+    defaults to today, the time to midnight."""
+    if not 1 <= len(args) <= 2:
+        raise ValueError(args)
+    day = datetime.date.today()
+    clock = datetime.time()
+    for arg in args:
+        if ":" in arg:
+            clock = datetime.datetime.strptime(arg, "%H:%M").time()
+        else:
+            day = datetime.datetime.strptime(arg, "%Y-%m-%d").date()
+    return time.mktime(datetime.datetime.combine(day, clock).timetuple())
+
+
+def _last_lines(logfile, count):
+    """Returns the last ``count`` lines of the chat log, going back to the
+    rotated files if the current one has fewer."""
+    lines = []
+    for path in [logfile] + _rotated(logfile):
+        if len(lines) >= count:
+            break
+        try:
+            with _open(path) as fp:
+                lines[:0] = deque(fp, maxlen=count - len(lines))
+        except FileNotFoundError:
+            # The file has been compressed since listing the directory
+            if path == logfile or not os.path.exists(path + _GZIP_SUFFIX):
+                continue
+            with _open(path + _GZIP_SUFFIX) as fp:
+                lines[:0] = deque(fp, maxlen=count - len(lines))
+    return lines
+
+
+def _open(path):
+    if path.endswith(_GZIP_SUFFIX):
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+def _rotations(logfile):
+    """Returns a dict mapping the date stamps of the rotated files of
+    ``logfile`` to their paths. A day has several files while it is being
+    compressed."""
+    directory, name = os.path.split(logfile)
+    prefix = name + "."
+    segments = {}
+    for filename in os.listdir(directory or "."):
+        if not filename.startswith(prefix):
+            continue
+        stamp = filename[len(prefix):].split(".", 1)[0]
+        if _STAMP.match(stamp):
+            segments.setdefault(stamp, []).append(
+                os.path.join(directory, filename))
+    return segments
+
+
+def _rotated(logfile):
+    """Returns the rotated files of ``logfile`` to read, the newest first:
+    one per day, the uncompressed one until its compression is done."""
+    rotated = []
+    for stamp, paths in sorted(_rotations(logfile).items(), reverse=True):
+        for path in sorted(paths):
+            if not path.endswith(_TMP_SUFFIX):
+                rotated.append(path)
+                break
+    return rotated
+
+
+def _compress(path):
+    """Compresses ``path`` to ``path.gz`` and removes it."""
+    with _compressing_lock:
+        if path in _compressing:
+            return
+        _compressing.add(path)
+    target = path + _GZIP_SUFFIX
+    tmp = target + _TMP_SUFFIX
+    try:
+        start = perf_counter()
+        with open(path, "rb") as src:
+            with gzip.open(tmp, "wb", compresslevel=6) as dst:
+                shutil.copyfileobj(src, dst, 1 << 16)
+        os.replace(tmp, target)
+        size, compressed = os.path.getsize(path), os.path.getsize(target)
+        os.remove(path)
+        logging.info("Compressed %s in %.2f s: %i -> %i bytes, %.1f:1",
+                     path, perf_counter() - start, size, compressed,
+                     size / max(compressed, 1))
+    except Exception:
+        logging.exception("Compressing %s failed", path)
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    finally:
+        with _compressing_lock:
+            _compressing.discard(path)
+
+
+def _compress_all(paths):
+    for path in paths:
+        _compress(path)
+
+
+def _finish_segments(folder, days, paths):
+    """Compresses the finished segments ``paths`` and removes the segments
+    older than ``days`` days."""
+    for path in paths:
+        try:
+            lala.segments.compress(path)
+        except Exception:
+            logging.exception("Compressing %s failed", path)
+    lala.segments.expire(folder, days)
+
+
+def _in_background(func, *args):
+    """Calls ``func`` with ``args`` in a new thread. The bot waits for it
+    before exiting.
+
+    :rtype: :class:`threading.Thread`
+    """
+    thread = threading.Thread(target=func, args=args, name="lala-log-gzip")
+    thread.start()
+    return thread
+
+
+class _CompressingHandler(lala.logqueue.TimedRotatingFileHandler):
+    """Compresses the rotated files in the background."""
+    def rotate(self, source, dest):
+        if os.path.exists(source):
+            os.rename(source, dest)
+            _in_background(_compress_all, [dest])
+
+    def getFilesToDelete(self):  # noqa: N802
+        # Counts days instead of files, a day has several while it's being
+        # compressed
+        segments = _rotations(self.baseFilename)
+        stamps = sorted(segments)[:-self.backupCount]
+        return [path for stamp in stamps for path in segments[stamp]]
+
+
+class _SegmentHandler(logging.Handler):
+    """Writes the messages to the segments of their channels."""
+    def __init__(self, folder, days):
+        logging.Handler.__init__(self)
+        self.folder = folder
+        self.days = days
+        self.writer = lala.segments.Writer(folder, self.finished)
+
+    def emit(self, record):
+        channel = getattr(record, "channel", None)
+        if channel is None:
+            return
+        try:
+            self.writer.write(channel, record.created, record.getMessage())
+        except Exception:
+            self.handleError(record)
+
+    def finished(self, path):
+        _in_background(_finish_segments, self.folder, self.days, [path])
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        logging.Handler.close(self)
+
+
+class _ArchiveHandler(logging.Handler):
+    """Adds the messages to ``archive``, one transaction per batch of the
+    writer thread, and removes those older than ``days`` days every
+    :data:`_PRUNE_INTERVAL` seconds.
+
+    The messages get ids after the newest one's unless ``next_id`` is set,
+    see :meth:`lala.archive.Archive.add`."""
+    def __init__(self, archive, days):
+        logging.Handler.__init__(self)
+        self.archive = archive
+        self.days = days
+        self.pending = []
+        self.pruned = None
+        self.next_id = None
+
+    def emit(self, record):
+        channel = getattr(record, "channel", None)
+        if channel is None:
+            return
+        self.pending.append((record.created, channel, record.nick,
+                             record.text))
+
+    def flush(self):
+        messages, self.pending = self.pending, []
+        try:
+            if messages:
+                self.archive.add(messages, self.next_id)
+                if self.next_id is not None:
+                    self.next_id += len(messages)
+            self.prune()
+        except Exception:
+            logging.exception("Archiving %i messages failed", len(messages))
+
+    def prune(self):
+        now = time.monotonic()
+        if self.days <= 0 or (self.pruned is not None and
+                              now - self.pruned < _PRUNE_INTERVAL):
+            return
+        self.pruned = now
+        # Like the segments, whole days are kept
+        oldest = datetime.date.today() - datetime.timedelta(days=self.days)
+        removed = self.archive.prune(time.mktime(oldest.timetuple()))
+        if removed:
+            logging.info("Removed %i messages from before %s from the "
+                         "archive", removed, oldest)
+
+    def close(self):
+        self.archive.close()
+        logging.Handler.close(self)
 
 
 @regex(".*")
 def chatlog(user, channel, text, match_obj):
-    chatlogger.info("%s: %s" % (user, text))
+    chatlogger.info("%s: %s", user, text,
+                    extra={"channel": channel, "nick": user, "text": text})
 
 
 def init():
-    global chatlogger
+    global chatlogger, _archive, _handler
     logfile = lala.config.get("log_file")
+    folder = lala.config.get("log_folder")
+    days = lala.config.get_int("max_log_days")
     chatlogger = logging.getLogger("MessageLog")
-    chathandler = logging.handlers.TimedRotatingFileHandler(
+    chathandler = _CompressingHandler(
         encoding="utf-8",
         filename=logfile,
         when="midnight",
-        backupCount=lala.config.get_int("max_log_days"))
+        backupCount=days)
     chatlogger.setLevel(logging.INFO)
     chathandler.setFormatter(
         logging.Formatter("%(asctime)s %(message)s", "%Y-%m-%d %H:%M"))
     chatlogger.propagate = False
-    chatlogger.addHandler(chathandler)
+    handlers = [chathandler, _SegmentHandler(folder, days)]
+    archive_file = lala.config.get("archive_file")
+    _archive = lala.archive.Archive(archive_file) if archive_file else None
+    if _archive is not None:
+        handlers.append(_ArchiveHandler(_archive, days))
+    _handler = lala.logqueue.attach(chatlogger, *handlers)
+
+    # Left over from before the rotated files were compressed or from an
+    # interrupted compression
+    uncompressed = [path for path in _rotated(logfile)
+                    if not path.endswith(_GZIP_SUFFIX)]
+    if uncompressed:
+        _in_background(_compress_all, uncompressed)
+    _in_background(_finish_segments, folder, days,
+                   lala.segments.finished(folder))
+
+
+def teardown():
+    global _archive, _handler
+    # Closes the log file, the segments and the archive once the messages
+    # logged so far have been written
+    if _handler is not None:
+        lala.logqueue.detach(chatlogger, _handler)
+        _handler = None
+    _archive = None
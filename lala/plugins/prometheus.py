@@ -8,33 +8,274 @@ Prometheus
 
 The prompetheus plugin exposes metrics for `Prometheus <https://prometheus.io/>`_.
 
+Besides the number of messages and joins, it records how long every command,
+regex and join callback takes, labeled by kind, plugin and trigger:
+
+- ``callback_sync_duration_seconds``: the time the call itself took
+- ``callback_duration_seconds``: the time until the Deferreds returned by the
+  callback fired
+- ``callback_errors``: the number of calls that raised an exception or whose
+  Deferreds failed
+
+The time from the receipt of a message triggering a command or regex until
+its replies are written to the socket, including the time they wait because
+of the bot's line rate, is recorded per trigger (see :mod:`lala.latency`):
+
+- ``response_latency_seconds``: until the first reply
+- ``response_line_latency_seconds``: until each reply
+
+It also shows how healthy the reactor is:
+
+- ``reactor_lag_seconds``: how much later than scheduled a call that runs
+  every ``lag_interval`` seconds actually ran, which is the time the reactor
+  was busy with something else
+- ``thread_pool_threads``, ``thread_pool_max_threads``,
+  ``thread_pool_queued_callbacks`` and ``thread_pool_utilization``: the state
+  of the thread pools from :func:`lala.threadpool.all_statistics`, including
+  the database pool of the quotes plugin. Only the plugin thread pool has a
+  number of queued callbacks
+- ``irc_send_queue_lines``: the number of lines waiting to be sent to the
+  server because of the bot's line rate
+- ``reactor_stalls``: the number of times :mod:`lala.watchdog` found the
+  reactor blocked, labeled by the plugin and trigger that blocked it
+
+While :mod:`lala.memory` tracks memory, ``plugin_memory_bytes`` exports the
+memory allocated by every plugin as of its most recent measurement and
+``traced_memory_bytes`` the memory allocated by the whole bot.
+
+The timeline of the startup from :mod:`lala.startup` is exported as
+``startup_phase_start_seconds`` and ``startup_phase_seconds``, when each phase
+began and how long it took, labeled by the phase and the plugin or channel it
+concerns, and ``startup_seconds``, how long the whole startup took.
+
 Options
 -------
 
 - ``port``
     The port on which the web server exposes the metrics. Defaults to 9100.
+
+- ``lag_interval``
+    Seconds between two measurements of the reactor lag. Defaults to 1.
 """  # noqa
 import lala.config
+import lala.latency
+import lala.memory
+import lala.pluginmanager
+import lala.startup
+import lala.threadpool
+import lala.util
+import lala.watchdog
+import tracemalloc
 
 from lala.util import on_join, regex
-from prometheus_client import Counter
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
 from prometheus_client.twisted import MetricsResource
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.web.server import Site
 from twisted.web.resource import Resource
 
 __all__ = ()
 
-DEFAULT_OPTIONS = {"port": 9100}
+DEFAULT_OPTIONS = {"port": 9100,
+                   "lag_interval": "1"}
+
+#: init starts a server, which has to listen before anything is called
+LAZY = False
+
+_port = None
+_lag_probe = None
 
 
 messages = Counter("channel_messages_received",
                    "Number of messages seen",
-                   ["channel"])
+                   ["channel"],
+                   registry=None)
 
 joins = Counter("joins",
                 "Number of joins seen",
-                ["channel"])
+                ["channel"],
+                registry=None)
+
+_CALLBACK_LABELS = ["kind", "plugin", "trigger"]
+
+callback_sync_duration = Histogram(
+    "callback_sync_duration_seconds",
+    "Time spent calling commands, regexes and join callbacks",
+    _CALLBACK_LABELS,
+    buckets=(.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25,
+             .5, 1, float("inf")),
+    registry=None)
+
+callback_duration = Histogram(
+    "callback_duration_seconds",
+    "Time until the Deferreds returned by commands, regexes and join "
+    "callbacks fired",
+    _CALLBACK_LABELS,
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+             float("inf")),
+    registry=None)
+
+callback_errors = Counter("callback_errors",
+                          "Number of failed commands, regexes and join "
+                          "callbacks",
+                          _CALLBACK_LABELS,
+                          registry=None)
+
+_LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60,
+                    float("inf"))
+
+response_latency = Histogram(
+    "response_latency_seconds",
+    "Time from receiving a message to sending the first reply to it",
+    ["trigger"],
+    buckets=_LATENCY_BUCKETS,
+    registry=None)
+
+response_line_latency = Histogram(
+    "response_line_latency_seconds",
+    "Time from receiving a message to sending each reply to it",
+    ["trigger"],
+    buckets=_LATENCY_BUCKETS,
+    registry=None)
+
+reactor_lag = Histogram(
+    "reactor_lag_seconds",
+    "Delay between the scheduled and the actual time of a periodic call",
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+             float("inf")),
+    registry=None)
+
+
+class _HealthCollector(object):
+    """Collects the state of the thread pools, the send queue, the stalls
+    found by the watchdog, the memory used by the plugins and the startup
+    timeline whenever the metrics are scraped."""
+    def describe(self):
+        return []
+
+    def collect(self):
+        threads = GaugeMetricFamily("thread_pool_threads",
+                                    "Number of threads of a thread pool",
+                                    labels=["pool", "state"])
+        size = GaugeMetricFamily("thread_pool_max_threads",
+                                 "Maximum number of threads of a thread pool",
+                                 labels=["pool"])
+        queued = GaugeMetricFamily("thread_pool_queued_callbacks",
+                                   "Number of callbacks waiting for a thread",
+                                   labels=["pool"])
+        utilization = GaugeMetricFamily("thread_pool_utilization",
+                                        "Fraction of busy threads of a "
+                                        "thread pool",
+                                        labels=["pool"])
+        for pool, stats in sorted(lala.threadpool.all_statistics().items()):
+            threads.add_metric([pool, "busy"], stats["busy"])
+            threads.add_metric([pool, "idle"], stats["idle"])
+            size.add_metric([pool], stats["size"])
+            if stats["queued"] is not None:
+                queued.add_metric([pool], stats["queued"])
+            utilization.add_metric([pool], stats["utilization"])
+        send_queue = GaugeMetricFamily("irc_send_queue_lines",
+                                       "Number of lines waiting to be sent "
+                                       "to the server")
+        send_queue.add_metric([], _send_queue_length())
+        stalls = CounterMetricFamily("reactor_stalls",
+                                     "Number of times the reactor was "
+                                     "blocked for longer than the watchdog "
+                                     "threshold",
+                                     labels=["plugin", "trigger"])
+        stats = lala.watchdog.stall_statistics()
+        for (plugin, trigger), count in stats.items():
+            stalls.add_metric([plugin or "", trigger or ""], count)
+        metrics = [threads, size, queued, utilization, send_queue, stalls]
+        if lala.memory.tracking():
+            plugin_memory = GaugeMetricFamily("plugin_memory_bytes",
+                                              "Memory allocated by a plugin "
+                                              "at the last measurement",
+                                              labels=["plugin"])
+            for plugin, allocated in (
+                    lala.memory.plugin_statistics().items()):
+                plugin_memory.add_metric([plugin], allocated)
+            traced = GaugeMetricFamily("traced_memory_bytes",
+                                       "Memory allocated by the bot")
+            traced.add_metric([], tracemalloc.get_traced_memory()[0])
+            metrics.extend((plugin_memory, traced))
+        metrics.extend(_startup_metrics())
+        return metrics
+
+
+def _startup_metrics():
+    phases = lala.startup.timeline()
+    if not phases:
+        return []
+    starts = GaugeMetricFamily("startup_phase_start_seconds",
+                               "Seconds after the start of the bot a phase "
+                               "of its startup began",
+                               labels=["phase", "detail"])
+    durations = GaugeMetricFamily("startup_phase_seconds",
+                                  "Duration of a phase of the startup",
+                                  labels=["phase", "detail"])
+    # Phases like connect can happen more than once, the last one counts
+    latest = {}
+    for phase in phases:
+        latest[(phase.name, phase.detail or "")] = phase
+    for labels, phase in sorted(latest.items()):
+        starts.add_metric(labels, phase.start)
+        if phase.end is not None:
+            durations.add_metric(labels, phase.duration)
+    metrics = [starts, durations]
+    total = lala.startup.total()
+    if total is not None:
+        startup = GaugeMetricFamily("startup_seconds",
+                                    "Duration of the startup until all "
+                                    "channels were joined")
+        startup.add_metric([], total)
+        metrics.append(startup)
+    return metrics
+
+
+def _send_queue_length():
+    # IRCClient keeps the lines delayed by its lineRate in _queue
+    return len(getattr(lala.util._BOT, "_queue", None) or ())
+
+
+health = _HealthCollector()
+
+#: Registered by init, so reloading the plugin can import a new copy of the
+#: module while the collectors of the current one are still registered
+_COLLECTORS = (messages, joins, callback_sync_duration, callback_duration,
+               callback_errors, response_latency, response_line_latency,
+               reactor_lag, health)
+
+
+class _LagProbe(object):
+    """Calls itself every ``interval`` seconds and records how late that
+    happens in :data:`reactor_lag`."""
+    def __init__(self, interval, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.call = LoopingCall(self.tick)
+        self.call.clock = clock
+        self.scheduled = None
+
+    def _schedule(self, now):
+        # LoopingCall runs on a grid starting at its start time
+        running_for = now - self.call.starttime
+        self.scheduled = now + self.interval - running_for % self.interval
+
+    def start(self):
+        self.call.start(self.interval, now=False)
+        self._schedule(self.clock.seconds())
+
+    def stop(self):
+        if self.call.running:
+            self.call.stop()
+
+    def tick(self):
+        now = self.clock.seconds()
+        reactor_lag.observe(max(0.0, now - self.scheduled))
+        self._schedule(now)
 
 
 @on_join
@@ -47,11 +288,55 @@ def inc_message_counter(user, channel, text, match_obj):
     messages.labels(channel=channel).inc()
 
 
+#: Maps label values to the children of the callback metrics, looking them
+#: up with labels() is a lot slower
+_callback_metrics = {}
+
+
+def observe_callback(kind, plugin, trigger, sync, total, failed):
+    labels = (kind, plugin or "", trigger)
+    metrics = _callback_metrics.get(labels)
+    if metrics is None:
+        metrics = _callback_metrics[labels] = (
+            callback_sync_duration.labels(*labels),
+            callback_duration.labels(*labels),
+            callback_errors.labels(*labels))
+    metrics[0].observe(sync)
+    metrics[1].observe(total)
+    if failed:
+        metrics[2].inc()
+
+
+def observe_response(trigger, latency, first):
+    if first:
+        response_latency.labels(trigger).observe(latency)
+    response_line_latency.labels(trigger).observe(latency)
+
+
 def init():
+    global _port
+    global _lag_probe
+    for collector in _COLLECTORS:
+        REGISTRY.register(collector)
+    lala.pluginmanager.add_dispatch_observer(observe_callback)
+    lala.latency.add_observer(observe_response)
+    _lag_probe = _LagProbe(float(lala.config.get("lag_interval")))
+    _lag_probe.start()
     root = Resource()
     root.putChild(b'metrics', MetricsResource())
 
     port = lala.config.get_int("port")
 
     factory = Site(root)
-    reactor.listenTCP(port, factory)
+    _port = reactor.listenTCP(port, factory)
+
+
+def teardown():
+    lala.pluginmanager.remove_dispatch_observer(observe_callback)
+    lala.latency.remove_observer(observe_response)
+    if _lag_probe is not None:
+        _lag_probe.stop()
+    for collector in _COLLECTORS:
+        REGISTRY.unregister(collector)
+    if _port is not None:
+        return _port.stopListening()
@@ -68,6 +68,7 @@ Options
   ``qtop``/``qflop``. Defaults to 5.
 """
 from __future__ import division
+import lala.threadpool
 import logging
 import os
 
@@ -111,6 +112,27 @@ def run_interaction(func, callback=None, **kwargs):
     return res
 
 
+def _create_tables(txn, *args):
+    """Creates the tables of the quotes database if they don't exist."""
+    txn.execute("""CREATE TABLE IF NOT EXISTS author(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE);""")
+    txn.execute("""CREATE TABLE IF NOT EXISTS quote(
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        quote TEXT,
+        author INTEGER NOT NULL REFERENCES author(id));""")
+    txn.execute("""CREATE TABLE IF NOT EXISTS voter (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL UNIQUE);""")
+    txn.execute("""CREATE TABLE IF NOT EXISTS vote (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        vote INT NOT NULL,
+        quote INTEGER NOT NULL REFERENCES quote(id),
+        voter INTEGER NOT NULL REFERENCES voter(id),
+        CONSTRAINT valid_vote CHECK (vote IN (-1, 1)),
+        CONSTRAINT unique_quote_voter UNIQUE (quote, voter));""")
+
+
 def init():
     global database_path
     global db_connection
@@ -119,26 +141,15 @@ def init():
                                           check_same_thread=False,
                                           cp_openfun=_openfun,
                                           cp_min=1)
+    lala.threadpool.watch("quotes", db_connection.threadpool)
+
+    return run_interaction(_create_tables)
+
 
-    def f(txn, *args):
-        txn.execute("""CREATE TABLE IF NOT EXISTS author(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE);""")
-        txn.execute("""CREATE TABLE IF NOT EXISTS quote(
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            quote TEXT,
-            author INTEGER NOT NULL REFERENCES author(id));""")
-        txn.execute("""CREATE TABLE IF NOT EXISTS voter (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE);""")
-        txn.execute("""CREATE TABLE IF NOT EXISTS vote (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            vote INT NOT NULL,
-            quote INTEGER NOT NULL REFERENCES quote(id),
-            voter INTEGER NOT NULL REFERENCES voter(id),
-            CONSTRAINT valid_vote CHECK (vote IN (-1, 1)),
-            CONSTRAINT unique_quote_voter UNIQUE (quote, voter));""")
-    return run_interaction(f)
+def teardown():
+    lala.threadpool.unwatch("quotes")
+    if db_connection is not None:
+        db_connection.close()
 
 
 @command(aliases=["qget"])
@@ -152,7 +163,7 @@ def getquote(user, channel, text):
                                                        text))
 
     if text:
-        logging.info("Trying to get quote number %s" % text)
+        logging.info("Trying to get quote number %s", text)
         run_query("""SELECT q.id, q.quote, sum(v.vote) as rating, count(v.vote)
                             as votes
                     FROM quote q
@@ -169,10 +180,10 @@ def addquote(user, channel, text):
     if text:
 
         def add(txn, *args):
-            logging.info("Adding author %s" % user)
+            logging.info("Adding author %s", user)
             txn.execute("INSERT OR IGNORE INTO author (name) values (?)",
                         [user])
-            logging.info("Adding quote: %s" % text)
+            logging.info("Adding quote: %s", text)
             txn.execute("INSERT INTO quote (quote, author)\
                             SELECT (?), rowid\
                             FROM author WHERE name = (?);",
@@ -191,14 +202,14 @@ def addquote(user, channel, text):
 def delquote(user, channel, text):
     """Delete a quote with a specified number"""
     if text:
-        logging.debug("delquote: %s" % text)
+        logging.debug("delquote: %s", text)
 
         def interaction(txn, *args):
-            logging.debug("Deleting quote %s" % text)
+            logging.debug("Deleting quote %s", text)
             txn.execute("DELETE FROM quote WHERE rowid = (?)", [text])
             txn.execute("SELECT changes()")
             res = txn.fetchone()
-            logging.debug("%s changes" % res)
+            logging.debug("%s changes", res)
             return int(res[0])
 
         def callback(changes):
@@ -228,7 +239,7 @@ def randomquote(user, channel, text):
     LIMIT 1;", [], callback)
 
 
-@command(aliases=["qsearch"])
+@command(aliases=["qsearch"], max_concurrency=2, max_queue=8)
 def searchquote(user, channel, text):
     """Search for a quote"""
     def callback(quotes):
@@ -241,7 +252,7 @@ def searchquote(user, channel, text):
             for quote in quotes:
                 _send_quote_to_channel(channel, quote)
 
-    run_query(
+    return run_query(
         "SELECT rowid, quote FROM quote WHERE quote LIKE (?)",
         ["".join(("%", text, "%"))],
         callback
@@ -286,7 +297,7 @@ def _like_impl(user, channel, text, votevalue):
     quotenumber = int(text)
 
     def interaction(txn, *args):
-        logging.debug("Adding 1 vote for %i by %s" % (quotenumber, user))
+        logging.debug("Adding 1 vote for %i by %s", quotenumber, user)
         txn.execute("""INSERT OR IGNORE INTO voter (name) VALUES (?);""",
                     [user])
         txn.execute("""INSERT OR REPLACE INTO vote (vote, quote, voter)
@@ -294,7 +305,7 @@ def _like_impl(user, channel, text, votevalue):
                         FROM voter
                         WHERE voter.name = ?;""",
                     [votevalue, quotenumber, user])
-        logging.debug("Added 1 vote for %i by %s" % (quotenumber, user))
+        logging.debug("Added 1 vote for %i by %s", quotenumber, user)
         msg(channel, "%s: Your vote for quote #%i has been accepted!"
             % (user, quotenumber))
 
@@ -32,8 +32,13 @@ __all__ = ()
 
 DEFAULT_OPTIONS = {"port": 9000}
 
+#: init starts a server, which has to listen before anything is called
+LAZY = False
+
 _CONNECTIONS = []
 
+_port = None
+
 
 class LalaWebSocketProtocol(WebSocketServerProtocol):
     def onConnect(self, request):  # noqa: N802
@@ -73,8 +78,16 @@ def push(user, channel, text, match_obj):
 
 
 def init():
+    global _port
     factory = WebSocketServerFactory()
     factory.protocol = LalaWebSocketProtocol
     port = lala.config.get_int("port")
     logging.info("Starting websocket server on port %d", port)
-    reactor.listenTCP(port, factory)
+    _port = reactor.listenTCP(port, factory)
+
+
+def teardown():
+    for connection in list(_CONNECTIONS):
+        connection.sendClose()
+    if _port is not None:
+        return _port.stopListening()
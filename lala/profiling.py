@@ -0,0 +1,198 @@
+"""Profiling the running bot
+
+A profiling session either runs :mod:`cProfile` on the reactor thread
+(``cprofile``) or samples the stack of the reactor thread from a separate
+thread every :data:`SAMPLE_INTERVAL` seconds (``sampling``), which has a much
+lower overhead. Only one session can run at a time and it's stopped after a
+number of seconds at the latest.
+
+The results are written to the ``profile_dir`` of the "base" section, as a
+:mod:`pstats` file or as collapsed stacks that can be turned into flame graphs,
+and summarized as the functions the most time was spent in.
+"""
+import cProfile
+import lala.config
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+from collections import Counter
+from twisted.internet import reactor
+
+MODES = ("cprofile", "sampling")
+
+#: The longest a session may run, in seconds
+MAX_SECONDS = 600
+
+#: Seconds between two samples of the sampling profiler
+SAMPLE_INTERVAL = 0.005
+
+_SESSION = None
+
+
+class ProfilingError(Exception):
+    """Raised when starting a session while another one is running or when
+    stopping one while none is running."""
+
+
+class CProfileSession(object):
+    """Profiles the reactor thread with :mod:`cProfile`."""
+    extension = "pstats"
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def write(self, path):
+        self.profile.dump_stats(path)
+
+    def summary(self, count):
+        stats = pstats.Stats(self.profile).stats
+        top = sorted(stats.items(), key=lambda item: item[1][2],
+                     reverse=True)[:count]
+        return ["%s (%s:%i): %.1f ms, %.1f ms cumulative, %i calls"
+                % (func, os.path.basename(filename), line, tottime * 1000,
+                   cumtime * 1000, calls)
+                for (filename, line, func), (_, calls, tottime, cumtime, _)
+                in top]
+
+
+def _frame_name(frame):
+    return "%s:%s" % (frame.f_globals.get("__name__", "?"),
+                      frame.f_code.co_name)
+
+
+class SamplingSession(object):
+    """Samples the stack of the reactor thread from another thread."""
+    extension = "collapsed"
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.thread_id = None
+        #: Counts the collapsed stacks, the outermost frame first
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self._thread = threading.Thread(target=self._run,
+                                        name="lala-profiler")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        names = []
+        while frame is not None:
+            names.append(_frame_name(frame))
+            frame = frame.f_back
+        if names:
+            self.stacks[";".join(reversed(names))] += 1
+
+    def write(self, path):
+        with open(path, "w") as fp:
+            for stack, samples in self.stacks.most_common():
+                fp.write("%s %i\n" % (stack, samples))
+
+    def summary(self, count):
+        total = sum(self.stacks.values())
+        functions = Counter()
+        for stack, samples in self.stacks.items():
+            functions[stack.rsplit(";", 1)[-1]] += samples
+        return ["%s: %.1f%% of %i samples"
+                % (function, 100.0 * samples / total, total)
+                for function, samples in functions.most_common(count)]
+
+
+class _Session(object):
+    def __init__(self, profiler, mode, seconds, on_stop):
+        self.profiler = profiler
+        self.mode = mode
+        self.on_stop = on_stop
+        self.started = time.time()
+        self.timer = reactor.callLater(seconds, _stop_session, self)
+
+
+def start(mode, seconds, on_stop):
+    """Starts a profiling session. Has to be called from the reactor thread.
+
+    :param str mode: One of :data:`MODES`
+    :param int seconds: Seconds after which the session is stopped, at most
+                        :data:`MAX_SECONDS`
+    :param on_stop: Called with the path of the written file and the summary
+                    once the session is stopped
+    :raises ProfilingError: If a session is already running
+    """
+    global _SESSION
+    if _SESSION is not None:
+        raise ProfilingError("A %s session is already running"
+                             % _SESSION.mode)
+    if mode == "cprofile":
+        profiler = CProfileSession()
+    elif mode == "sampling":
+        profiler = SamplingSession()
+    else:
+        raise ValueError("Unknown profiling mode %s" % mode)
+    seconds = min(seconds, MAX_SECONDS)
+    logging.info("Starting a %s profiling session for %i seconds", mode,
+                 seconds)
+    _SESSION = _Session(profiler, mode, seconds, on_stop)
+    profiler.start()
+
+
+def stop():
+    """Stops the running profiling session.
+
+    :raises ProfilingError: If no session is running
+    """
+    if _SESSION is None:
+        raise ProfilingError("No profiling session is running")
+    _SESSION.timer.cancel()
+    _stop_session(_SESSION)
+
+
+def running():
+    """Returns whether a profiling session is running.
+
+    :rtype: bool
+    """
+    return _SESSION is not None
+
+
+def _stop_session(session):
+    global _SESSION
+    _SESSION = None
+    profiler = session.profiler
+    profiler.stop()
+    directory = os.path.expanduser(lala.config._get("base", "profile_dir"))
+    path = os.path.join(directory, "%s-%s.%s" % (
+        session.mode, time.strftime("%Y%m%d-%H%M%S",
+                                    time.localtime(session.started)),
+        profiler.extension))
+    try:
+        os.makedirs(directory, exist_ok=True)
+        profiler.write(path)
+    except EnvironmentError:
+        logging.exception("Writing the profile to %s failed", path)
+        path = None
+    else:
+        logging.info("Wrote the profile to %s", path)
+    session.on_stop(path, profiler.summary(
+        int(lala.config._get("base", "profile_top"))))
@@ -0,0 +1,208 @@
+"""Token bucket rate limits for commands
+
+Limits are given as ``<calls>/<seconds>``: up to ``calls`` commands are
+allowed at once, after which one more is allowed every ``seconds / calls``
+seconds. They apply
+
+- to all commands of a user (``user_rate_limit`` in the "base" section),
+- to all commands in a channel (``channel_rate_limit``) and
+- to each user's calls of a command and its aliases (the ``rate_limit``
+  option of :class:`lala.util.command`, which ``command_rate_limits`` can
+  override with entries like ``decide_real_hard:3/60`` naming the command).
+
+Commands exceeding any of the limits are dropped before the plugin is called
+and don't count towards the others. The user is warned once until a command
+is allowed again.
+"""
+import lala.config
+import lala.util
+import logging
+import time
+
+from collections import Counter, OrderedDict
+
+#: Counts the dropped commands per (command, scope) pair
+_drops = Counter()
+
+#: Maps scopes to (limit, :class:`RateLimiter`) tuples
+_limiters = {}
+
+_now = time.monotonic
+
+
+class _Bucket(object):
+    __slots__ = ("tokens", "updated", "warned")
+
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.warned = False
+
+
+class RateLimiter(object):
+    """Keeps a token bucket per key.
+
+    Buckets that have not been used for ``period`` seconds are full again and
+    are therefore removed, so memory use only depends on the number of keys
+    that were active recently.
+
+    :param int calls: The size of the buckets
+    :param float period: Seconds in which an empty bucket is refilled
+    """
+    def __init__(self, calls, period, clock=None):
+        self.calls = calls
+        self.period = period
+        self.rate = calls / period
+        self.clock = clock or _now
+        # Ordered by the time of the last update, the oldest first
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _evict(self, now):
+        buckets = self._buckets
+        while buckets:
+            key, bucket = next(iter(buckets.items()))
+            if now - bucket.updated < self.period:
+                break
+            del buckets[key]
+
+    def _bucket(self, key):
+        now = self.clock()
+        self._evict(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.calls, now)
+        else:
+            bucket.tokens = min(self.calls,
+                                bucket.tokens +
+                                (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def allow(self, key):
+        """Takes a token from the bucket of ``key``.
+
+        :rtype: bool
+        :return: Whether there was a token
+        """
+        if self.available(key):
+            self.take(key)
+            return True
+        return False
+
+    def available(self, key):
+        """Returns whether the bucket of ``key`` has a token without taking
+        it.
+
+        :rtype: bool
+        """
+        return self._bucket(key).tokens >= 1
+
+    def take(self, key):
+        """Takes a token from the bucket of ``key``, which
+        :meth:`available` has to have confirmed."""
+        bucket = self._bucket(key)
+        bucket.tokens -= 1
+        bucket.warned = False
+
+    def warn(self, key):
+        """Returns whether ``key`` should be warned about being throttled,
+        which is only the case once until :meth:`allow` returns True again.
+
+        :rtype: bool
+        """
+        bucket = self._buckets.get(key)
+        if bucket is None or bucket.warned:
+            return False
+        bucket.warned = True
+        return True
+
+
+def parse_limit(limit):
+    """Parses a limit like ``5/60``.
+
+    :rtype: tuple
+    :return: The number of calls and the period in seconds or None if
+             ``limit`` is empty
+    """
+    if not limit:
+        return None
+    calls, period = limit.split("/")
+    calls, period = int(calls), float(period)
+    if calls < 1 or period <= 0:
+        raise ValueError("Invalid rate limit %s" % limit)
+    return calls, period
+
+
+def _get_limiter(scope, limit):
+    """Returns the :class:`RateLimiter` of ``scope`` for the limit ``limit``,
+    replacing the old one if the limit has changed."""
+    current = _limiters.get(scope)
+    if current is not None and current[0] == limit:
+        return current[1]
+    try:
+        parsed = parse_limit(limit)
+    except ValueError:
+        logging.error("Ignoring the invalid rate limit %r for %s", limit,
+                      scope)
+        parsed = None
+    limiter = RateLimiter(*parsed) if parsed is not None else None
+    _limiters[scope] = (limit, limiter)
+    return limiter
+
+
+def _command_limit(command, func):
+    overrides = lala.config._get("base", "command_rate_limits")
+    for override in overrides.split(lala.config._LIST_SEPARATOR):
+        trigger, _, limit = override.strip().partition(":")
+        if trigger == command:
+            return limit.strip()
+    return func.rate_limit
+
+
+def allow(user, channel, command, func):
+    """Checks whether ``user`` may call ``command`` in ``channel`` and warns
+    them if they may not. A token is only taken from the buckets if all
+    limits allow the call.
+
+    :param command: The trigger the command has been called with, which may
+                    be an alias
+    :param func: The :class:`lala.pluginmanager.PluginFunc` of ``command``
+    :rtype: bool
+    """
+    # Aliases share the limit of their command
+    command = func.trigger or command
+    checks = (("user", lala.config._get("base", "user_rate_limit"), user),
+              ("channel", lala.config._get("base", "channel_rate_limit"),
+               channel),
+              ("command:%s" % command, _command_limit(command, func), user))
+    limited = []
+    for scope, limit, key in checks:
+        limiter = _get_limiter(scope, limit)
+        if limiter is None:
+            continue
+        if not limiter.available(key):
+            _drops[(command, scope.partition(":")[0])] += 1
+            logging.info("Dropping %s by %s in %s, the %s limit is exceeded",
+                         command, user, channel, scope)
+            if limiter.warn(key):
+                lala.util.msg(channel, "%s: you're using commands too often, "
+                              "please slow down" % user)
+            return False
+        limited.append((limiter, key))
+    for limiter, key in limited:
+        limiter.take(key)
+    return True
+
+
+def drop_statistics():
+    """Returns a dict mapping commands to dicts mapping the scopes ``user``,
+    ``channel`` and ``command`` to the number of times the command has been
+    dropped because of the limit of that scope."""
+    stats = {}
+    for (command, scope), count in _drops.items():
+        stats.setdefault(command, {})[scope] = count
+    return stats
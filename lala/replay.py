@@ -0,0 +1,295 @@
+"""Replaying captured traffic
+
+Feeds the lines captured by :mod:`lala.capture` into a bot, either with the
+original timing (optionally sped up) or as fast as possible, and reports how
+fast the bot handled them and how long it took to answer::
+
+    python -m lala.replay [--config FILE] [--plugins PLUGINS] [--fast]
+                          [--speed FACTOR] [--line-rate SECONDS]
+                          [--drain SECONDS] [--keep] CAPTURE [CAPTURE ...]
+
+The bot runs with a copy of the config in a temporary directory: files and
+directories configured for the base section and for the plugins (options
+ending in ``_path``, ``_file``, ``_folder``, ``_dir`` or ``_directory``),
+including their defaults, are copied there and the copies are used instead,
+ports are replaced by random ones, capturing is disabled and no nickserv
+password is sent. Lines sent by the bot are counted and discarded.
+"""
+import argparse
+import lala.capture
+import lala.config as config
+import lala.latency
+import lala.logqueue
+import os
+import shutil
+import sys
+import tempfile
+
+from six.moves import configparser
+from twisted.internet import defer, reactor
+from twisted.internet.testing import StringTransport
+
+#: Options of the "base" section pointing to files or directories the bot
+#: writes to
+_BASE_PATHS = ("log_folder", "log_file", "plugin_manifest", "profile_dir")
+
+#: Suffixes of plugin options pointing to files or directories
+_PATH_SUFFIXES = ("_path", "_file", "_folder", "_dir", "_directory")
+
+
+def _sandbox_path(value, directory, name):
+    """Copies the file or directory ``value`` to ``directory`` as ``name`` if
+    it exists and returns the path of the copy."""
+    source = os.path.expanduser(value)
+    if source.startswith(directory + os.sep):
+        return source
+    target = os.path.join(directory, name)
+    if os.path.isdir(source):
+        shutil.copytree(source, target)
+    elif os.path.isfile(source):
+        shutil.copy2(source, target)
+    return target
+
+
+def _sandbox_section(cfg, section, directory):
+    """Returns a dict mapping the ports and paths of ``section`` in ``cfg``
+    to their sandboxed values."""
+    replacements = {}
+    for option, value in cfg.items(section):
+        if option == "port":
+            replacement = "0"
+        elif option.endswith(_PATH_SUFFIXES) and value:
+            replacement = _sandbox_path(value, directory,
+                                        "%s-%s" % (section, option))
+        else:
+            continue
+        if replacement != value:
+            replacements[option] = replacement
+    return replacements
+
+
+def sandbox_config(source, directory, plugins=None):
+    """Writes a sandboxed copy of the config file ``source`` to
+    ``directory``.
+
+    The defaults of the plugins are not known before they are loaded, see
+    :func:`sandbox_defaults`.
+
+    :param source: The path of the config file or None to start with an empty
+                   one
+    :param plugins: Overrides the enabled plugins
+    :return: The path of the copy
+    """
+    cfg = configparser.RawConfigParser()
+    if source is not None and not cfg.read(source):
+        raise IOError("Unable to read %s" % source)
+    if not cfg.has_section("base"):
+        cfg.add_section("base")
+    if plugins is not None:
+        cfg.set("base", "plugins", plugins)
+    if not cfg.has_option("base", "nick"):
+        cfg.set("base", "nick", "lala")
+
+    for option in _BASE_PATHS:
+        if cfg.has_option("base", option):
+            path = _sandbox_path(cfg.get("base", option), directory, option)
+        else:
+            path = os.path.join(directory, option)
+        cfg.set("base", option, path)
+        # Options missing in the plugins' sections fall back to the defaults
+        # of the base section, see lala.config._initialize
+        cfg.set(configparser.DEFAULTSECT, option, path)
+    cfg.set("base", "capture_file", "")
+    cfg.remove_option("base", "nickserv_password")
+
+    for section in cfg.sections():
+        if section != "base":
+            for option, value in _sandbox_section(cfg, section,
+                                                  directory).items():
+                cfg.set(section, option, value)
+
+    path = os.path.join(directory, "config")
+    with open(path, "w") as fp:
+        cfg.write(fp)
+    return path
+
+
+def sandbox_defaults(directory):
+    """Makes :func:`lala.config._set_default_options` sandbox the defaults of
+    every plugin that is loaded from now on, before its init function
+    runs."""
+    set_default_options = config._set_default_options
+
+    def sandboxed(plugin, options):
+        set_default_options(plugin, options)
+        for option, value in _sandbox_section(config._CFG, plugin,
+                                              directory).items():
+            config._set(plugin, option, value)
+
+    config._set_default_options = sandboxed
+
+
+class _NullTransport(StringTransport):
+    """Counts and discards the lines sent by the bot."""
+    def __init__(self):
+        StringTransport.__init__(self)
+        self.lines = 0
+
+    def write(self, data):
+        self.lines += data.count(b"\n")
+
+
+class Replayer(object):
+    """Feeds ``lines``, (seconds, line) tuples as returned by
+    :func:`lala.capture.read`, into ``bot``.
+
+    :param float speed: How many times faster than captured the lines are
+                        fed, None feeds them as fast as possible
+    :param int batch: The number of lines fed at once as fast as possible
+                      before the reactor gets to run
+    """
+    def __init__(self, bot, lines, speed=None, batch=100, clock=reactor):
+        self.bot = bot
+        self.lines = iter(lines)
+        self.speed = speed
+        self.batch = batch
+        self.clock = clock
+        #: The number of lines fed
+        self.fed = 0
+        #: The most seconds a line was fed later than it was due
+        self.max_lag = 0.0
+        self.started = None
+        self.finished = None
+        self._next = None
+        self._done = defer.Deferred()
+
+    def start(self):
+        """Starts feeding the lines.
+
+        :return: A Deferred firing once all lines have been fed
+        """
+        self.started = self.clock.seconds()
+        self._next = next(self.lines, None)
+        self.clock.callLater(0, self._feed)
+        return self._done
+
+    def _feed_line(self, line):
+        self.bot.lineReceived(line)
+        self.fed += 1
+
+    def _feed(self):
+        if self.speed is None:
+            for _ in range(self.batch):
+                if self._next is None:
+                    break
+                self._feed_line(self._next[1])
+                self._next = next(self.lines, None)
+        else:
+            now = self.clock.seconds() - self.started
+            while self._next is not None:
+                due = self._next[0] / self.speed
+                if due > now:
+                    break
+                self.max_lag = max(self.max_lag, now - due)
+                self._feed_line(self._next[1])
+                self._next = next(self.lines, None)
+        if self._next is None:
+            self.finished = self.clock.seconds()
+            self._done.callback(self)
+        elif self.speed is None:
+            self.clock.callLater(0, self._feed)
+        else:
+            due = self._next[0] / self.speed
+            self.clock.callLater(
+                max(0, due - (self.clock.seconds() - self.started)),
+                self._feed)
+
+
+def _percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1,
+                      max(0, int(round(percent / 100.0 * len(values))) - 1))]
+
+
+def _milliseconds(seconds):
+    return "-" if seconds is None else "%.1f ms" % (seconds * 1000)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("captures", nargs="+", metavar="CAPTURE",
+                        help="Captured files, rotated ones in any order")
+    parser.add_argument("--config", help="The config file to sandbox")
+    parser.add_argument("--plugins", help="Overrides the enabled plugins")
+    parser.add_argument("--fast", action="store_true",
+                        help="Feed the lines as fast as possible")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Feed the lines this many times faster than "
+                             "they were captured")
+    parser.add_argument("--line-rate", type=float,
+                        help="Seconds between two lines the bot sends, 0 for "
+                             "no limit. Defaults to the bot's")
+    parser.add_argument("--drain", type=float, default=2.0,
+                        help="Seconds to wait for answers after the last line")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the sandbox directory")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="lala-replay-")
+    try:
+        return _run(args, directory)
+    finally:
+        if args.keep:
+            sys.stdout.write("The sandbox is in %s\n" % directory)
+        else:
+            shutil.rmtree(directory)
+
+
+def _run(args, directory):
+    lala.logqueue.log_to_file(os.path.join(directory, "lala.log"))
+    configfile = sandbox_config(args.config, directory, args.plugins)
+    config._initialize(configfile)
+    sandbox_defaults(directory)
+
+    from lala.factory import LalaFactory
+
+    latencies = []
+
+    def observe(trigger, latency, first):
+        if first:
+            latencies.append(latency)
+
+    lala.latency.add_observer(observe)
+    factory = LalaFactory(config._get("base", "channels"),
+                          config._get("base", "nick"))
+    bot = factory.buildProtocol(None)
+    if args.line_rate is not None:
+        bot.lineRate = args.line_rate or None
+    transport = _NullTransport()
+    bot.makeConnection(transport)
+
+    replayer = Replayer(bot, lala.capture.read(args.captures),
+                        speed=None if args.fast else args.speed)
+    d = replayer.start()
+    d.addCallback(lambda _: reactor.callLater(args.drain, reactor.stop))
+    reactor.run()
+
+    duration = (replayer.finished or reactor.seconds()) - replayer.started
+    write = sys.stdout.write
+    write("replayed:   %i lines in %.1f s, %.0f lines/s\n" % (
+        replayer.fed, duration, replayer.fed / duration if duration else 0))
+    if replayer.speed is not None:
+        write("lag:        lines were fed up to %s late\n"
+              % _milliseconds(replayer.max_lag))
+    write("sent:       %i lines, %i still queued\n"
+          % (transport.lines, len(bot._queue or ())))
+    write("latency:    %i answers, p50 %s, p90 %s, p99 %s, max %s\n" % (
+        (len(latencies),) + tuple(_milliseconds(_percentile(latencies, p))
+                                  for p in (50, 90, 99, 100))))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,467 @@
+"""Per-channel chat log segments with a time index
+
+The ``log`` plugin writes the messages of every channel to a directory of its
+own in the ``log_folder``, one segment per day::
+
+    <log_folder>/#channel/2026-10-19.log
+    <log_folder>/#channel/2026-10-19.log.idx
+
+Segments are appended to only. Every line starts with the local time as
+``YYYY-MM-DDTHH:MM:SS``. The index next to a segment records the time and
+the byte offset of the first line of every block of about
+:data:`BLOCK_SIZE` bytes, as :data:`_ENTRY` structs. :func:`since` finds the
+block to start reading at with a binary search on the index file, reading
+O(log n) entries however large the segment is.
+
+Finished segments are compressed by :func:`compress`. Every
+:data:`COMPRESSED_BLOCK_SIZE` bytes become a gzip member of their own and the
+index of the ``.log.gz`` file points to the members instead. Concatenated
+gzip members are a valid gzip file, so it can be read from any indexed offset
+as well as with ``zcat``.
+"""
+import bisect
+import datetime
+import gzip
+import io
+import logging
+import os
+import struct
+
+from time import perf_counter
+from urllib.parse import quote
+
+#: Bytes of lines between two index entries
+BLOCK_SIZE = 4096
+
+#: Bytes of lines per gzip member of a compressed segment
+COMPRESSED_BLOCK_SIZE = 65536
+
+#: An index entry, the time of the block's first line and its offset
+_ENTRY = struct.Struct("<dQ")
+
+_SUFFIX = ".log"
+_GZIP_SUFFIX = ".gz"
+_INDEX_SUFFIX = ".idx"
+_TMP_SUFFIX = ".tmp"
+
+#: The length of the time at the start of every line
+_STAMP_LENGTH = 19
+
+
+def _stamp(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).strftime(
+        "%Y-%m-%dT%H:%M:%S")
+
+
+def channel_directory(folder, channel):
+    """Returns the directory of the segments of ``channel``. Channel names
+    are case insensitive."""
+    name = quote(channel.lower(), safe="#&+!-_")
+    if name.startswith("."):
+        name = "%2E" + name[1:]
+    return os.path.join(folder, name)
+
+
+class _Segment(object):
+    def __init__(self, path):
+        self.path = path
+        self.data = open(path, "ab")
+        self.index = open(path + _INDEX_SUFFIX, "a+b")
+        self.position = self.data.tell()
+        self.indexed = None
+        self.last_time = float("-inf")
+        if self.index.tell() >= _ENTRY.size:
+            self.index.seek(-_ENTRY.size, os.SEEK_END)
+            self.last_time, self.indexed = _ENTRY.unpack(
+                self.index.read(_ENTRY.size))
+
+    def append(self, timestamp, line):
+        data = line.encode("utf-8")
+        if self.indexed is None or self.position - self.indexed >= BLOCK_SIZE:
+            # The binary search needs ascending times, even if the clock
+            # went backwards
+            self.last_time = max(timestamp, self.last_time)
+            self.index.write(_ENTRY.pack(self.last_time, self.position))
+            self.indexed = self.position
+        self.data.write(data)
+        self.position += len(data)
+
+    def flush(self):
+        # An index entry never points past the data
+        self.data.flush()
+        self.index.flush()
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+class Writer(object):
+    """Appends lines to the segments of the channels in ``folder``.
+
+    :param on_finished: Called with the path of a segment once the lines of
+                        its channel go to the next day's segment
+    """
+    def __init__(self, folder, on_finished=None):
+        self.folder = folder
+        self.on_finished = on_finished
+        self._segments = {}
+
+    def write(self, channel, timestamp, line):
+        """Appends ``line`` to the segment of ``channel`` for the day of
+        ``timestamp``, prefixed with the time."""
+        stamp = _stamp(timestamp)
+        directory = channel_directory(self.folder, channel)
+        path = os.path.join(directory, stamp[:10] + _SUFFIX)
+        segment = self._segments.get(directory)
+        if segment is None or segment.path != path:
+            if segment is not None:
+                segment.close()
+                if self.on_finished is not None:
+                    self.on_finished(segment.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            segment = self._segments[directory] = _Segment(path)
+        segment.append(timestamp, "%s %s\n" % (stamp, line))
+
+    def flush(self):
+        for segment in self._segments.values():
+            segment.flush()
+
+    def close(self):
+        for segment in self._segments.values():
+            segment.close()
+        self._segments.clear()
+
+
+def segments(folder, channel):
+    """Returns the segments of ``channel``, the oldest first, as (day, path)
+    tuples. While a segment is being compressed, the uncompressed one is
+    returned."""
+    directory = channel_directory(folder, channel)
+    try:
+        filenames = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    days = {}
+    for filename in filenames:
+        if filename.endswith(_SUFFIX):
+            days[filename[:-len(_SUFFIX)]] = filename
+        elif filename.endswith(_SUFFIX + _GZIP_SUFFIX):
+            days.setdefault(filename[:-len(_SUFFIX + _GZIP_SUFFIX)],
+                            filename)
+    return [(day, os.path.join(directory, days[day])) for day in sorted(days)]
+
+
+def finished(folder, today=None):
+    """Returns the uncompressed segments of all channels in ``folder`` that
+    are older than ``today``, a date string like the segment names, which
+    defaults to the current day."""
+    if today is None:
+        today = datetime.date.today().isoformat()
+    paths = []
+    if not os.path.isdir(folder):
+        return paths
+    for name in sorted(os.listdir(folder)):
+        directory = os.path.join(folder, name)
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(_SUFFIX) and filename[:-len(_SUFFIX)] < today:
+                paths.append(os.path.join(directory, filename))
+    return paths
+
+
+def discard(path):
+    """Removes the segment ``path``, compressed or not, and its index."""
+    if path.endswith(_GZIP_SUFFIX):
+        path = path[:-len(_GZIP_SUFFIX)]
+    for candidate in (path, path + _GZIP_SUFFIX):
+        for leftover in (candidate, candidate + _INDEX_SUFFIX):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+
+def truncate(path, size, index_size):
+    """Removes the lines appended to the segment ``path`` since it had
+    ``size`` bytes and its index ``index_size`` bytes. If it has been
+    compressed since, it's decompressed again."""
+    target = path + _GZIP_SUFFIX
+    if not os.path.exists(path):
+        _decompress(path, size)
+    else:
+        with open(path, "r+b") as fp:
+            fp.truncate(size)
+        if os.path.exists(path + _INDEX_SUFFIX):
+            with open(path + _INDEX_SUFFIX, "r+b") as fp:
+                fp.truncate(index_size)
+    # Compressed with the appended lines
+    for leftover in (target, target + _INDEX_SUFFIX):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def _decompress(path, size):
+    """Writes the first ``size`` bytes of the compressed segment ``path``
+    to a segment with a new index."""
+    with gzip.open(path + _GZIP_SUFFIX, "rb") as fp:
+        data = fp.read(size)
+    segment = _Segment(path)
+    try:
+        for line in data.decode("utf-8", "replace").splitlines(True):
+            segment.append(datetime.datetime.strptime(
+                line[:_STAMP_LENGTH], "%Y-%m-%dT%H:%M:%S").timestamp(), line)
+    finally:
+        segment.close()
+
+
+def expire(folder, days, today=None):
+    """Removes the segments of all channels in ``folder`` that are more than
+    ``days`` days older than ``today``, a :class:`datetime.date`. 0 keeps all
+    segments."""
+    if days <= 0 or not os.path.isdir(folder):
+        return
+    if today is None:
+        today = datetime.date.today()
+    oldest = (today - datetime.timedelta(days=days)).isoformat()
+    for name in os.listdir(folder):
+        directory = os.path.join(folder, name)
+        if not os.path.isdir(directory):
+            continue
+        for filename in os.listdir(directory):
+            if filename[:10] < oldest and _SUFFIX in filename:
+                os.remove(os.path.join(directory, filename))
+
+
+class _Index(object):
+    """The entries of an index file, read on demand."""
+    def __init__(self, path):
+        self.fp = open(path + _INDEX_SUFFIX, "rb")
+        self.fp.seek(0, os.SEEK_END)
+        self.length = self.fp.tell() // _ENTRY.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        self.fp.seek(i * _ENTRY.size)
+        return _ENTRY.unpack(self.fp.read(_ENTRY.size))
+
+    def close(self):
+        self.fp.close()
+
+
+class _Times(object):
+    """The times of ``index``'s entries as a sequence for :mod:`bisect`."""
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.index[i][0]
+
+
+def _offset(path, timestamp):
+    """Returns the offset of the last block in the segment ``path`` starting
+    before ``timestamp``."""
+    try:
+        index = _Index(path)
+    except FileNotFoundError:
+        return 0
+    try:
+        i = bisect.bisect_right(_Times(index), timestamp) - 1
+        return index[i][1] if i >= 0 else 0
+    finally:
+        index.close()
+
+
+def _lines(path, offset=0):
+    """Returns an iterator over the lines of the segment ``path`` from
+    ``offset`` on. The segment is opened right away.
+
+    :raises FileNotFoundError: If it doesn't exist
+    """
+    raw = open(path, "rb")
+    raw.seek(offset)
+    return _decoded(raw, path.endswith(_GZIP_SUFFIX))
+
+
+def _decoded(raw, compressed):
+    with raw:
+        fp = gzip.GzipFile(fileobj=raw) if compressed else raw
+        for line in fp:
+            yield line.decode("utf-8", "replace").rstrip("\n")
+
+
+def _read(read, path, *args):
+    """Returns ``read(path, *args)`` for the segment ``path``. If
+    :func:`compress` has removed it since the directory was listed, the
+    compressed segment is read instead. None if neither exists anymore, like
+    after :func:`expire`."""
+    for candidate in (path, path + _GZIP_SUFFIX):
+        try:
+            return read(candidate, *args)
+        except FileNotFoundError:
+            if candidate.endswith(_GZIP_SUFFIX):
+                return None
+    return None
+
+
+def _lines_since(path, timestamp):
+    """Returns an iterator over the lines of the segment ``path`` from the
+    last block starting before ``timestamp`` on, from its start if it's
+    None."""
+    return _lines(path, 0 if timestamp is None else _offset(path, timestamp))
+
+
+def since(folder, channel, timestamp, limit):
+    """Returns up to ``limit`` lines of ``channel`` from ``timestamp`` on."""
+    stamp = _stamp(timestamp)
+    result = []
+    for day, path in segments(folder, channel):
+        if day < stamp[:10]:
+            continue
+        lines = _read(_lines_since, path,
+                      timestamp if day == stamp[:10] else None)
+        for line in lines or ():
+            if line[:_STAMP_LENGTH] < stamp:
+                continue
+            result.append(line)
+            if len(result) >= limit:
+                lines.close()
+                return result
+    return result
+
+
+def _block(path, start, end):
+    """Returns the lines of the segment ``path`` between the offsets
+    ``start`` and ``end``, which may be None for the end of the file."""
+    with open(path, "rb") as fp:
+        fp.seek(start)
+        data = fp.read() if end is None else fp.read(end - start)
+    if path.endswith(_GZIP_SUFFIX):
+        data = gzip.decompress(data)
+    return data.decode("utf-8", "replace").splitlines()
+
+
+def _offsets_backwards(path):
+    """Yields the offsets of the blocks of the segment ``path``, the last
+    one first."""
+    try:
+        index = _Index(path)
+    except FileNotFoundError:
+        yield 0
+        return
+    try:
+        offset = None
+        for i in range(len(index) - 1, -1, -1):
+            offset = index[i][1]
+            yield offset
+    finally:
+        index.close()
+    # Lines written before a crash might not have been indexed
+    if offset != 0:
+        yield 0
+
+
+def _last_lines(path, count):
+    """Returns at least the last ``count`` lines of the segment ``path``,
+    all if it has fewer, reading blocks from its end."""
+    result = []
+    end = None
+    for start in _offsets_backwards(path):
+        result[:0] = _block(path, start, end)
+        if len(result) >= count:
+            break
+        end = start
+    return result
+
+
+def last(folder, channel, count):
+    """Returns the last ``count`` lines of ``channel``, reading only as many
+    blocks from the end of the newest segments as needed."""
+    result = []
+    if count <= 0:
+        return result
+    for day, path in reversed(segments(folder, channel)):
+        result[:0] = _read(_last_lines, path, count - len(result)) or ()
+        if len(result) >= count:
+            return result[-count:]
+    return result
+
+
+def _member(data):
+    """Returns ``data`` as a gzip member. Its mtime is 0, so compressing a
+    segment twice gives the same file."""
+    buf = io.BytesIO()
+    # gzip.compress() only takes an mtime from Python 3.8 on
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6,
+                       mtime=0) as fp:
+        fp.write(data)
+    return buf.getvalue()
+
+
+def compress(path):
+    """Compresses the finished segment ``path`` to ``path.gz`` with an index
+    pointing to its gzip members and removes it.
+
+    :rtype: tuple
+    :return: The size of the segment and of the compressed one
+    """
+    start = perf_counter()
+    target = path + _GZIP_SUFFIX
+    tmp = target + _TMP_SUFFIX
+    try:
+        index = _Index(path)
+    except FileNotFoundError:
+        entries = []
+    else:
+        try:
+            entries = [index[i] for i in range(len(index))]
+        finally:
+            index.close()
+    size = os.path.getsize(path)
+    # Lines written before a crash might not have been indexed, so the first
+    # member always starts at the beginning of the segment
+    if not entries or entries[0][1] != 0:
+        entries.insert(0, (float("-inf"), 0))
+    # Merges the blocks into members of about COMPRESSED_BLOCK_SIZE bytes
+    members = []
+    for timestamp, offset in entries:
+        if not members or offset - members[-1][1] >= COMPRESSED_BLOCK_SIZE:
+            members.append((timestamp, offset))
+    ends = [offset for _, offset in members[1:]] + [size]
+    tmp_index = target + _INDEX_SUFFIX + _TMP_SUFFIX
+    try:
+        read = 0
+        with open(path, "rb") as src, open(tmp, "wb") as dst:
+            with open(tmp_index, "wb") as idx:
+                for (timestamp, offset), end in zip(members, ends):
+                    src.seek(offset)
+                    data = src.read(end - offset)
+                    read += len(data)
+                    idx.write(_ENTRY.pack(timestamp, dst.tell()))
+                    dst.write(_member(data))
+        if read != size:
+            raise OSError("Compressed %i of the %i bytes of %s"
+                          % (read, size, path))
+        # The index has to be in place before the segment is
+        os.replace(tmp_index, target + _INDEX_SUFFIX)
+        os.replace(tmp, target)
+    except BaseException:
+        for leftover in (tmp, tmp_index):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        raise
+    compressed = os.path.getsize(target)
+    os.remove(path)
+    if os.path.exists(path + _INDEX_SUFFIX):
+        os.remove(path + _INDEX_SUFFIX)
+    logging.info("Compressed %s in %.2f s: %i -> %i bytes, %.1f:1",
+                 path, perf_counter() - start, size, compressed,
+                 size / max(compressed, 1))
+    return size, compressed
@@ -0,0 +1,243 @@
+"""The timeline of starting the bot
+
+:func:`start` is called first thing in :func:`lala.main.getService`. From
+then on, until all channels have been joined, the bot records when each
+phase of its startup began and ended, using monotonic time:
+
+- ``config``: reading the config file
+- ``modules``: importing the bot's modules, including Twisted
+- ``plugins``: importing all plugins, ``import`` and ``init`` per plugin.
+  ``init`` ends when the Deferred returned by the plugin's init function
+  fires, for example after the quotes plugin has created its tables.
+- ``workers``: starting the worker processes, see :mod:`lala.workers`
+- ``wait``: waiting for the init functions and the workers before
+  connecting, see the ``plugin_init_timeout`` option
+- ``connect``: from starting to connect until the connection has been made,
+  including ``dns``, the lookup of the server's address
+- ``registration``: from sending NICK and USER until the server welcomed the
+  bot
+- ``join`` per channel: until the server confirmed the join
+
+Once the last channel has been joined (or, without channels, the bot has
+been welcomed), the breakdown is logged and the timeline is available from
+:func:`timeline` and as metrics of the prometheus plugin. The startup after
+a reconnect is not traced.
+"""
+import logging
+import time
+
+from contextlib import contextmanager
+from twisted.internet import defer
+from twisted.internet.interfaces import IResolverSimple
+from zope.interface import implementer
+
+_now = time.monotonic
+
+#: The :class:`Trace` of the current or finished startup
+_trace = None
+
+
+class Phase(object):
+    """A phase of the startup. ``detail`` is the plugin or channel it
+    concerns, if any. ``start`` and ``end`` are seconds since the startup
+    began, ``end`` is None until the phase is over."""
+    __slots__ = ("name", "detail", "start", "end", "depth")
+
+    def __init__(self, name, detail, start, depth):
+        self.name = name
+        self.detail = detail
+        self.start = start
+        self.end = None
+        self.depth = depth
+
+    @property
+    def label(self):
+        if self.detail is None:
+            return self.name
+        return "%s %s" % (self.name, self.detail)
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Trace(object):
+    def __init__(self, start):
+        self.start = start
+        self.finished = None
+        self.phases = []
+        # Phases that are currently running in the calling code, the
+        # phases begun during them are shown nested
+        self.stack = []
+        self.resolver = None
+
+
+def start():
+    """Starts tracing the startup."""
+    global _trace
+    _trace = Trace(_now())
+
+
+def tracing():
+    """Returns whether the startup is being traced right now."""
+    return _trace is not None and _trace.finished is None
+
+
+def begin(name, detail=None):
+    """Records the beginning of the phase ``name`` if the startup is being
+    traced."""
+    if not tracing():
+        return None
+    phase = Phase(name, detail, _now() - _trace.start, len(_trace.stack))
+    _trace.phases.append(phase)
+    return phase
+
+
+def end(name, detail=None):
+    """Records the end of the most recent phase ``name`` concerning
+    ``detail`` that hasn't ended yet.
+
+    :return: Whether there was such a phase
+    """
+    if not tracing():
+        return False
+    # Servers don't necessarily answer with the channel name's case
+    key = _key(detail)
+    for phase in reversed(_trace.phases):
+        if (phase.end is None and phase.name == name and
+                _key(phase.detail) == key):
+            phase.end = _now() - _trace.start
+            return True
+    return False
+
+
+def _key(detail):
+    return detail.lower() if detail is not None else None
+
+
+def running(name):
+    """Returns the details of the phases ``name`` that haven't ended yet."""
+    if not tracing():
+        return []
+    return [phase.detail for phase in _trace.phases
+            if phase.name == name and phase.end is None]
+
+
+@contextmanager
+def phase(name, detail=None):
+    """Records the phase ``name`` for the duration of the ``with`` block."""
+    current = begin(name, detail)
+    if current is not None:
+        _trace.stack.append(current)
+    try:
+        yield
+    finally:
+        if current is not None:
+            _trace.stack.remove(current)
+            current.end = _now() - _trace.start
+
+
+def timed(name, detail, func, *args):
+    """Calls ``func`` with ``args`` as the phase ``name``, which ends when
+    the Deferred it returns fires.
+
+    :return: What ``func`` returned
+    """
+    current = begin(name, detail)
+    if current is None:
+        return func(*args)
+
+    def finish(result):
+        if current.end is None:
+            current.end = _now() - _trace.start
+        return result
+
+    _trace.stack.append(current)
+    try:
+        result = func(*args)
+    except BaseException:
+        finish(None)
+        raise
+    finally:
+        _trace.stack.remove(current)
+    if isinstance(result, defer.Deferred):
+        result.addBoth(finish)
+    else:
+        finish(None)
+    return result
+
+
+@implementer(IResolverSimple)
+class _TimingResolver(object):
+    """Records the lookups of ``resolver`` as the phase ``dns``."""
+    def __init__(self, resolver):
+        self.resolver = resolver
+
+    def getHostByName(self, name, timeout=(1, 3, 11, 45)):  # noqa: N802
+        def done(result):
+            end("dns", name)
+            return result
+
+        begin("dns", name)
+        return self.resolver.getHostByName(name, timeout).addBoth(done)
+
+
+def trace_resolver(reactor):
+    """Makes ``reactor`` record its host name lookups during the startup."""
+    if not tracing():
+        return
+    resolver = _TimingResolver(reactor.resolver)
+    # installResolver() would also replace the name resolver that endpoints
+    # use, reactor.resolve() only uses this one
+    reactor.resolver = resolver
+    _trace.resolver = (reactor, resolver)
+
+
+def finish():
+    """Ends tracing and logs the breakdown."""
+    if not tracing():
+        return
+    _trace.finished = _now() - _trace.start
+    if _trace.resolver is not None:
+        reactor, resolver = _trace.resolver
+        if reactor.resolver is resolver:
+            reactor.resolver = resolver.resolver
+        _trace.resolver = None
+    logging.info("\n".join(breakdown()))
+
+
+def timeline():
+    """Returns the phases of the startup sorted by their beginning.
+
+    :rtype: list of :class:`Phase`
+    """
+    if _trace is None:
+        return []
+    return list(_trace.phases)
+
+
+def total():
+    """Returns the seconds the startup took or None if it hasn't finished."""
+    if _trace is None:
+        return None
+    return _trace.finished
+
+
+def breakdown():
+    """Returns the timeline as lines of text, one per phase with its offset
+    from the start and its duration."""
+    if _trace is None:
+        return ["The startup hasn't been traced"]
+    duration = total()
+    if duration is None:
+        lines = ["The startup hasn't finished yet:"]
+    else:
+        lines = ["The startup took %.3f s:" % duration]
+    for phase in timeline():
+        lines.append("  %+9.3f s  %9s  %s%s" % (
+            phase.start,
+            "running" if phase.end is None else "%.3f s" % phase.duration,
+            "  " * phase.depth, phase.label))
+    return lines
@@ -0,0 +1,123 @@
+"""The thread pool running plugin callbacks registered with ``threaded=True``
+
+The pool is started the first time it's needed and stopped when the reactor
+shuts down. Its maximum size is the ``plugin_threads`` option of the "base"
+section.
+
+Plugins can make the statistics of their own thread pools available with
+:func:`watch`.
+
+:class:`twisted.python.threadpool.ThreadPool` doesn't tell how many callbacks
+wait for a thread, so :func:`run_in_thread` counts the callbacks it submits
+until they start. The pools lala doesn't submit to itself have no such count.
+"""
+import lala.config
+import logging
+import threading
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+_POOL = None
+
+#: Maps names to thread pools registered with :func:`watch`
+_WATCHED = {}
+
+#: The number of callbacks submitted by :func:`run_in_thread` that haven't
+#: started yet
+_QUEUED = 0
+_QUEUED_LOCK = threading.Lock()
+
+
+def _add_queued(count):
+    global _QUEUED
+    with _QUEUED_LOCK:
+        _QUEUED += count
+
+
+def _get_pool():
+    global _POOL
+    if _POOL is None:
+        size = int(lala.config._get("base", "plugin_threads"))
+        logging.info("Starting the plugin thread pool with %i threads", size)
+        _POOL = ThreadPool(minthreads=0, maxthreads=size, name="lala-plugins")
+        _POOL.start()
+        reactor.addSystemEventTrigger("during", "shutdown", _stop)
+    return _POOL
+
+
+def _stop():
+    global _POOL
+    if _POOL is not None:
+        _POOL.stop()
+        _POOL = None
+
+
+def run_in_thread(func, *args, **kwargs):
+    """Calls ``func`` with ``args`` and ``kwargs`` in the plugin thread pool.
+
+    :rtype: :class:`twisted.internet.defer.Deferred` firing with the return
+            value of ``func``
+    """
+    pool = _get_pool()
+
+    def started(*args, **kwargs):
+        _add_queued(-1)
+        return func(*args, **kwargs)
+
+    _add_queued(1)
+    return deferToThreadPool(reactor, pool, started, *args, **kwargs)
+
+
+def watch(name, pool):
+    """Includes the :class:`twisted.python.threadpool.ThreadPool` ``pool`` in
+    :func:`all_statistics` as ``name``."""
+    _WATCHED[name] = pool
+
+
+def unwatch(name):
+    """Removes a thread pool registered with :func:`watch`."""
+    _WATCHED.pop(name, None)
+
+
+def _pool_statistics(pool, queued=None):
+    size = pool.max
+    busy = len(pool.working)
+    return {"size": size,
+            "busy": busy,
+            "idle": len(pool.waiters),
+            "queued": queued,
+            "utilization": float(busy) / size if size else 0.0}
+
+
+def statistics():
+    """Returns a dict describing the current state of the thread pool:
+
+    - ``size``: the maximum number of threads
+    - ``busy``: the number of threads running a callback
+    - ``idle``: the number of started threads waiting for work
+    - ``queued``: the number of callbacks waiting for a thread
+    - ``utilization``: the fraction of ``size`` threads that are busy
+    """
+    if _POOL is not None:
+        return _pool_statistics(_POOL, _QUEUED)
+    return {"size": int(lala.config._get("base", "plugin_threads")),
+            "busy": 0,
+            "idle": 0,
+            "queued": 0,
+            "utilization": 0.0}
+
+
+def all_statistics():
+    """Returns a dict mapping names of thread pools to their
+    :func:`statistics`. Besides the plugin thread pool (``plugins``), it
+    contains the thread pool of the reactor (``reactor``) once that has been
+    started and all pools registered with :func:`watch`. Their ``queued``
+    is None, because lala doesn't submit their callbacks."""
+    stats = {"plugins": statistics()}
+    if reactor.threadpool is not None:
+        stats["reactor"] = _pool_statistics(reactor.threadpool)
+    for name, pool in _WATCHED.items():
+        stats[name] = _pool_statistics(pool)
+    return stats
@@ -1,6 +1,9 @@
 """Helpers to be used with plugins"""
 import lala.pluginmanager
 
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python import threadable
 from types import FunctionType
 try:
     from inspect import getfullargspec
@@ -41,6 +44,42 @@ class command(object):  # noqa: N801
             def give_me_the_one_ring(user, channel, text):
                 pass
 
+        Commands that block, for example by doing file I/O or lots of
+        computations, can be run in a thread pool by passing
+        ``threaded=True``. Their return value is then delivered through a
+        :class:`twisted.internet.defer.Deferred`::
+
+            @command(threaded=True)
+            def read_a_file(user, channel, text):
+                pass
+
+        ``max_concurrency`` limits the number of calls of a command whose
+        Deferreds have not fired yet. Up to ``max_queue`` further calls wait
+        for one of them to finish, any more are rejected with a message. With
+        the default ``max_queue`` of 0, no calls wait::
+
+            @command(max_concurrency=2, max_queue=5)
+            def fetch_a_website(user, channel, text):
+                pass
+
+        Commands can also be coroutine functions::
+
+            @command
+            async def slow_command(user, channel, text):
+                result = await some_deferred()
+                msg(channel, result)
+
+        Deferreds returned by a command are cancelled after ``timeout``
+        seconds, or after the ``command_timeout`` of the "base" section if
+        it's not given. 0 disables the timeout.
+
+        ``rate_limit`` limits how often each user can call the command, see
+        :mod:`lala.ratelimit`::
+
+            @command(rate_limit="3/60")
+            def expensive_command(user, channel, text):
+                pass
+
         .. versionadded:: 0.5
         If the function returns a :class:`twisted.internet.defer.Deferred` or a
         generator function that's generating them, an
@@ -51,9 +90,11 @@ class command(object):  # noqa: N801
         The third argument received by a command function used to include the
         name of the command itself. Since version 0.5 this is no longer the case.
     """  # noqa
-    def __init__(self, command=None, admin_only=False, aliases=None):
+    def __init__(self, command=None, admin_only=False, aliases=None,
+                 **options):
         self.admin_only = admin_only
         self.aliases = aliases
+        self.options = options
         if isinstance(command, FunctionType):
             # Used like
             # @command
@@ -91,13 +132,15 @@ class command(object):  # noqa: N801
         lala.pluginmanager.register_callback(self.cmd,
                                              self.func,
                                              self.admin_only,
-                                             self.aliases)
+                                             self.aliases,
+                                             **self.options)
 
 
 def on_join(f):
     """Decorator for functions reacting to joins
 
-    :param f: The function which should be called on joins."""
+    :param f: The function which should be called on joins. Can be a
+              coroutine function."""
     if _check_args(f, 2):
         lala.pluginmanager.register_join_callback(f)
     else:
@@ -115,15 +158,20 @@ class regex(object):  # noqa: N801
 
        :param regex: A :py:class:`re.RegexObject` or a string representing a
                      regular expression.
+       :param bool threaded: Whether to call the function in a thread pool,
+                             see :class:`command`.
+       :param timeout: Seconds after which Deferreds returned by the function
+                       are cancelled, see :class:`command`.
     """
-    def __init__(self, regex):
+    def __init__(self, regex, **options):
         if not hasattr(regex, "match") and isinstance(regex, string_types):
             regex = compile(regex)
         self.re = regex
+        self.options = options
 
     def __call__(self, func):
         if _check_args(func, 4):
-            lala.pluginmanager.register_regex(self.re, func)
+            lala.pluginmanager.register_regex(self.re, func, **self.options)
         else:
             raise TypeError(
                 "A regex callback function should take exactly 4 arguments")
@@ -136,7 +184,13 @@ def msg(target, message, log=True):
     :param message: One or more messages to send
     :type message: str or [str]
     :param bool log: Whether or not to log the message
+
+    This can be called from threads other than the reactor thread, the message
+    will then be sent from the reactor thread.
     """
+    if threadable.ioThread is not None and not threadable.isInIOThread():
+        reactor.callFromThread(msg, target, message, log)
+        return
     try:
         if not isinstance(message, string_types):
             for _message in iter(message):
@@ -153,6 +207,18 @@ def msg(target, message, log=True):
         _BOT.msg(target, message, log)
 
 
+def from_asyncio(awaitable):
+    """Wraps an asyncio coroutine or future in a
+    :class:`twisted.internet.defer.Deferred` so it can be awaited in
+    commands. This only works if the bot runs on the asyncio reactor, see the
+    ``reactor`` option of the "base" section.
+
+    :rtype: :class:`twisted.internet.defer.Deferred`
+    """
+    import asyncio
+    return Deferred.fromFuture(asyncio.ensure_future(awaitable))
+
+
 def _check_args(f, count=3):
     """ Checks whether the number of arguments ``f`` takes equals
     ``count``."""
@@ -0,0 +1,140 @@
+"""Detects callbacks blocking the reactor
+
+If the ``watchdog_threshold`` option of the "base" section is set to a number
+of milliseconds, a heartbeat is scheduled on the reactor and a separate thread
+checks that it keeps running. Whenever the reactor hasn't run the heartbeat
+for longer than the threshold, the stack of the reactor thread is logged
+together with the command, regex or join callback that is currently being
+called, and the stall is counted for that callback.
+"""
+import lala.config
+import lala.pluginmanager
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from collections import Counter
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+
+_WATCHDOG = None
+
+
+class Watchdog(object):
+    """Watches the reactor thread.
+
+    :param float threshold: Seconds the reactor may be blocked
+    """
+    def __init__(self, threshold, clock=time.monotonic):
+        self.threshold = threshold
+        # A heartbeat every half threshold is late by at most a threshold
+        self.interval = threshold / 2
+        self.clock = clock
+        self.reactor_thread = None
+        self.last_tick = None
+        self.reported = None
+        #: Counts the stalls per (plugin, trigger) pair
+        self.stalls = Counter()
+        self._heartbeat = LoopingCall(self.tick)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the heartbeat and the watchdog thread. Has to be called from
+        the reactor thread."""
+        self.reactor_thread = threading.get_ident()
+        self.last_tick = self.clock()
+        self._heartbeat.start(self.interval)
+        self._thread = threading.Thread(target=self._run,
+                                        name="lala-watchdog")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._heartbeat.running:
+            self._heartbeat.stop()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception:
+                logging.exception("The watchdog check failed")
+
+    def tick(self):
+        """Called by the reactor every ``interval`` seconds."""
+        now = self.clock()
+        if self.reported is not None:
+            logging.warning("The reactor was blocked for %.0f ms",
+                            (now - self.reported - self.interval) * 1000)
+            self.reported = None
+        self.last_tick = now
+
+    def check(self):
+        """Called by the watchdog thread. Reports a stall if the heartbeat is
+        late by more than ``threshold`` seconds.
+
+        :rtype: bool
+        :return: Whether a new stall has been reported
+        """
+        last_tick = self.last_tick
+        late = self.clock() - last_tick - self.interval
+        if late <= self.threshold or self.reported == last_tick:
+            return False
+        self.reported = last_tick
+        self.report(late)
+        return True
+
+    def report(self, late):
+        frame = sys._current_frames().get(self.reactor_thread)
+        dispatching = lala.pluginmanager._dispatching
+        if dispatching is not None:
+            kind, plugin, trigger = dispatching
+            during = "while calling the %s %s of %s" % (kind, trigger, plugin)
+        else:
+            # Probably a callback of a Deferred a plugin returned
+            plugin, trigger = _innermost_plugin_frame(frame)
+            if plugin is None:
+                during = "outside of any plugin"
+            else:
+                during = "in %s of %s" % (trigger, plugin)
+        self.stalls[(plugin, trigger)] += 1
+        stack = "".join(traceback.format_stack(frame)) if frame else ""
+        logging.warning("The reactor has been blocked for %.0f ms %s:\n%s",
+                        late * 1000, during, stack)
+
+
+def _innermost_plugin_frame(frame):
+    """Returns the name of the plugin and the function of the innermost frame
+    of ``frame``'s stack that belongs to a plugin, or (None, None)."""
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.startswith(lala.pluginmanager.PLUGIN_PACKAGE + "."):
+            return (module[len(lala.pluginmanager.PLUGIN_PACKAGE) + 1:],
+                    frame.f_code.co_name)
+        frame = frame.f_back
+    return None, None
+
+
+def start():
+    """Starts the watchdog once the reactor runs if ``watchdog_threshold`` is
+    set."""
+    global _WATCHDOG
+    threshold = float(lala.config._get("base", "watchdog_threshold"))
+    if threshold <= 0 or _WATCHDOG is not None:
+        return
+    _WATCHDOG = Watchdog(threshold / 1000)
+    reactor.callWhenRunning(_WATCHDOG.start)
+    reactor.addSystemEventTrigger("before", "shutdown", _WATCHDOG.stop)
+
+
+def stall_statistics():
+    """Returns a dict mapping (plugin, trigger) pairs to the number of times
+    the reactor was blocked while calling them. Stalls outside of plugin
+    callbacks are counted as (None, None)."""
+    if _WATCHDOG is None:
+        return {}
+    return dict(_WATCHDOG.stalls)
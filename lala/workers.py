@@ -0,0 +1,370 @@
+"""Plugins running in worker processes
+
+Plugins listed in the ``worker_plugins`` option of the "base" section are not
+imported by the bot itself. Instead, each of ``workers`` child processes (one
+per CPU by default) loads all of them. The bot registers their commands,
+regexes and join callbacks and calls them in the least busy worker via
+:mod:`twisted.protocols.amp`. Messages the plugins send with
+:func:`lala.util.msg` are passed on to the bot.
+
+This allows CPU bound plugins to use more than one core and prevents a
+plugin from crashing or blocking the bot: a worker that exits is restarted
+and a worker that doesn't finish a callback within ``worker_timeout`` seconds
+is killed.
+
+Plugins running in workers can only use :func:`lala.util.msg` to interact
+with the bot. Configuration changes they make are not seen by the bot.
+"""
+import json
+import lala.config
+import lala.pluginmanager
+import lala.util
+import logging
+import os
+import sys
+
+from functools import partial
+from inspect import iscoroutine
+from twisted.internet import reactor
+from twisted.internet.address import UNIXAddress
+from twisted.internet.defer import (Deferred, ensureDeferred, fail,
+                                    gatherResults, inlineCallbacks,
+                                    maybeDeferred, succeed)
+from twisted.internet.endpoints import ProcessEndpoint
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import IProcessTransport
+from twisted.internet.protocol import Factory
+from twisted.protocols import amp
+from twisted.python.components import proxyForInterface
+from twisted.python.failure import Failure
+from types import GeneratorType
+
+#: The arguments to the Python interpreter to start a worker
+_CHILD_ARGS = ["-c", "from lala.workers import main; main()"]
+
+#: Seconds to wait before restarting a worker that exited
+RESTART_DELAY = 1
+
+_POOL = None
+
+
+class WorkerError(Exception):
+    """Loading a plugin or calling one of its callbacks in a worker
+    failed."""
+
+
+class LoadPlugins(amp.Command):
+    arguments = [(b"config", amp.Unicode()),
+                 (b"plugins", amp.ListOf(amp.Unicode()))]
+    response = [(b"descriptions", amp.Unicode())]
+    errors = {WorkerError: b"WORKER_ERROR"}
+
+
+class Dispatch(amp.Command):
+    arguments = [(b"plugin", amp.Unicode()),
+                 (b"kind", amp.Unicode()),
+                 (b"key", amp.Unicode()),
+                 (b"user", amp.Unicode()),
+                 (b"channel", amp.Unicode()),
+                 (b"message", amp.Unicode())]
+    response = []
+    errors = {WorkerError: b"WORKER_ERROR"}
+
+
+class SendMessage(amp.Command):
+    arguments = [(b"target", amp.Unicode()),
+                 (b"message", amp.Unicode()),
+                 (b"log", amp.Boolean())]
+    requiresAnswer = False
+
+
+class _BotProxy(object):
+    """Stands in for :data:`lala.util._BOT` in a worker and sends all messages
+    to the bot."""
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+    def msg(self, target, message, log=True, length=None):
+        self.protocol.callRemote(SendMessage, target=target, message=message,
+                                 log=log)
+
+
+def _wait_for(result):
+    """Returns a Deferred firing once all Deferreds a callback returned have
+    fired."""
+    if isinstance(result, GeneratorType):
+        return gatherResults(list(result), consumeErrors=True)
+    if iscoroutine(result):
+        return ensureDeferred(result)
+    return result
+
+
+class WorkerProtocol(amp.AMP):
+    """The worker side of the connection. Loads plugins and calls their
+    callbacks on request of the bot."""
+    @LoadPlugins.responder
+    def load_plugins(self, config, plugins):
+        lala.config._initialize(config or None)
+        lala.util._BOT = _BotProxy(self)
+        descriptions = {}
+        inits = []
+        try:
+            for plugin in plugins:
+                initialized = lala.pluginmanager.load_plugin(plugin)
+                descriptions[plugin] = lala.pluginmanager._describe_plugin(
+                    plugin)
+                inits.append(maybeDeferred(lambda: initialized).addErrback(
+                    partial(self._init_failed, plugin)))
+        except Exception as exc:
+            logging.exception("Loading %s failed", plugin)
+            raise WorkerError("Loading %s failed: %r" % (plugin, exc))
+        # The bot registers the callbacks once the plugins are initialized
+        d = gatherResults(inits, consumeErrors=True)
+        return d.addCallbacks(
+            lambda _: {"descriptions": json.dumps(descriptions)},
+            lambda failure: failure.value.subFailure)
+
+    def _init_failed(self, plugin, failure):
+        logging.error("Initializing %s failed:\n%s", plugin,
+                      failure.getTraceback())
+        raise WorkerError("Initializing %s failed: %s" % (
+            plugin, failure.getErrorMessage()))
+
+    @Dispatch.responder
+    def dispatch(self, plugin, kind, key, user, channel, message):
+        func = lala.pluginmanager._resolve(plugin, kind, key)
+        if func is None:
+            raise WorkerError("%s has no %s %s" % (plugin, kind, key))
+        if kind == "join":
+            args = (user, channel)
+        elif kind == "regex":
+            regex = next(regex for regex, f in
+                         lala.pluginmanager._regexes.items()
+                         if f.plugin == plugin and regex.pattern == key)
+            args = (user, channel, message, regex.search(message))
+        else:
+            args = (user, channel, message)
+        if kind != "join":
+            func = func.func
+        d = maybeDeferred(func, *args)
+        d.addCallback(_wait_for)
+        d.addCallbacks(lambda _: {}, partial(self._failed, plugin, key))
+        return d
+
+    def _failed(self, plugin, key, failure):
+        logging.error("%s of %s failed:\n%s", key, plugin,
+                      failure.getTraceback())
+        raise WorkerError("%s: %s" % (failure.type.__name__,
+                                      failure.getErrorMessage()))
+
+    def connectionLost(self, reason):  # noqa: N802
+        amp.AMP.connectionLost(self, reason)
+        # The bot went away
+        if reactor.running:
+            reactor.stop()
+
+
+class _WorkerTransport(proxyForInterface(IProcessTransport)):
+    """The transport of a worker process. AMP asks it for its peer and host
+    addresses, which process transports don't have."""
+    def getPeer(self):  # noqa: N802
+        return UNIXAddress(None)
+
+    def getHost(self):  # noqa: N802
+        return UNIXAddress(None)
+
+
+class _WorkerConnection(amp.AMP):
+    """The bot side of the connection to a worker."""
+    def __init__(self, pool):
+        amp.AMP.__init__(self)
+        self.pool = pool
+        self.pending = 0
+        self.lost = Deferred()
+
+    def makeConnection(self, transport):  # noqa: N802
+        amp.AMP.makeConnection(self, _WorkerTransport(transport))
+
+    @SendMessage.responder
+    def send_message(self, target, message, log):
+        lala.util.msg(target, message, log)
+        return {}
+
+    def kill(self):
+        try:
+            self.transport.signalProcess("KILL")
+        except ProcessExitedAlready:
+            pass
+
+    def connectionLost(self, reason):  # noqa: N802
+        amp.AMP.connectionLost(self, reason)
+        self.pool._worker_lost(self)
+        self.lost.callback(None)
+
+
+class WorkerPool(object):
+    """A pool of worker processes which have all loaded ``plugins``.
+
+    :param plugins: The names of the plugins to load
+    :param int size: The number of workers
+    :param timeout: Seconds after which a worker not finishing a callback is
+                    killed, no limit if it's 0 or None
+    :param str config: Path to the configuration file for the workers
+    """
+    def __init__(self, plugins, size, timeout, config, clock=reactor):
+        self.plugins = plugins
+        self.size = size
+        self.timeout = timeout
+        self.config = config
+        self.clock = clock
+        self.workers = []
+        self.descriptions = None
+        self._stopping = False
+
+    def start(self):
+        """Starts all workers.
+
+        :rtype: :class:`twisted.internet.defer.Deferred` firing with the
+                descriptions of the loaded plugins
+        """
+        d = gatherResults([self._spawn() for _ in range(self.size)],
+                          consumeErrors=True)
+        return d.addCallback(lambda _: self.descriptions)
+
+    def stop(self):
+        """Stops all workers.
+
+        :rtype: :class:`twisted.internet.defer.Deferred` firing once all of
+                them have exited
+        """
+        self._stopping = True
+        lost = [worker.lost for worker in self.workers]
+        for worker in self.workers:
+            worker.transport.loseConnection()
+        return gatherResults(lost)
+
+    @inlineCallbacks
+    def _spawn(self):
+        endpoint = ProcessEndpoint(self.clock, sys.executable,
+                                   [sys.executable] + _CHILD_ARGS,
+                                   env=os.environ)
+        factory = Factory.forProtocol(partial(_WorkerConnection, self))
+        worker = yield endpoint.connect(factory)
+        result = yield worker.callRemote(LoadPlugins, config=self.config,
+                                         plugins=self.plugins)
+        self.descriptions = json.loads(result["descriptions"])
+        if self._stopping:
+            worker.transport.loseConnection()
+        else:
+            self.workers.append(worker)
+
+    def _restart(self):
+        if self._stopping:
+            return
+        d = self._spawn()
+        d.addErrback(lambda failure: logging.error(
+            "Restarting a worker failed: %s", failure.getErrorMessage()))
+
+    def _worker_lost(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if not self._stopping:
+            logging.warning("A worker exited, restarting it")
+            self.clock.callLater(RESTART_DELAY, self._restart)
+
+    def dispatch(self, plugin, kind, key, user, channel, message=""):
+        """Calls a callback of ``plugin`` in the least busy worker.
+
+        Cancelling the returned Deferred kills the worker.
+
+        :param str kind: ``command``, ``regex`` or ``join``
+        :param str key: The trigger, pattern or name of the callback
+        :rtype: :class:`twisted.internet.defer.Deferred`
+        """
+        if not self.workers:
+            return fail(WorkerError("No worker is running"))
+        worker = min(self.workers, key=lambda worker: worker.pending)
+        worker.pending += 1
+        result = Deferred(lambda _: worker.kill())
+
+        def finished(value):
+            worker.pending -= 1
+            # The result may already have been cancelled
+            if not result.called:
+                if isinstance(value, Failure):
+                    result.errback(value)
+                else:
+                    result.callback(None)
+
+        worker.callRemote(Dispatch, plugin=plugin, kind=kind, key=key,
+                          user=user, channel=channel,
+                          message=message).addBoth(finished)
+        if self.timeout:
+            result.addTimeout(self.timeout, self.clock)
+        return result
+
+
+def _make_proxy(plugin, kind, key, doc=None):
+    def proxy(user, channel, message="", match=None):
+        return _POOL.dispatch(plugin, kind, key, user, channel, message)
+    proxy.__doc__ = doc
+    proxy.__name__ = str(key)
+    return proxy
+
+
+def _get_size():
+    size = int(lala.config._get("base", "workers"))
+    return size or os.cpu_count() or 1
+
+
+def start(plugins):
+    """Starts the worker pool for ``plugins`` and registers their callbacks
+    once the workers have loaded them. A running pool is stopped first.
+
+    :rtype: :class:`twisted.internet.defer.Deferred`
+    """
+    d = stop()
+
+    def spawn(_):
+        global _POOL
+        _POOL = WorkerPool(plugins,
+                           _get_size(),
+                           float(lala.config._get("base", "worker_timeout")),
+                           lala.config._FILENAME or "")
+        logging.info("Starting %i workers for %s", _POOL.size,
+                     ", ".join(plugins))
+        return _POOL.start()
+
+    def register(descriptions):
+        def load():
+            for name, entry in descriptions.items():
+                # The workers decide on their own whether to use threads
+                lala.pluginmanager._register_described(
+                    name, entry, partial(_make_proxy, name),
+                    ignored_options=("threaded",))
+        lala.pluginmanager._staged(load, plugins)
+
+    d.addCallback(spawn)
+    d.addCallback(register)
+    return d
+
+
+def stop():
+    """Stops the worker pool if it's running.
+
+    :rtype: :class:`twisted.internet.defer.Deferred`
+    """
+    global _POOL
+    if _POOL is None:
+        return succeed(None)
+    pool, _POOL = _POOL, None
+    return pool.stop()
+
+
+def main():
+    """Runs a worker, talking to the bot over stdin and stdout."""
+    from twisted.internet.stdio import StandardIO
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO,
+                        format="worker %(process)d: %(message)s")
+    StandardIO(WorkerProtocol())
+    reactor.run()
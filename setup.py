@@ -11,7 +11,7 @@ setup(name="lala",
       packages=["lala", "lala.plugins", "twisted.plugins"],
       package_dir={"lala": "lala"},
       requires=["Twisted"],
-      python_requires=">=3.6.0",
+      python_requires=">=3.7.0",
       download_url="https://github.com/mineo/lala/tarball/master",
       url="http://github.com/mineo/lala",
       license="MIT",
@@ -21,7 +21,6 @@ setup(name="lala",
                    "License :: OSI Approved :: MIT License",
                    "Natural Language :: English",
                    "Operating System :: OS Independent",
-                   "Programming Language :: Python :: 3.6"
                    "Programming Language :: Python :: 3.7",
                    "Programming Language :: Python :: 3.8",
                    "Programming Language :: Python :: 3.9"
@@ -50,6 +50,16 @@ class NewDateTime(datetime.datetime):
         return cls(2012, 12, 10, 00, 00, 00, 00, None)
 
 
+class FakeClock(object):
+    """A clock returning :attr:`now` when called, to pass as the ``clock``
+    of rate limiters, the watchdog and captures."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
 class DeferredHelper(Deferred):
     def __init__(self, data=None):
         Deferred.__init__(self)
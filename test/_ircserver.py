@@ -0,0 +1,275 @@
+"""A fake IRC server for tests and benchmarks
+
+:class:`FakeIRCServer` accepts a bot, welcomes it, lets it join and part
+channels, answers WHOIS queries (with ``307`` for registered nicks) and records
+every line the bot sends. Its users are simulated: :meth:`FakeIRCServer.privmsg`
+and friends send messages as if they came from them.
+
+:class:`LoadGenerator` floods the channels with PRIVMSG, JOIN, PART and QUIT
+at fixed rates and measures how long the bot takes to answer commands.
+
+Both can be connected to a bot over TCP on localhost or, in tests, with
+:func:`twisted.test.iosim.connect` and a :class:`twisted.internet.task.Clock`.
+"""
+import random
+
+from collections import namedtuple
+from twisted.internet import protocol, reactor
+from twisted.internet.task import LoopingCall
+from twisted.words.protocols import irc
+
+SERVER_NAME = "irc.localhost"
+
+#: A line sent by the bot and when it was received
+Line = namedtuple("Line", "time line")
+
+#: A PRIVMSG sent by the bot
+Message = namedtuple("Message", "time target text")
+
+
+class FakeIRCServerProtocol(irc.IRC):
+    """The connection to one bot."""
+    # Looked up with socket.getfqdn() otherwise
+    hostname = SERVER_NAME
+
+    def __init__(self):
+        self.nick = None
+        self.channels = []
+
+    def connectionMade(self):  # noqa: N802
+        irc.IRC.connectionMade(self)
+        self.factory.clients.append(self)
+
+    def connectionLost(self, reason):  # noqa: N802
+        if self in self.factory.clients:
+            self.factory.clients.remove(self)
+
+    def handleCommand(self, command, prefix, params):  # noqa: N802
+        self.factory.record(self, command, params)
+        irc.IRC.handleCommand(self, command, prefix, params)
+
+    def numeric(self, code, *params):
+        self.sendCommand(code, (self.nick,) + params, prefix=SERVER_NAME)
+
+    def irc_unknown(self, prefix, command, params):
+        pass
+
+    def irc_NICK(self, prefix, params):  # noqa: N802
+        self.nick = params[0]
+
+    def irc_USER(self, prefix, params):  # noqa: N802
+        self.numeric(irc.RPL_WELCOME, ":Welcome to the fake IRC server")
+
+    def irc_PING(self, prefix, params):  # noqa: N802
+        self.sendCommand("PONG", (SERVER_NAME, ":" + params[0]),
+                         prefix=SERVER_NAME)
+
+    def irc_JOIN(self, prefix, params):  # noqa: N802
+        for channel in params[0].split(","):
+            if channel not in self.channels:
+                self.channels.append(channel)
+            self.sendCommand("JOIN", (":" + channel,),
+                             prefix=self.factory.hostmask(self.nick))
+
+    def irc_PART(self, prefix, params):  # noqa: N802
+        for channel in params[0].split(","):
+            if channel in self.channels:
+                self.channels.remove(channel)
+            self.sendCommand("PART", (channel,),
+                             prefix=self.factory.hostmask(self.nick))
+
+    def irc_WHOIS(self, prefix, params):  # noqa: N802
+        nick = params[-1]
+        self.numeric(irc.RPL_WHOISUSER, nick, nick, "localhost", "*",
+                     ":" + nick)
+        if nick in self.factory.registered:
+            self.numeric("307", nick, ":is a registered nick")
+        self.numeric(irc.RPL_ENDOFWHOIS, nick, ":End of /WHOIS list.")
+
+
+class FakeIRCServer(protocol.ServerFactory):
+    """Simulates ``channels`` channels named ``#channel<n>`` and ``users``
+    users named ``user<n>``.
+
+    :param registered: Nicks for which WHOIS answers with ``307``
+    :param clock: Used to timestamp the lines the bot sends
+    """
+    protocol = FakeIRCServerProtocol
+
+    def __init__(self, channels=1, users=10, registered=(), clock=reactor):
+        self.channels = ["#channel%i" % i for i in range(channels)]
+        self.users = ["user%i" % i for i in range(users)]
+        self.registered = set(registered)
+        self.clock = clock
+        self.clients = []
+        #: Every :class:`Line` the bots sent
+        self.lines = []
+        #: Every :class:`Message` the bots sent
+        self.messages = []
+        #: Functions called with every :class:`Message`
+        self.message_observers = []
+
+    def record(self, client, command, params):
+        now = self.clock.seconds()
+        self.lines.append(Line(now, " ".join([command] + params)))
+        if command == "PRIVMSG" and len(params) == 2:
+            message = Message(now, params[0], params[1])
+            self.messages.append(message)
+            for observer in self.message_observers:
+                observer(message)
+
+    def hostmask(self, nick):
+        return "%s!%s@localhost" % (nick, nick)
+
+    def joined(self, channel):
+        """Returns whether a bot has joined ``channel``."""
+        return any(channel in client.channels for client in self.clients)
+
+    def send(self, user, command, *params):
+        """Sends ``command`` from ``user`` to all bots. The last parameter
+        may contain spaces."""
+        params = list(params)
+        if params:
+            params[-1] = ":" + params[-1]
+        for client in self.clients:
+            client.sendCommand(command, params, prefix=self.hostmask(user))
+
+    def privmsg(self, user, target, text):
+        self.send(user, "PRIVMSG", target, text)
+
+    def join(self, user, channel):
+        self.send(user, "JOIN", channel)
+
+    def part(self, user, channel, reason="bye"):
+        self.send(user, "PART", channel, reason)
+
+    def quit(self, user, reason="bye"):
+        self.send(user, "QUIT", reason)
+
+
+class LoadGenerator(object):
+    """Sends events from the users of ``server`` at ``rates`` per second.
+
+    ``rates`` may contain ``privmsg`` (chat messages), ``command`` (calls of
+    ``command`` whose answer has to contain its argument), ``join``, ``part``
+    and ``quit``. Users part or quit only if they are in a channel and only
+    send messages to channels they are in.
+
+    :param float resolution: Seconds between two batches of events
+    """
+    def __init__(self, server, rates, command="echo", clock=reactor,
+                 resolution=0.01, seed=0):
+        self.server = server
+        self.rates = rates
+        self.command = command
+        self.clock = clock
+        self.resolution = resolution
+        self.random = random.Random(seed)
+        #: Maps channels to the users in them
+        self.members = {channel: set(server.users[::2])
+                        for channel in server.channels}
+        #: Counts the events sent per kind
+        self.sent = dict.fromkeys(rates, 0)
+        #: Seconds from sending a command until the first answer
+        self.latencies = []
+        self._pending = {}
+        self._owed = dict.fromkeys(rates, 0.0)
+        self._next_id = 0
+        self._call = LoopingCall(self.tick)
+        self._call.clock = clock
+
+    def start(self):
+        self.server.message_observers.append(self.message)
+        self._call.start(self.resolution, now=False)
+
+    def stop(self):
+        """Stops sending events. Answers to commands are still measured."""
+        if self._call.running:
+            self._call.stop()
+
+    @property
+    def unanswered(self):
+        """The number of commands that haven't been answered."""
+        return len(self._pending)
+
+    def tick(self):
+        for kind, rate in self.rates.items():
+            owed = self._owed[kind] + rate * self.resolution
+            # Don't lose events to rounding errors
+            count = int(owed + 1e-9)
+            self._owed[kind] = owed - count
+            for _ in range(count):
+                if getattr(self, "_send_" + kind)():
+                    self.sent[kind] += 1
+
+    def _member(self, channel=None):
+        channels = ([channel] if channel is not None else
+                    [c for c, users in self.members.items() if users])
+        if not channels:
+            return None, None
+        channel = self.random.choice(channels)
+        users = self.members[channel]
+        if not users:
+            return None, None
+        return self.random.choice(sorted(users)), channel
+
+    def _send_privmsg(self):
+        user, channel = self._member()
+        if user is None:
+            return False
+        self.server.privmsg(user, channel, "message %i from %s" % (
+            self.random.randrange(10 ** 6), user))
+        return True
+
+    def _send_command(self):
+        user, channel = self._member()
+        if user is None:
+            return False
+        self._next_id += 1
+        token = "request%i" % self._next_id
+        self._pending[token] = self.clock.seconds()
+        self.server.privmsg(user, channel, "!%s %s" % (self.command, token))
+        return True
+
+    def _send_join(self):
+        channel = self.random.choice(self.server.channels)
+        outside = sorted(set(self.server.users) - self.members[channel])
+        if not outside:
+            return False
+        user = self.random.choice(outside)
+        self.members[channel].add(user)
+        self.server.join(user, channel)
+        return True
+
+    def _send_part(self):
+        user, channel = self._member()
+        if user is None:
+            return False
+        self.members[channel].discard(user)
+        self.server.part(user, channel)
+        return True
+
+    def _send_quit(self):
+        user, _ = self._member()
+        if user is None:
+            return False
+        for users in self.members.values():
+            users.discard(user)
+        self.server.quit(user)
+        return True
+
+    def message(self, message):
+        for word in message.text.split():
+            sent = self._pending.pop(word, None)
+            if sent is not None:
+                self.latencies.append(message.time - sent)
+
+
+def percentile(values, percent):
+    """Returns the ``percent`` percentile of ``values`` by the nearest rank
+    method or None if there are no values."""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
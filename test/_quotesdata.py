@@ -0,0 +1,128 @@
+"""Builds quotes databases of any size for tests and benchmarks
+
+:func:`build` fills a database with the schema of :mod:`lala.plugins.quotes`
+with generated data shaped like a long-running channel's:
+
+- a few authors add most quotes, the number of quotes per author follows
+  Zipf's law
+- quotes are one to three IRC lines like ``<user12> some words``, so nicks
+  appear in the quote texts and on-join lookups find some of them
+- a few quotes get most votes, votes are mostly likes and every voter votes
+  at most once per quote
+
+The same ``seed`` always builds the same database.
+"""
+import itertools
+import random
+import sqlite3
+
+#: The words quotes are made of
+WORDS = tuple("%s%s%s" % parts for parts in itertools.product(
+    ("b", "ch", "d", "f", "g", "k", "l", "m", "n", "p", "r", "s", "t", "w"),
+    ("a", "e", "i", "o", "u", "ai", "ou"),
+    ("", "n", "r", "st", "ck", "ll", "ng")))
+
+#: Votes per quote and quotes per author and per voter of the default shape,
+#: 400,000 quotes with 2,000,000 votes by 2,000 voters from 1,000 authors
+VOTES_PER_QUOTE = 5
+QUOTES_PER_AUTHOR = 400
+QUOTES_PER_VOTER = 200
+
+_BATCH = 10000
+
+
+def nick(number):
+    return "user%i" % number
+
+
+def _zipf_weights(count, exponent=1.0):
+    """Returns the cumulative weights of ``count`` ranks by Zipf's law."""
+    return list(itertools.accumulate(rank ** -exponent
+                                     for rank in range(1, count + 1)))
+
+
+def _quote(rng, nicks, weights):
+    lines = []
+    for _ in range(rng.choice((1, 1, 1, 2, 2, 3))):
+        speaker = rng.choices(nicks, cum_weights=weights)[0]
+        lines.append("<%s> %s" % (speaker, " ".join(
+            rng.choices(WORDS, k=rng.randint(3, 15)))))
+    return " ".join(lines)
+
+
+def _batches(iterable):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, _BATCH))
+        if not batch:
+            return
+        yield batch
+
+
+def build(path, quotes, authors=None, voters=None, votes=None, seed=0):
+    """Creates the quotes database ``path`` and fills it.
+
+    :param int quotes: The number of quotes
+    :param int authors: The number of authors, defaults to one per
+                        :data:`QUOTES_PER_AUTHOR` quotes
+    :param int voters: The number of voters, defaults to one per
+                       :data:`QUOTES_PER_VOTER` quotes
+    :param int votes: The number of votes to attempt, defaults to
+                      :data:`VOTES_PER_QUOTE` per quote. Attempts by a voter
+                      who already voted for the quote are dropped.
+    :rtype: dict
+    :return: The number of rows per table
+    """
+    from lala.plugins.quotes import _create_tables
+
+    if authors is None:
+        authors = max(1, quotes // QUOTES_PER_AUTHOR)
+    if voters is None:
+        voters = max(1, quotes // QUOTES_PER_VOTER)
+    if votes is None:
+        votes = quotes * VOTES_PER_QUOTE
+    rng = random.Random(seed)
+    nicks = [nick(i) for i in range(max(authors, voters))]
+    nick_weights = _zipf_weights(len(nicks))
+
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute("PRAGMA journal_mode = OFF;")
+        connection.execute("PRAGMA synchronous = OFF;")
+        cursor = connection.cursor()
+        _create_tables(cursor)
+        cursor.executemany("INSERT INTO author (id, name) VALUES (?, ?);",
+                           ((i + 1, nicks[i]) for i in range(authors)))
+        cursor.executemany("INSERT INTO voter (id, name) VALUES (?, ?);",
+                           ((i + 1, nicks[i]) for i in range(voters)))
+
+        author_weights = _zipf_weights(authors)
+        author_ids = range(1, authors + 1)
+        for batch in _batches(range(1, quotes + 1)):
+            written_by = rng.choices(author_ids, cum_weights=author_weights,
+                                     k=len(batch))
+            cursor.executemany(
+                "INSERT INTO quote (id, quote, author) VALUES (?, ?, ?);",
+                ((quote, _quote(rng, nicks, nick_weights), author)
+                 for quote, author in zip(batch, written_by)))
+
+        # Popular quotes are spread over the whole database
+        popularity = list(range(1, quotes + 1))
+        rng.shuffle(popularity)
+        quote_weights = _zipf_weights(quotes, 0.5)
+        voter_ids = range(1, voters + 1)
+        for batch in _batches(range(votes)):
+            cursor.executemany(
+                "INSERT OR IGNORE INTO vote (vote, quote, voter) "
+                "VALUES (?, ?, ?);",
+                zip(rng.choices((1, 1, 1, -1), k=len(batch)),
+                    rng.choices(popularity, cum_weights=quote_weights,
+                                k=len(batch)),
+                    rng.choices(voter_ids, k=len(batch))))
+        connection.commit()
+
+        query = "SELECT count(*) FROM %s;"
+        return {table: connection.execute(query % table).fetchone()[0]
+                for table in ("author", "quote", "voter", "vote")}
+    finally:
+        connection.close()
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from ._helpers import LalaTestCase
+from lala import archive
+
+
+class TestArchive(LalaTestCase):
+    def setUp(self):
+        super(TestArchive, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.archive = archive.Archive(os.path.join(directory, "archive.db"))
+        self.addCleanup(self.archive.close)
+        self.archive.add([(1.0, "#Lala", "user", "hello world"),
+                          (2.0, "#lala", "Other", "hello there"),
+                          (3.0, "#other", "user", "hello again, world"),
+                          (4.0, "#lala", "user", "something else")])
+
+    def texts(self, *args, **kwargs):
+        return [row[3] for row in self.archive.search(*args, **kwargs)]
+
+    def test_search(self):
+        self.assertEqual(self.texts(["hello"]),
+                         ["hello world", "hello there", "hello again, world"])
+        self.assertEqual(self.texts(["WORLD", "hello"]),
+                         ["hello world", "hello again, world"])
+        self.assertEqual(self.texts(["nothing"]), [])
+
+    def test_filters(self):
+        self.assertEqual(self.texts(["hello"], channel="#LALA"),
+                         ["hello world", "hello there"])
+        self.assertEqual(self.texts(["hello"], nick="other"),
+                         ["hello there"])
+        self.assertEqual(self.archive.search(["hello"], "#lala", "user"),
+                         [(1.0, "#lala", "user", "hello world")])
+
+    def test_limit(self):
+        # The newest ones, the oldest first
+        self.assertEqual(self.texts(["hello"], limit=2),
+                         ["hello there", "hello again, world"])
+
+    def test_prefix(self):
+        self.assertEqual(self.texts(["some*"]), ["something else"])
+        self.assertEqual(self.texts(["some"]), [])
+
+    def test_operators_are_quoted(self):
+        self.archive.add([(5.0, "#lala", "user", 'say "NOT" or AND')])
+        self.assertEqual(self.texts(['"NOT"', "AND"]), ['say "NOT" or AND'])
+        self.assertEqual(self.texts(["hello", "NOT", "world"]), [])
+        self.assertRaises(ValueError, self.archive.search, ["*", "**"])
+        self.assertRaises(ValueError, self.archive.search, [])
+
+    def test_prune(self):
+        self.assertEqual(self.archive.prune(3.0), 2)
+        self.assertEqual(self.texts(["hello"]), ["hello again, world"])
+        # The index is updated as well
+        count = self.archive.connection().execute(
+            "SELECT count(*) FROM message_fts WHERE message_fts MATCH "
+            "'hello';").fetchone()[0]
+        self.assertEqual(count, 1)
+
+    def test_remove(self):
+        # The ids of the messages are 1 to 4
+        self.assertEqual(self.archive.remove(2, 4), 2)
+        self.assertEqual(self.texts(["hello"]), ["hello world"])
+        self.assertEqual(self.texts(["else"]), ["something else"])
+
+    def test_threads(self):
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.append(self.texts(["else"])))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [["something else"]])
+
+    def test_reopen(self):
+        self.archive.close()
+        reopened = archive.Archive(self.archive.path)
+        self.addCleanup(reopened.close)
+        self.assertEqual(len(reopened.search(["hello"])), 3)
+
+    def test_close_all_threads(self):
+        thread = threading.Thread(target=self.texts, args=(["else"],))
+        thread.start()
+        thread.join()
+        connections = list(self.archive._connections)
+        self.assertEqual(len(connections), 2)
+        self.archive.close()
+        for connection in connections:
+            self.assertRaises(Exception, connection.execute, "SELECT 1;")
+        # Reopened on demand
+        self.assertEqual(self.texts(["else"]), ["something else"])
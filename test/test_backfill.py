@@ -0,0 +1,245 @@
+import datetime
+import gzip
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ._helpers import mock, LalaTestCase
+from lala import archive, backfill, segments
+
+
+def stamp(day, hour, minute=0):
+    return "2026-10-%02i %02i:%02i" % (day, hour, minute)
+
+
+class TestBackfill(LalaTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.logfile = os.path.join(self.directory, "chat.log")
+        self.folder = os.path.join(self.directory, "logs")
+        self.archive_file = os.path.join(self.directory, "archive.db")
+        self.checkpoint = self.logfile + ".backfill"
+        super(TestBackfill, self).setUp()
+        # The plugin tests rely on importing the plugins themselves
+        modules_patcher = mock.patch.dict(sys.modules)
+        modules_patcher.start()
+        self.addCleanup(modules_patcher.stop)
+        self.addCleanup(self.wait_for_compression)
+        # The current file was last written on the 19th
+        self.write("chat.log", [stamp(19, 9) + " user: today",
+                                stamp(19, 10) + " other: still today"])
+        os.utime(self.logfile, (time.mktime((2026, 10, 19, 12, 0, 0, 0, 0,
+                                             -1)),) * 2)
+        self.write("chat.log.2026-10-18.gz",
+                   [stamp(18, 9) + " user: yesterday",
+                    "not a message",
+                    stamp(18, 23, 59) + " user: late"],
+                   compress=True)
+        self.write("chat.log.2026-10-17",
+                   [stamp(17, 12) + " user: hello: world"])
+
+    def writeConfigFile(self, _file):
+        _file.write("[base]\nchannels = #lala\n"
+                    "[log]\nlog_file = %s\nlog_folder = %s\n"
+                    "archive_file = %s\nmax_log_days = 0\n"
+                    % (self.logfile, self.folder, self.archive_file))
+
+    def write(self, name, lines, compress=False):
+        path = os.path.join(self.directory, name)
+        with (gzip.open if compress else open)(path, "wt") as fp:
+            fp.writelines("%s\n" % line for line in lines)
+
+    def wait_for_compression(self):
+        for thread in threading.enumerate():
+            if thread.name == "lala-log-gzip":
+                thread.join()
+
+    def run_main(self, *args):
+        with mock.patch("sys.stdout", new_callable=io.StringIO) as stdout:
+            self.assertEqual(backfill.main(["--config", self.configfile,
+                                            "--progress", "0"] + list(args)),
+                             0)
+        self.wait_for_compression()
+        return stdout.getvalue()
+
+    def archived(self):
+        db = archive.Archive(self.archive_file)
+        self.addCleanup(db.close)
+        return db.connection().execute(
+            "SELECT channel, nick, text FROM message ORDER BY id;").fetchall()
+
+    def test_files(self):
+        self.assertEqual(
+            [(day, os.path.basename(path))
+             for day, path in backfill.files(self.logfile)],
+            [("2026-10-17", "chat.log.2026-10-17"),
+             ("2026-10-18", "chat.log.2026-10-18.gz"),
+             ("2026-10-19", "chat.log")])
+
+    def test_records(self):
+        pipeline = backfill.records(backfill.lines(backfill.files(
+            self.logfile), ("2026-10-18", 1)), "#lala")
+        (day, number, none), (_, _, record) = list(pipeline)[:2]
+        self.assertEqual((day, number, none), ("2026-10-18", 2, None))
+        self.assertEqual(record.getMessage(), "user: late")
+        self.assertEqual((record.channel, record.nick, record.text),
+                         ("#lala", "user", "late"))
+        self.assertEqual(datetime.datetime.fromtimestamp(record.created),
+                         datetime.datetime(2026, 10, 18, 23, 59))
+
+    def test_retained(self):
+        record = mock.Mock(created=time.time() - 3 * 86400)
+        items = [("day", 1, record), ("day", 2, None)]
+        self.assertEqual(list(backfill.retained(items, 0)), items)
+        self.assertEqual([item[2] for item in backfill.retained(items, 2)],
+                         [None, None])
+        self.assertEqual(list(backfill.retained(items, 4)), items)
+
+    def test_backfill(self):
+        output = self.run_main()
+        self.assertIn("segments, archive with 5 messages of 6 lines", output)
+        self.assertEqual(self.archived(), [
+            ("#lala", "user", "hello: world"),
+            ("#lala", "user", "yesterday"),
+            ("#lala", "user", "late"),
+            ("#lala", "user", "today"),
+            ("#lala", "other", "still today")])
+        self.assertEqual(
+            segments.since(self.folder, "#lala", 0, 10),
+            ["2026-10-17T12:00:00 user: hello: world",
+             "2026-10-18T09:00:00 user: yesterday",
+             "2026-10-18T23:59:00 user: late",
+             "2026-10-19T09:00:00 user: today",
+             "2026-10-19T10:00:00 other: still today"])
+        # The finished days are compressed
+        self.assertEqual([os.path.basename(path) for _, path in
+                          segments.segments(self.folder, "#lala")],
+                         ["2026-10-17.log.gz", "2026-10-18.log.gz",
+                          "2026-10-19.log"])
+        # Nothing is added twice
+        self.assertIn("with 0 messages of 0 lines", self.run_main())
+        os.remove(self.checkpoint)
+        self.run_main()
+        self.assertEqual(len(self.archived()), 5)
+
+    def test_only_older_messages(self):
+        # The bot added these since the 18th, 23:59
+        db = archive.Archive(self.archive_file)
+        db.add([(time.mktime((2026, 10, 18, 23, 59, 30, 0, 0, -1)),
+                 "#lala", "user", "late, hello")])
+        writer = segments.Writer(self.folder)
+        writer.write("#lala", time.mktime((2026, 10, 19, 9, 0, 0, 0, 0, -1)),
+                     "user: today")
+        writer.close()
+        self.run_main()
+        self.assertEqual([text for _, _, text in self.archived()],
+                         ["hello: world", "yesterday", "late, hello"])
+        # The backfilled messages are older
+        self.assertEqual(db.search(["hello"], limit=1)[0][3], "late, hello")
+        self.assertEqual(
+            segments.last(self.folder, "#lala", 10),
+            ["2026-10-17T12:00:00 user: hello: world",
+             "2026-10-18T09:00:00 user: yesterday",
+             "2026-10-18T23:59:00 user: late",
+             "2026-10-19T09:00:00 user: today"])
+
+    def test_resume(self):
+        write = backfill.lala.logqueue._write
+        calls = []
+
+        def interrupt(batch):
+            calls.append(batch)
+            if len(calls) == 3:
+                raise KeyboardInterrupt()
+            write(batch)
+
+        with mock.patch("lala.logqueue._write", side_effect=interrupt):
+            self.assertRaises(KeyboardInterrupt, self.run_main,
+                              "--batch", "2")
+        self.assertEqual(len(self.archived()), 3)
+        self.assertEqual(backfill.load_checkpoint(self.checkpoint)["position"],
+                         ["2026-10-18", 3])
+        with mock.patch("sys.stderr"):
+            self.assertRaises(SystemExit, self.run_main, "--targets",
+                              "archive")
+        self.assertIn("with 2 messages of 2 lines", self.run_main())
+        self.assertEqual([text for _, _, text in self.archived()],
+                         ["hello: world", "yesterday", "late", "today",
+                          "still today"])
+
+    def interrupt_after(self, count):
+        """Runs a backfill of two lines per batch which is interrupted after
+        writing the ``count``-th batch, before saving the checkpoint."""
+        write = backfill.lala.logqueue._write
+        calls = []
+
+        def interrupt(batch):
+            write(batch)
+            calls.append(batch)
+            if len(calls) == count:
+                raise KeyboardInterrupt()
+
+        with mock.patch("lala.logqueue._write", side_effect=interrupt):
+            self.assertRaises(KeyboardInterrupt, self.run_main,
+                              "--batch", "2")
+        self.wait_for_compression()
+
+    def assert_backfilled_once(self):
+        self.assertEqual([text for _, _, text in self.archived()],
+                         ["hello: world", "yesterday", "late", "today",
+                          "still today"])
+        self.assertEqual(
+            segments.since(self.folder, "#lala", 0, 10),
+            ["2026-10-17T12:00:00 user: hello: world",
+             "2026-10-18T09:00:00 user: yesterday",
+             "2026-10-18T23:59:00 user: late",
+             "2026-10-19T09:00:00 user: today",
+             "2026-10-19T10:00:00 other: still today"])
+
+    def test_resume_truncates_segment(self):
+        # The second batch appended "late" to the segment of the 18th
+        self.interrupt_after(2)
+        self.assertEqual(len(segments.last(self.folder, "#lala", 10)), 3)
+        self.run_main("--batch", "2")
+        self.assert_backfilled_once()
+
+    def test_resume_after_compression(self):
+        # The third batch started the 19th, the 18th has been compressed
+        self.interrupt_after(3)
+        self.assertTrue(os.path.exists(os.path.join(
+            segments.channel_directory(self.folder, "#lala"),
+            "2026-10-18.log.gz")))
+        self.run_main("--batch", "2")
+        self.assert_backfilled_once()
+
+    def test_resume_without_checkpointed_segment(self):
+        self.interrupt_after(1)
+        self.run_main("--batch", "2")
+        self.assert_backfilled_once()
+
+    def test_channel(self):
+        self.run_main("--channel", "#other", "--targets", "archive",
+                      "--checkpoint", os.path.join(self.directory, "other"))
+        self.assertEqual({channel for channel, _, _ in self.archived()},
+                         {"#other"})
+        self.assertFalse(os.path.exists(self.folder))
+        with mock.patch("sys.stderr"):
+            self.assertRaises(SystemExit, self.run_main, "--targets", "x")
+            # The checkpoint is of another channel
+            self.assertRaises(SystemExit, self.run_main, "--channel", "#other",
+                              "--checkpoint",
+                              os.path.join(self.directory, "other"),
+                              "--channel", "#lala")
+
+    def test_progress(self):
+        stream = io.StringIO()
+        progress = backfill._Progress(stream, 0.001)
+        time.sleep(0.002)
+        progress.update("2026-10-18", 2, 2, 1)
+        self.assertTrue(stream.getvalue().startswith(
+            "2026-10-18 line 2: 1 messages, "))
@@ -1,10 +1,15 @@
 import lala.factory
+import lala.latency
 import lala.util
 import lala.pluginmanager
 import lala.config
+import lala.startup
 from ._helpers import mock, LalaTestCase
+from ._ircserver import FakeIRCServer
 
-from twisted.test import proto_helpers
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.test import iosim, proto_helpers
 
 
 class TestBot(LalaTestCase):
@@ -48,3 +53,119 @@ class TestBot(LalaTestCase):
         self.proto.signedOn()
         self.proto.msg.assert_called_once_with("Nickserv", "identify test",
                 log=False)
+
+
+class TestLatency(LalaTestCase):
+    def setUp(self):
+        super(TestLatency, self).setUp()
+        lala.pluginmanager._callbacks.clear()
+        lala.pluginmanager._regexes.clear()
+        clock_patcher = mock.patch("twisted.words.protocols.irc.reactor",
+                                   new=Clock())
+        self.clock = clock_patcher.start()
+        self.addCleanup(clock_patcher.stop)
+        now_patcher = mock.patch("lala.latency._now", new=self.clock.seconds)
+        now_patcher.start()
+        self.addCleanup(now_patcher.stop)
+
+        self.observed = []
+        lala.latency.add_observer(self.observe)
+        self.addCleanup(lala.latency.remove_observer, self.observe)
+
+        with mock.patch("lala.pluginmanager.setup"):
+            factory = lala.factory.LalaFactory("#test", "nick")
+        self.proto = factory.buildProtocol(("127.0.0.1", ))
+        self.proto.makeConnection(proto_helpers.StringTransport())
+        # Sending the registration lines fills the queue
+        self.clock.pump([1] * 3)
+        self.addCleanup(setattr, lala.util, "_BOT", lala.util._BOT)
+        lala.util._BOT = self.proto
+
+    def observe(self, trigger, latency, first):
+        self.observed.append((trigger, latency, first))
+
+    def test_latency_includes_line_rate(self):
+        def reply(user, channel, text):
+            self.clock.advance(0.5)
+            lala.util.msg(channel, ["one", "two"])
+
+        lala.util.command(command="reply")(reply)
+        self.proto.lineReceived(b":user!u@host PRIVMSG #test :!reply")
+        self.assertEqual(self.observed, [("reply", 0.5, True)])
+        self.clock.advance(1)
+        self.assertEqual(self.observed, [("reply", 0.5, True),
+                                         ("reply", 1.5, False)])
+
+    def test_latency_of_deferred_callbacks(self):
+        d = Deferred()
+
+        def reply(user, channel, text):
+            d.addCallback(lambda _: lala.util.msg(channel, "done"))
+            return d
+
+        lala.util.command(command="reply", timeout=0)(reply)
+        self.proto.lineReceived(b":user!u@host PRIVMSG #test :!reply")
+        self.clock.advance(2)
+        d.callback(None)
+        self.assertEqual(self.observed, [("reply", 2, True)])
+        self.assertEqual(dict(lala.latency._open), {})
+
+    def test_unrelated_lines(self):
+        self.proto.msg("#test", "hello", True)
+        self.assertEqual(self.observed, [])
+
+
+class TestStartup(LalaTestCase):
+    def setUp(self):
+        super(TestStartup, self).setUp()
+        lala.pluginmanager._callbacks.clear()
+        lala.pluginmanager._regexes.clear()
+        self.clock = Clock()
+        clock_patcher = mock.patch("twisted.words.protocols.irc.reactor",
+                                   new=self.clock)
+        clock_patcher.start()
+        self.addCleanup(clock_patcher.stop)
+        now_patcher = mock.patch("lala.startup._now", new=self.clock.seconds)
+        now_patcher.start()
+        self.addCleanup(now_patcher.stop)
+        trace_patcher = mock.patch("lala.startup._trace", new=None)
+        trace_patcher.start()
+        self.addCleanup(trace_patcher.stop)
+        self.addCleanup(setattr, lala.util, "_BOT", lala.util._BOT)
+
+    def connect(self, channels):
+        server = FakeIRCServer(channels=channels, clock=self.clock)
+        with mock.patch("lala.pluginmanager.setup"):
+            factory = lala.factory.LalaFactory(",".join(server.channels),
+                                               "lala")
+        factory.startedConnecting(None)
+        self.clock.advance(0.5)
+        bot = factory.buildProtocol(None)
+        protocol = server.buildProtocol(None)
+        pump = iosim.connect(protocol, iosim.makeFakeServer(protocol),
+                             bot, iosim.makeFakeClient(bot))
+        for _ in range(300):
+            self.clock.advance(0.01)
+            pump.flush()
+
+    def test_timeline(self):
+        lala.startup.start()
+        with mock.patch("logging.info") as info:
+            self.connect(2)
+        phases = lala.startup.timeline()
+        self.assertEqual([phase.label for phase in phases],
+                         ["connect", "registration", "join #channel0",
+                          "join #channel1"])
+        self.assertEqual(phases[0].duration, 0.5)
+        self.assertTrue(all(phase.end is not None for phase in phases))
+        self.assertEqual(lala.startup.total(), phases[-1].end)
+        self.assertFalse(lala.startup.tracing())
+        info.assert_any_call("\n".join(lala.startup.breakdown()))
+
+    def test_without_channels(self):
+        lala.startup.start()
+        with mock.patch("logging.info"):
+            self.connect(0)
+        self.assertEqual([phase.label for phase in lala.startup.timeline()],
+                         ["connect", "registration"])
+        self.assertIsNotNone(lala.startup.total())
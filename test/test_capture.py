@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+from ._helpers import mock, FakeClock, LalaTestCase
+from lala import capture, config
+
+
+class TestCapture(LalaTestCase):
+    def setUp(self):
+        super(TestCapture, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "capture")
+        self.clock = FakeClock()
+
+    def capture(self, max_bytes=0, backups=2):
+        return capture.Capture(self.path, max_bytes, backups,
+                               clock=self.clock,
+                               wall_clock=lambda: 1000 + self.clock.now)
+
+    def test_record(self):
+        cap = self.capture()
+        cap.record(b":user!u@host PRIVMSG #channel :hello")
+        self.clock.now = 0.25
+        cap.record(b"PING :server")
+        cap.close()
+        with open(self.path, "rb") as fp:
+            self.assertEqual(fp.read(),
+                             b"# lala-capture 1 1000.000000\n"
+                             b"0 :user!u@host PRIVMSG #channel :hello\n"
+                             b"250000 PING :server\n")
+        self.assertEqual(list(capture.read([self.path])),
+                         [(0, b":user!u@host PRIVMSG #channel :hello"),
+                          (0.25, b"PING :server")])
+
+    def test_rotate(self):
+        cap = self.capture(max_bytes=60)
+        for i in range(10):
+            self.clock.now = i
+            cap.record(b"line %i" % i)
+        cap.close()
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["capture", "capture.1", "capture.2"])
+        paths = [self.path + suffix for suffix in ("", ".1", ".2")]
+        lines = list(capture.read(paths))
+        # The oldest lines have been rotated away
+        self.assertEqual([line for _, line in lines],
+                         [b"line %i" % i for i in range(10 - len(lines), 10)])
+        first = 10 - len(lines)
+        self.assertEqual([offset for offset, _ in lines],
+                         [i - first for i in range(first, 10)])
+
+    def test_reopen(self):
+        cap = self.capture()
+        cap.record(b"line 1")
+        cap.close()
+        # After a restart, monotonic time starts again
+        self.clock.now = 5
+        cap = capture.Capture(self.path, 0, 0, clock=lambda: 0.0,
+                              wall_clock=lambda: 1005.0)
+        cap.record(b"line 2")
+        cap.close()
+        self.assertEqual(list(capture.read([self.path])),
+                         [(0, b"line 1"), (5, b"line 2")])
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as fp:
+            fp.write(b"hello\n")
+        self.assertRaises(ValueError, list, capture.read([self.path]))
+
+    def test_start(self):
+        self.addCleanup(capture.stop)
+        capture.start()
+        self.assertIsNone(capture._CAPTURE)
+        config._set("base", "capture_file", self.path)
+        with mock.patch("lala.capture.reactor"):
+            capture.start()
+        capture.record(b"a line")
+        capture.stop()
+        self.assertEqual([line for _, line in capture.read([self.path])],
+                         [b"a line"])
@@ -0,0 +1,102 @@
+import lala.factory
+import lala.pluginmanager
+import lala.util
+
+from ._helpers import mock, LalaTestCase
+from ._ircserver import FakeIRCServer, LoadGenerator, percentile
+from lala import config
+from twisted.internet.task import Clock
+from twisted.test import iosim
+
+
+class TestFakeIRCServer(LalaTestCase):
+    def setUp(self):
+        super(TestFakeIRCServer, self).setUp()
+        lala.pluginmanager._callbacks.clear()
+        lala.pluginmanager._regexes.clear()
+        self.clock = Clock()
+        clock_patcher = mock.patch("twisted.words.protocols.irc.reactor",
+                                   new=self.clock)
+        clock_patcher.start()
+        self.addCleanup(clock_patcher.stop)
+        self.addCleanup(setattr, lala.util, "_BOT", lala.util._BOT)
+        self.server = FakeIRCServer(channels=2, users=6,
+                                    registered=["admin"], clock=self.clock)
+
+    def connect(self):
+        with mock.patch("lala.pluginmanager.setup"):
+            factory = lala.factory.LalaFactory(
+                ",".join(self.server.channels), "lala")
+        self.bot = factory.buildProtocol(None)
+        server = self.server.buildProtocol(None)
+        self.pump = iosim.connect(server, iosim.makeFakeServer(server),
+                                  self.bot, iosim.makeFakeClient(self.bot))
+        self.run_for(6)
+
+    def run_for(self, seconds, step=0.01):
+        for _ in range(int(round(seconds / step))):
+            self.clock.advance(step)
+            self.pump.flush()
+
+    def test_join(self):
+        self.connect()
+        self.assertTrue(self.server.joined("#channel0"))
+        self.assertTrue(self.server.joined("#channel1"))
+        self.assertEqual(self.server.lines[0].line, "NICK lala")
+
+    def test_whois(self):
+        config._set("base", "nickserv_admin_tracking", "true")
+        config._set("base", "nickserv_password", "secret")
+        config._set("base", "admins", "admin,other")
+        self.connect()
+        self.assertIn("PRIVMSG Nickserv identify secret",
+                      [line.line for line in self.server.lines])
+        self.assertEqual(self.bot.identified_admins, ["admin"])
+
+    def test_load(self):
+        lala.util.command(command="echo")(
+            lambda user, channel, text: lala.util.msg(channel, text))
+        self.connect()
+        self.bot.lineRate = None
+        generator = LoadGenerator(self.server,
+                                  {"privmsg": 50, "command": 10, "join": 5,
+                                   "part": 5, "quit": 1},
+                                  clock=self.clock)
+        generator.start()
+        self.run_for(2)
+        generator.stop()
+        self.assertEqual(generator.sent["privmsg"], 100)
+        self.assertEqual(generator.sent["command"], 20)
+        self.assertEqual(generator.sent["quit"], 2)
+        self.assertEqual(generator.unanswered, 0)
+        self.assertEqual(len(generator.latencies), 20)
+        self.assertTrue(all(0 <= latency <= 0.01
+                            for latency in generator.latencies))
+        replies = [message for message in self.server.messages
+                   if message.text.startswith("request")]
+        self.assertEqual(len(replies), 20)
+
+    def test_line_rate_delays_answers(self):
+        lala.util.command(command="echo")(
+            lambda user, channel, text: lala.util.msg(channel, text))
+        self.connect()
+        generator = LoadGenerator(self.server, {"command": 4},
+                                  clock=self.clock)
+        generator.start()
+        self.run_for(1)
+        generator.stop()
+        self.assertEqual(generator.sent["command"], 4)
+        self.assertEqual(len(self.bot._queue), 3)
+        self.run_for(3)
+        self.assertEqual(generator.unanswered, 0)
+        self.assertGreater(max(generator.latencies), 2)
+
+
+class TestPercentile(LalaTestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([3], 90), 3)
+        self.assertIsNone(percentile([], 50))
@@ -0,0 +1,107 @@
+from ._helpers import mock, LalaTestCase
+from lala import latency, pluginmanager, util
+from twisted.internet.defer import Deferred
+
+
+class TestLatency(LalaTestCase):
+    def setUp(self):
+        super(TestLatency, self).setUp()
+        self.now = 0.0
+        patcher = mock.patch("lala.latency._now", new=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.observed = []
+        latency.add_observer(self.observe)
+        self.addCleanup(latency.remove_observer, self.observe)
+        latency._open.clear()
+
+    def observe(self, trigger, seconds, first):
+        self.observed.append((trigger, seconds, first))
+
+    def test_begin_uses_receipt_time(self):
+        latency.line_received()
+        self.now = 3
+        request = latency.begin("cmd", "#channel")
+        latency.line_handled()
+        self.assertEqual(request.received, 0)
+        self.assertEqual(latency.begin("cmd", "#channel").received, 3)
+
+    def test_sent(self):
+        request = latency.Request("cmd", "#channel")
+        self.now = 2
+        latency.sent(request)
+        self.now = 3
+        latency.sent(request)
+        self.assertEqual(self.observed, [("cmd", 2, True), ("cmd", 3, False)])
+
+    @mock.patch("lala.latency.logging")
+    def test_failing_observer(self, logging):
+        def fail(*args):
+            raise ValueError()
+
+        latency.add_observer(fail)
+        self.addCleanup(latency.remove_observer, fail)
+        latency.sent(latency.Request("cmd", "#channel"))
+        self.assertTrue(logging.exception.called)
+        self.assertEqual(len(self.observed), 1)
+
+    def test_request_for_current(self):
+        request = latency.Request("cmd", "#channel")
+        token = latency.activate(request)
+        try:
+            self.assertIs(latency.request_for("#other"), request)
+        finally:
+            latency.deactivate(token)
+        self.assertIsNone(latency.request_for("#other"))
+
+    def test_request_for_open(self):
+        first = latency.Request("first", "#channel")
+        second = latency.Request("second", "#channel")
+        d1, d2 = Deferred(), Deferred()
+        latency.track(first, d1)
+        latency.track(second, d2)
+        self.assertIs(latency.request_for("#channel"), first)
+        self.assertIsNone(latency.request_for("#other"))
+        d1.callback(None)
+        self.assertIs(latency.request_for("#channel"), second)
+        d2.callback(None)
+        self.assertIsNone(latency.request_for("#channel"))
+        self.assertNotIn("#channel", latency._open)
+
+
+class TestDispatch(LalaTestCase):
+    def setUp(self):
+        super(TestDispatch, self).setUp()
+        pluginmanager._callbacks.clear()
+        pluginmanager._regexes.clear()
+        latency._open.clear()
+        self.requests = []
+
+    def record(self):
+        self.requests.append(latency.request_for("#nowhere"))
+
+    def test_command(self):
+        util.command(command="cmd")(lambda user, channel, text: self.record())
+        pluginmanager._handle_message("user", "#channel", "!cmd")
+        self.assertEqual(self.requests[0].trigger, "cmd")
+        self.assertIsNone(latency.current())
+
+    def test_regex(self):
+        util.regex("^foo")(
+            lambda user, channel, text, match: self.record())
+        pluginmanager._handle_message("user", "#channel", "foo")
+        self.assertEqual(self.requests[0].trigger, "^foo")
+
+    def test_coroutine(self):
+        d = Deferred()
+
+        async def cmd(user, channel, text):
+            await d
+            self.record()
+
+        util.command(command="cmd", timeout=0)(cmd)
+        pluginmanager._handle_message("user", "#channel", "!cmd")
+        self.assertIsNone(latency.current())
+        d.callback(None)
+        self.assertEqual(self.requests[0].trigger, "cmd")
+        self.assertEqual(dict(latency._open), {})
@@ -0,0 +1,153 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+from ._helpers import LalaTestCase
+from lala import logqueue
+
+
+def record(message):
+    return logging.makeLogRecord({"msg": message, "levelno": logging.INFO})
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.calls = []
+
+    def emit(self, record):
+        self.calls.append(("emit", record.getMessage(),
+                           threading.current_thread().name))
+
+    def flush(self):
+        self.calls.append(("flush",))
+
+    def close(self):
+        self.calls.append(("close", threading.current_thread().name))
+        logging.Handler.close(self)
+
+
+class TestLogQueue(LalaTestCase):
+    def setUp(self):
+        super(TestLogQueue, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(logqueue.stop)
+        self.logger = logging.getLogger("lala.test.logqueue")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+        self.addCleanup(self.logger.handlers.clear)
+
+    def read(self, name):
+        with open(os.path.join(self.directory, name)) as fp:
+            return fp.read()
+
+    def test_attach(self):
+        handler = logqueue.FileHandler(os.path.join(self.directory, "log"))
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.addCleanup(handler.close)
+        logqueue.attach(self.logger, handler)
+        self.logger.info("%s: %s", "user", "hello")
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self.logger.exception("Failed")
+        logqueue.flush()
+        content = self.read("log")
+        self.assertTrue(content.startswith("INFO user: hello\nERROR Failed\n"
+                                           "Traceback"))
+        self.assertIn("ValueError: broken", content)
+
+    def test_writer_thread(self):
+        handler = RecordingHandler()
+        logqueue.attach(self.logger, handler)
+        self.logger.info("hello")
+        logqueue.flush()
+        self.assertEqual(handler.calls, [("emit", "hello", "lala-log"),
+                                         ("flush",)])
+
+    def test_prepare(self):
+        handler = logqueue._QueueHandler(())
+        lazy = handler.prepare(logging.makeLogRecord(
+            {"msg": "%s: %i", "args": ("user", 1)}))
+        self.assertEqual((lazy.msg, lazy.args), ("%s: %i", ("user", 1)))
+        eager = handler.prepare(logging.makeLogRecord(
+            {"msg": "%s", "args": ([1],)}))
+        self.assertEqual((eager.msg, eager.args), ("[1]", None))
+
+    def test_mutable_arguments(self):
+        handler = RecordingHandler()
+        logqueue.attach(self.logger, handler)
+        users = ["user"]
+        self.logger.info("%s joined", users)
+        users.append("other")
+        logqueue.flush()
+        self.assertEqual(handler.calls[0][1], "['user'] joined")
+
+    def test_handler_level(self):
+        info = RecordingHandler(logging.INFO)
+        debug = RecordingHandler()
+        logqueue.attach(self.logger, info, debug)
+        self.logger.debug("debug")
+        self.logger.info("info")
+        logqueue.flush()
+        self.assertEqual([call[1] for call in info.calls if len(call) > 1],
+                         ["info"])
+        self.assertEqual([call[1] for call in debug.calls if len(call) > 1],
+                         ["debug", "info"])
+
+    def test_flush_per_batch(self):
+        first = RecordingHandler()
+        second = RecordingHandler()
+        batch = [((first, second), record("a")),
+                 ((first,), record("b")),
+                 ((first, second), record("c"))]
+        logqueue._write(batch)
+        self.assertEqual([call[:2] for call in first.calls],
+                         [("emit", "a"), ("emit", "b"), ("emit", "c"),
+                          ("flush",)])
+        self.assertEqual([call[:2] for call in second.calls],
+                         [("emit", "a"), ("emit", "c"), ("flush",)])
+
+    def test_file_flushed_per_batch(self):
+        handler = logqueue.FileHandler(os.path.join(self.directory, "log"))
+        self.addCleanup(handler.close)
+        handler.handle(record("hello"))
+        self.assertEqual(self.read("log"), "")
+        handler.flush()
+        self.assertEqual(self.read("log"), "hello\n")
+
+    def test_stop(self):
+        handler = RecordingHandler()
+        logqueue.attach(self.logger, handler)
+        self.logger.info("queued")
+        logqueue.stop()
+        self.assertIsNone(logqueue._LISTENER)
+        self.assertEqual(handler.calls[0][:2], ("emit", "queued"))
+        # Afterwards, records are written right away
+        self.logger.info("direct")
+        self.assertEqual(handler.calls[-2:],
+                         [("emit", "direct",
+                           threading.current_thread().name), ("flush",)])
+        # Flushing doesn't wait for anything
+        logqueue.flush()
+
+    def test_detach(self):
+        handler = RecordingHandler()
+        queued = logqueue.attach(self.logger, handler)
+        self.logger.info("hello")
+        logqueue.detach(self.logger, queued)
+        self.assertNotIn(queued, self.logger.handlers)
+        # Closed in the writer thread after writing the queued records
+        self.assertEqual(handler.calls, [("emit", "hello", "lala-log"),
+                                         ("flush",), ("close", "lala-log")])
+        self.logger.info("ignored")
+        self.assertEqual(len(handler.calls), 3)
+
+    def test_start_once(self):
+        logqueue.start()
+        listener = logqueue._LISTENER
+        logqueue.start()
+        self.assertIs(logqueue._LISTENER, listener)
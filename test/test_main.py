@@ -0,0 +1,61 @@
+import lala.main
+
+from ._helpers import mock, LalaTestCase
+from twisted.internet.defer import Deferred
+from twisted.application import service
+from twisted.internet.task import Clock
+
+
+class TestGate(LalaTestCase):
+    def setUp(self):
+        super(TestGate, self).setUp()
+        self.clock = Clock()
+        self.ready = Deferred()
+
+    def client(self, timeout=30):
+        self.tcp = service.Service()
+        self.tcp.startService = mock.Mock(wraps=self.tcp.startService)
+        client = lala.main._Gate(self.ready, timeout, self.tcp,
+                                 reactor=self.clock)
+        client.startService()
+        return client
+
+    def test_waits_until_ready(self):
+        client = self.client()
+        self.clock.advance(10)
+        self.assertFalse(self.tcp.startService.called)
+        self.ready.callback(None)
+        self.tcp.startService.assert_called_once_with()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    @mock.patch("logging.warning")
+    def test_timeout(self, warning):
+        client = self.client()
+        self.clock.advance(30)
+        self.tcp.startService.assert_called_once_with()
+        self.assertTrue(warning.called)
+        self.ready.callback(None)
+        self.tcp.startService.assert_called_once_with()
+
+    def test_no_timeout(self):
+        client = self.client(0)
+        self.tcp.startService.assert_called_once_with()
+
+    def test_already_ready(self):
+        self.ready.callback(None)
+        client = self.client()
+        self.tcp.startService.assert_called_once_with()
+
+    def test_stopped_while_waiting(self):
+        client = self.client()
+        client.stopService()
+        self.ready.callback(None)
+        self.assertIsNone(self.tcp.parent)
+        self.assertFalse(self.tcp.startService.called)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_stops_client(self):
+        client = self.client(0)
+        self.assertTrue(self.tcp.running)
+        client.stopService()
+        self.assertFalse(self.tcp.running)
@@ -0,0 +1,121 @@
+import os
+import sys
+import tracemalloc
+import types
+
+from ._helpers import mock, LalaTestCase
+from lala import config, memory
+
+_PLUGIN_SOURCE = """
+_cache = []
+
+
+class Entry(object):
+    def __init__(self):
+        self.data = bytearray(1024)
+
+
+def grow(count):
+    _cache.extend(Entry() for _ in range(count))
+"""
+
+
+class TestMemory(LalaTestCase):
+    def setUp(self):
+        super(TestMemory, self).setUp()
+        config._set("base", "memory_frames", "5")
+        # A plugin whose allocations can be recognized
+        filename = os.path.join(os.path.dirname(memory.__file__), "plugins",
+                                "_leaky.py")
+        module = types.ModuleType("lala.plugins._leaky")
+        module.__file__ = filename
+        exec(compile(_PLUGIN_SOURCE, filename, "exec"), module.__dict__)
+        self.plugin = module
+        self.entry = "lala.plugins._leaky.Entry: "
+        patcher = mock.patch.dict(sys.modules, {module.__name__: module})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if memory.tracking():
+            memory.stop_tracking()
+        super(TestMemory, self).tearDown()
+
+    def test_report(self):
+        memory.start_tracking()
+        self.plugin.grow(100)
+        lines = memory.report(100)
+        [line] = [line for line in lines if line.startswith("_leaky: ")]
+        self.assertIn("since start", line)
+        self.assertGreaterEqual(memory.plugin_statistics()["_leaky"],
+                                100 * 1024)
+        [line] = [line for line in lines if line.startswith(self.entry)]
+        self.assertIn("(+100 since start, +100 since the last report)", line)
+
+        # The next report compares to this one
+        lines = memory.report(100)
+        [line] = [line for line in lines if line.startswith(self.entry)]
+        self.assertIn("+100 since start, +0 since the last report", line)
+
+    def test_stop(self):
+        memory.start_tracking()
+        self.assertTrue(tracemalloc.is_tracing())
+        memory.stop_tracking()
+        self.assertFalse(memory.tracking())
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(memory.plugin_statistics(), {})
+
+    def test_errors(self):
+        self.assertRaises(memory.MemoryTrackingError, memory.stop_tracking)
+        self.assertRaises(memory.MemoryTrackingError, memory.report, 1)
+        memory.start_tracking()
+        self.assertRaises(memory.MemoryTrackingError, memory.start_tracking)
+
+    def test_start_disabled(self):
+        config._set("base", "memory_interval", "0")
+        memory.start()
+        self.assertFalse(memory.tracking())
+
+    def test_owner(self):
+        owners = {"/lala/util.py": "lala", "/lala/plugins/quotes.py": "quotes"}
+
+        def traceback(*filenames):
+            # The most recent frame first
+            return tuple((filename, 1) for filename in filenames)
+
+        self.assertEqual(memory._owner(traceback(
+            "/lala/util.py", "/lib/sqlite.py", "/lala/plugins/quotes.py",
+            "/lala/util.py"), owners), "quotes")
+        self.assertEqual(memory._owner(traceback(
+            "/lala/util.py", "/twisted/reactor.py"), owners), "lala")
+        self.assertEqual(memory._owner(traceback("/lib/x.py"), owners),
+                         "other")
+
+    def test_traces(self):
+        tracemalloc.start(5)
+        self.addCleanup(tracemalloc.stop)
+        self.plugin.grow(10)
+        snapshot = tracemalloc.take_snapshot()
+
+        def totals(traces):
+            result = {}
+            for size, frames in traces:
+                result[frames] = result.get(frames, 0) + size
+            return result
+
+        raw = totals(memory._traces(snapshot))
+        # Other Pythons use the public statistics
+        with mock.patch("lala.memory._RAW_TRACES", False):
+            self.assertEqual(totals(memory._traces(snapshot)), raw)
+
+    def test_traces_without_total_nframe(self):
+        # Before Python 3.9, the raw traces had no total number of frames
+        frames = (("/lala/util.py", 1),)
+        snapshot = mock.Mock(traces=mock.Mock(_traces=[(0, 10, frames)]))
+        with mock.patch("lala.memory._RAW_TRACES", True):
+            self.assertEqual(list(memory._traces(snapshot)), [(10, frames)])
+
+    def test_format_size(self):
+        self.assertEqual(memory._format_size(100), "100 B")
+        self.assertEqual(memory._format_size(-2048, True), "-2.0 KiB")
+        self.assertEqual(memory._format_size(3 * 1024 ** 3), "3.0 GiB")
@@ -1,12 +1,17 @@
+import sys
+
 from ._helpers import mock
 
 from ._helpers import (command_func_generator, irc_nickname, irc_nickname_list,
                        bot_command, bot_command_list, LalaTestCase)
 from hypothesis import assume, given
-from lala import util, pluginmanager
+from lala import config, util, pluginmanager
+from functools import partial
 from re import compile
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
+from types import ModuleType
 
 
 def f(user, channel, text):
@@ -31,6 +36,9 @@ class TestPluginmanager(LalaTestCase):
         pluginmanager._callbacks.clear()
         pluginmanager._regexes.clear()
         pluginmanager._join_callbacks = pluginmanager._join_callbacks[:0]
+        pluginmanager._lazy_plugins.clear()
+        pluginmanager._jobs.clear()
+        pluginmanager._timeouts.clear()
 
     def execute_example(self, f):
         self.setUp()
@@ -263,3 +271,637 @@ class TestPluginmanager(LalaTestCase):
         self.assertEqual(errb.call_count, 2)
         c = [mock.call("gandalf", "#channel", f)] * 2
         self.assertEqual(c, errb.call_args_list)
+
+    def load_plugin(self, name):
+        """Loads the plugin ``name`` and makes sure it's imported from scratch
+        by the next test needing it."""
+        modname = "%s.%s" % (pluginmanager.PLUGIN_PACKAGE, name)
+        self.addCleanup(sys.modules.pop, modname, None)
+        pluginmanager.load_plugin(name)
+        return sys.modules[modname]
+
+    def test_load_plugin(self):
+        self.load_plugin("calendar")
+        self.assertIn("weeknum", pluginmanager._callbacks)
+        self.assertEqual(pluginmanager._callbacks["weeknum"].plugin,
+                         "calendar")
+
+    def test_describe_plugin(self):
+        self.load_plugin("last")
+        entry = pluginmanager._describe_plugin("last")
+        self.assertEqual([c["trigger"] for c in entry["commands"]], ["last"])
+        self.assertEqual([r["pattern"] for r in entry["regexes"]], [".*"])
+        self.assertTrue(pluginmanager._manifest_entry_is_fresh("last", entry))
+        entry["mtime"] -= 1
+        self.assertFalse(pluginmanager._manifest_entry_is_fresh("last", entry))
+
+    def test_lazy_plugin_imported_on_first_use(self):
+        self.load_plugin("calendar")
+        entry = pluginmanager._describe_plugin("calendar")
+        pluginmanager._callbacks.clear()
+
+        pluginmanager._register_lazy("calendar", entry)
+        self.assertIn("calendar", pluginmanager._lazy_plugins)
+        self.assertIn("weeknum", pluginmanager._callbacks)
+
+        pluginmanager._handle_message("user", "#channel", "!weeknum")
+        self.assertTrue(util._BOT.msg.called)
+        self.assertNotIn("calendar", pluginmanager._lazy_plugins)
+        self.assertEqual(pluginmanager._callbacks["weeknum"].func.__name__,
+                         "weeknum")
+
+    def test_lazy_regex_imported_on_first_use(self):
+        mod = self.load_plugin("last")
+        entry = pluginmanager._describe_plugin("last")
+        pluginmanager._callbacks.clear()
+        pluginmanager._regexes.clear()
+
+        pluginmanager._register_lazy("last", entry)
+        pluginmanager._handle_message("user", "#channel", "text")
+        self.assertNotIn("last", pluginmanager._lazy_plugins)
+        self.assertEqual(len(pluginmanager._regexes), 1)
+        self.assertEqual(len(mod._chatlog), 1)
+
+    def lazy_module(self, init, threaded=False):
+        """Registers a placeholder for the command ``f`` of this module,
+        whose import registers ``f`` and whose init function is ``init``."""
+        calls = []
+
+        def f(user, channel, text):
+            calls.append(text)
+
+        def import_plugin(name):
+            util.command(command="f", threaded=threaded)(f)
+            mod = ModuleType(name)
+            mod.init = init
+            return mod
+
+        patcher = mock.patch("lala.pluginmanager._import_plugin",
+                             side_effect=import_plugin)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        pluginmanager._register_lazy("test_pluginmanager", {
+            "commands": [{"trigger": "f", "doc": None, "admin_only": False,
+                          "aliases": [],
+                          "options": {"threaded": threaded}}],
+            "regexes": [], "join_callbacks": []})
+        return calls
+
+    def test_lazy_command_waits_for_init(self):
+        initialized = Deferred()
+        calls = self.lazy_module(lambda: initialized)
+        pluginmanager._handle_message("user", "#channel", "!f one")
+        pluginmanager._handle_message("user", "#channel", "!f two")
+        self.assertEqual(calls, [])
+        self.assertIn("test_pluginmanager", pluginmanager._lazy_inits)
+        initialized.callback(None)
+        self.assertEqual(calls, ["one", "two"])
+        self.assertEqual(pluginmanager._lazy_inits, {})
+        pluginmanager._handle_message("user", "#channel", "!f three")
+        self.assertEqual(calls, ["one", "two", "three"])
+
+    def test_lazy_init_failure(self):
+        initialized = Deferred()
+        calls = self.lazy_module(lambda: initialized)
+        with mock.patch("lala.pluginmanager.logging") as logging:
+            pluginmanager._handle_message("user", "#channel", "!f one")
+            initialized.errback(ValueError())
+            self.assertTrue(logging.error.called)
+        self.assertEqual(calls, [])
+        util._BOT.msg.assert_called_once_with(
+            "#channel", "user: whoops, something went wrong while processing "
+            "your command!", True)
+        # The next call tries again
+        self.assertIn("test_pluginmanager", pluginmanager._lazy_plugins)
+
+    @mock.patch("lala.threadpool.run_in_thread")
+    def test_lazy_threaded_command(self, run_in_thread):
+        run_in_thread.return_value = succeed(None)
+        init = mock.Mock(return_value=None)
+        self.lazy_module(init, threaded=True)
+        # The plugin is imported and initialized on the reactor thread
+        self.assertFalse(pluginmanager._callbacks["f"].threaded)
+        pluginmanager._handle_message("user", "#channel", "!f one")
+        self.assertTrue(init.called)
+        func = pluginmanager._callbacks["f"]
+        self.assertTrue(func.threaded)
+        run_in_thread.assert_called_once_with(func.func, "user", "#channel",
+                                              "one")
+
+    def test_setup_lazy_uses_manifest(self):
+        with mock.patch.multiple("lala.pluginmanager",
+                                 _get_enabled_plugins=mock.DEFAULT,
+                                 _load_manifest=mock.DEFAULT,
+                                 _save_manifest=mock.DEFAULT,
+                                 _import_plugin=mock.DEFAULT) as mocks:
+            config._set("base", "lazy_plugins", "true")
+            mocks["_get_enabled_plugins"].return_value = ["calendar"]
+            mocks["_load_manifest"].return_value = {}
+            mocks["_import_plugin"].side_effect = ModuleType
+            pluginmanager.setup()
+            manifest = mocks["_save_manifest"].call_args[0][0]
+            self.assertIn("calendar", manifest)
+
+            mocks["_import_plugin"].reset_mock()
+            mocks["_save_manifest"].reset_mock()
+            mocks["_load_manifest"].return_value = manifest
+            pluginmanager.setup()
+            mocks["_import_plugin"].assert_called_once_with("base")
+            self.assertFalse(mocks["_save_manifest"].called)
+            self.assertIn("calendar", pluginmanager._lazy_plugins)
+
+            # Plugins starting servers in their init function opt out
+            pluginmanager._lazy_plugins.clear()
+            mocks["_import_plugin"].reset_mock()
+            manifest["calendar"]["lazy"] = False
+            pluginmanager.setup()
+            mocks["_import_plugin"].assert_any_call("calendar")
+            self.assertNotIn("calendar", pluginmanager._lazy_plugins)
+
+    def test_reload_plugin_keeps_other_plugins(self):
+        util.command(f)
+        mod = self.load_plugin("calendar")
+        live_callbacks = pluginmanager._callbacks
+        other = live_callbacks["f"]
+        weeknum = live_callbacks["weeknum"]
+
+        with mock.patch.object(mod, "teardown", create=True) as teardown:
+            pluginmanager._reload_plugin("calendar")
+            teardown.assert_called_once_with()
+
+        self.assertIs(pluginmanager._callbacks["f"], other)
+        self.assertIsNot(pluginmanager._callbacks["weeknum"], weeknum)
+        # The old table has been replaced, not modified
+        self.assertIsNot(pluginmanager._callbacks, live_callbacks)
+        self.assertIs(live_callbacks["weeknum"], weeknum)
+
+    def test_reload_plugin_failure_keeps_tables(self):
+        mod = self.load_plugin("calendar")
+        weeknum = pluginmanager._callbacks["weeknum"]
+
+        with mock.patch("lala.pluginmanager._import_plugin") as import_plugin, \
+                mock.patch.object(mod, "teardown", create=True) as teardown:
+            import_plugin.side_effect = ImportError()
+            d = pluginmanager._reload_plugin("calendar")
+            # The current version keeps its resources
+            self.assertFalse(teardown.called)
+        failures = []
+        d.addErrback(failures.append)
+        self.assertTrue(failures[0].check(ImportError))
+        self.assertIs(pluginmanager._callbacks["weeknum"], weeknum)
+
+    def test_reload_plugin_init_failure(self):
+        mod = self.load_plugin("calendar")
+        weeknum = pluginmanager._callbacks["weeknum"]
+        new = ModuleType("calendar")
+        new.init = mock.Mock(side_effect=ValueError())
+
+        with mock.patch("lala.pluginmanager._import_plugin",
+                        return_value=new), \
+                mock.patch("lala.pluginmanager.logging"), \
+                mock.patch.object(mod, "teardown", create=True) as teardown, \
+                mock.patch.object(mod, "init", create=True) as init:
+            d = pluginmanager._reload_plugin("calendar")
+            teardown.assert_called_once_with()
+            # The current version is initialized again
+            init.assert_called_once_with()
+        failures = []
+        d.addErrback(failures.append)
+        self.assertTrue(failures[0].check(ValueError))
+        self.assertIs(sys.modules["lala.plugins.calendar"], mod)
+        self.assertIs(pluginmanager._callbacks["weeknum"], weeknum)
+
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    def test_reload_replaces_all_tables(self, enabled):
+        enabled.return_value = ["calendar"]
+        util.command(f)
+        self.load_plugin("calendar")
+        self.addCleanup(sys.modules.pop, "lala.plugins.base", None)
+
+        pluginmanager._reload()
+        self.assertNotIn("f", pluginmanager._callbacks)
+        self.assertIn("weeknum", pluginmanager._callbacks)
+        self.assertIn("pluginupdate", pluginmanager._callbacks)
+
+    @mock.patch("lala.pluginmanager._teardown")
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    def test_reload_failure_keeps_plugins(self, enabled, teardown):
+        enabled.return_value = ["calendar"]
+        self.load_plugin("calendar")
+        weeknum = pluginmanager._callbacks["weeknum"]
+        with mock.patch("lala.pluginmanager._import_plugin",
+                        side_effect=ImportError()):
+            d = pluginmanager._reload()
+        self.assertFalse(teardown.called)
+        self.assertIs(pluginmanager._callbacks["weeknum"], weeknum)
+        d.addErrback(lambda failure: failure.trap(ImportError))
+
+    @mock.patch("lala.threadpool.run_in_thread")
+    def test_threaded_command(self, run_in_thread):
+        run_in_thread.return_value = succeed(None)
+        util.command(command="threaded", threaded=True)(f)
+        self.assertTrue(pluginmanager._callbacks["threaded"].threaded)
+        pluginmanager._handle_message("user", "#channel", "!threaded text")
+        run_in_thread.assert_called_once_with(f, "user", "#channel", "text")
+
+    @mock.patch("lala.threadpool.run_in_thread")
+    def test_threaded_regex(self, run_in_thread):
+        run_in_thread.return_value = succeed(None)
+        regex = compile("test")
+        util.regex(regex, threaded=True)(regex_f)
+        pluginmanager._handle_message("user", "#channel", "test")
+        self.assertEqual(run_in_thread.call_args[0][0], regex_f)
+
+    @mock.patch("lala.pluginmanager._generic_errback")
+    @mock.patch("lala.threadpool.run_in_thread")
+    def test_threaded_command_errback(self, run_in_thread, errback):
+        d = Deferred()
+        run_in_thread.return_value = d
+        util.command(command="threaded", threaded=True)(f)
+        pluginmanager._handle_message("user", "#channel", "!threaded")
+        failure = Failure(ValueError(""))
+        d.errback(failure)
+        errback.assert_called_once_with("user", "#channel", failure)
+
+    def test_max_concurrency(self):
+        deferreds = []
+
+        def limited(user, channel, text):
+            d = Deferred()
+            deferreds.append(d)
+            return d
+
+        util.command(command="limited", max_concurrency=1, max_queue=1)(
+            limited)
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        self.assertEqual(len(deferreds), 1)
+        self.assertEqual(pluginmanager.concurrency_statistics(),
+                         {"limited": {"limit": 1,
+                                      "in_flight": 1,
+                                      "queued": 1}})
+
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        util._BOT.msg.assert_called_once_with(
+            "#channel",
+            "Sorry user, too many people are using limited right now, "
+            "please try again later",
+            True)
+
+        deferreds[0].callback(None)
+        self.assertEqual(len(deferreds), 2)
+        deferreds[1].callback(None)
+        self.assertEqual(pluginmanager.concurrency_statistics()["limited"],
+                         {"limit": 1, "in_flight": 0, "queued": 0})
+
+    def test_max_concurrency_survives_reload(self):
+        def limited(user, channel, text):
+            return Deferred()
+
+        def register(max_concurrency):
+            util.command(command="limited", max_concurrency=max_concurrency,
+                         max_queue=1)(limited)
+
+        register(1)
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        semaphore = pluginmanager._callbacks["limited"].semaphore
+        plugin = pluginmanager._callbacks["limited"].plugin
+
+        pluginmanager._staged(partial(register, 1), [plugin])
+        self.assertIs(pluginmanager._callbacks["limited"].semaphore,
+                      semaphore)
+        self.assertEqual(pluginmanager.concurrency_statistics()["limited"],
+                         {"limit": 1, "in_flight": 1, "queued": 1})
+        # A changed limit starts over
+        pluginmanager._staged(partial(register, 2), [plugin])
+        self.assertIsNot(pluginmanager._callbacks["limited"].semaphore,
+                         semaphore)
+
+    @mock.patch("lala.pluginmanager._generic_errback")
+    def test_max_concurrency_releases_on_exception(self, errback):
+        util.command(command="f3", max_concurrency=1)(f3)
+        pluginmanager._handle_message("user", "#channel", "!f3")
+        pluginmanager._handle_message("user", "#channel", "!f3")
+        self.assertEqual(errback.call_count, 2)
+        self.assertEqual(pluginmanager._callbacks["f3"].semaphore.tokens, 1)
+
+    def test_max_concurrency_waits_for_generators(self):
+        deferreds = [Deferred(), Deferred()]
+
+        def limited(user, channel, text):
+            for d in deferreds:
+                yield d
+
+        util.command(command="limited", max_concurrency=1)(limited)
+        pluginmanager._handle_message("user", "#channel", "!limited")
+        semaphore = pluginmanager._callbacks["limited"].semaphore
+        deferreds[0].callback(None)
+        self.assertEqual(semaphore.tokens, 0)
+        deferreds[1].callback(None)
+        self.assertEqual(semaphore.tokens, 1)
+
+    def test_describe_plugin_keeps_options(self):
+        self.load_plugin("quotes")
+        entry = pluginmanager._describe_plugin("quotes")
+        pluginmanager._callbacks.clear()
+
+        pluginmanager._register_lazy("quotes", entry)
+        func = pluginmanager._callbacks["searchquote"]
+        self.assertEqual(func.max_concurrency, 2)
+        self.assertIs(pluginmanager._callbacks["qsearch"], func)
+
+    @mock.patch("lala.pluginmanager.reactor", new_callable=Clock)
+    def test_timeout(self, clock):
+        d = Deferred()
+        util.command(command="slow", timeout=10)(lambda u, c, t: d)
+        pluginmanager._handle_message("user", "#channel", "!slow")
+        self.assertEqual([job.trigger for job in pluginmanager.jobs()],
+                         ["slow"])
+
+        clock.advance(10)
+        self.assertEqual(pluginmanager.jobs(), [])
+        self.assertEqual(pluginmanager.timeout_statistics(), {"slow": 1})
+        util._BOT.msg.assert_called_once_with(
+            "#channel", "user: sorry, slow took too long and has been "
+            "cancelled", True)
+
+    @mock.patch("lala.pluginmanager.reactor", new_callable=Clock)
+    def test_default_timeout(self, clock):
+        config._set("base", "command_timeout", "5")
+        deferreds = [Deferred(), Deferred()]
+
+        def slow(user, channel, text):
+            for d in deferreds:
+                yield d
+
+        util.command(command="slow")(slow)
+        pluginmanager._handle_message("user", "#channel", "!slow")
+        deferreds[0].callback(None)
+        self.assertEqual(len(pluginmanager.jobs()), 1)
+        clock.advance(5)
+        self.assertEqual(pluginmanager.timeout_statistics(), {"slow": 1})
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    @mock.patch("lala.pluginmanager.reactor", new_callable=Clock)
+    def test_no_timeout(self, clock):
+        util.command(command="slow", timeout=0)(lambda u, c, t: Deferred())
+        pluginmanager._handle_message("user", "#channel", "!slow")
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(len(pluginmanager.jobs()), 1)
+
+    @mock.patch("lala.pluginmanager.reactor", new_callable=Clock)
+    def test_no_timeout_fired(self, clock):
+        util.command(command="fast", timeout=10)(
+            lambda u, c, t: succeed(None))
+        with mock.patch("twisted.internet.defer.Deferred.addTimeout") as add:
+            pluginmanager._handle_message("user", "#channel", "!fast")
+        add.assert_not_called()
+        self.assertEqual(pluginmanager.jobs(), [])
+
+    def test_cancel_job(self):
+        cancelled = []
+        d = Deferred(cancelled.append)
+        util.command(command="slow", timeout=0)(lambda u, c, t: d)
+        pluginmanager._handle_message("user", "#channel", "!slow")
+        job = pluginmanager.jobs()[0]
+
+        self.assertTrue(pluginmanager.cancel_job(job.id))
+        self.assertEqual(cancelled, [d])
+        self.assertFalse(pluginmanager.cancel_job(job.id))
+        self.assertEqual(pluginmanager.timeout_statistics(), {})
+        util._BOT.msg.assert_called_once_with(
+            "#channel", "user: slow has been cancelled", True)
+
+    def test_coroutine_command(self):
+        d = Deferred()
+
+        async def coro(user, channel, text):
+            result = await d
+            util.msg(channel, result)
+
+        util.command(command="coro")(coro)
+        pluginmanager._handle_message("user", "#channel", "!coro")
+        self.assertEqual([job.trigger for job in pluginmanager.jobs()],
+                         ["coro"])
+        d.callback("done")
+        util._BOT.msg.assert_called_once_with("#channel", "done", True)
+        self.assertEqual(pluginmanager.jobs(), [])
+
+    @mock.patch("lala.pluginmanager._generic_errback")
+    def test_coroutine_regex_errback(self, errback):
+        async def coro(user, channel, text, match):
+            raise ValueError()
+
+        util.regex("test")(coro)
+        pluginmanager._handle_message("user", "#channel", "test")
+        self.assertTrue(errback.call_args[0][2].check(ValueError))
+
+    def test_coroutine_join_callback(self):
+        joined = []
+
+        async def coro(user, channel):
+            joined.append((user, channel))
+
+        util.on_join(coro)
+        pluginmanager.on_join("user", "#channel")
+        self.assertEqual(joined, [("user", "#channel")])
+
+    def observe(self):
+        observer = mock.Mock()
+        pluginmanager.add_dispatch_observer(observer)
+        self.addCleanup(pluginmanager.remove_dispatch_observer, observer)
+        return observer
+
+    def test_dispatch_observer_command(self):
+        observer = self.observe()
+        util.command(f)
+        pluginmanager._handle_message("user", "#channel", "!f")
+        kind, plugin, trigger, sync, total, failed = observer.call_args[0]
+        self.assertEqual((kind, plugin, trigger, failed),
+                         ("command", "test_pluginmanager", "f", False))
+        self.assertEqual(sync, total)
+
+    def test_dispatch_observer_deferred(self):
+        observer = self.observe()
+        d = Deferred()
+        util.command(command="slow", timeout=0)(lambda u, c, t: d)
+        pluginmanager._handle_message("user", "#channel", "!slow")
+        self.assertFalse(observer.called)
+        d.callback(None)
+        kind, plugin, trigger, sync, total, failed = observer.call_args[0]
+        self.assertEqual(trigger, "slow")
+        self.assertGreaterEqual(total, sync)
+        self.assertFalse(failed)
+
+    @mock.patch("lala.pluginmanager._generic_errback")
+    def test_dispatch_observer_failure(self, errback):
+        errback.side_effect = lambda user, channel, failure: failure
+        observer = self.observe()
+        d = Deferred()
+        util.regex("test", timeout=0)(lambda u, c, t, m: d)
+        pluginmanager._handle_message("user", "#channel", "test")
+        d.errback(ValueError())
+        self.assertEqual(observer.call_args[0][0], "regex")
+        self.assertTrue(observer.call_args[0][5])
+        d.addErrback(lambda failure: None)
+
+    def test_dispatch_observer_exception(self):
+        observer = self.observe()
+        util.command(command="f3")(f3)
+        self.assertRaises(ValueError, pluginmanager._handle_message,
+                          "user", "#channel", "!f3")
+        self.assertTrue(observer.call_args[0][5])
+
+    def test_dispatch_observer_join(self):
+        observer = self.observe()
+        util.on_join(f2)
+        pluginmanager.on_join("user", "#channel")
+        self.assertEqual(observer.call_args[0][:3],
+                         ("join", "test_pluginmanager", "f2"))
+
+    def test_failing_dispatch_observer(self):
+        self.observe().side_effect = ValueError()
+        mocked_f = mock.Mock(spec=f)
+        pluginmanager.register_callback("f", mocked_f)
+        pluginmanager._handle_message("user", "#channel", "!f")
+        self.assertTrue(mocked_f.called)
+
+
+class TestInitPlugins(LalaTestCase):
+    def setUp(self):
+        super(TestInitPlugins, self).setUp()
+        self.calls = []
+        self.deferreds = {}
+
+    def module(self, name, dependencies=(), deferred=False, error=None):
+        mod = ModuleType(name)
+        if dependencies:
+            mod.DEPENDENCIES = dependencies
+
+        def init():
+            self.calls.append(name)
+            if error is not None:
+                raise error
+            if deferred:
+                self.deferreds[name] = Deferred()
+                return self.deferreds[name]
+        mod.init = init
+        return mod
+
+    def test_concurrent(self):
+        modules = {"a": self.module("a", deferred=True),
+                   "b": self.module("b", deferred=True)}
+        initialized = []
+        pluginmanager._init_plugins(modules).addCallback(initialized.append)
+        self.assertEqual(self.calls, ["a", "b"])
+        self.deferreds["b"].callback(None)
+        self.assertEqual(initialized, [])
+        self.deferreds["a"].callback(None)
+        self.assertEqual(initialized, [["a", "b"]])
+
+    def test_dependencies(self):
+        modules = {"user": self.module("user", ("database",)),
+                   "database": self.module("database", deferred=True),
+                   "other": self.module("other")}
+        initialized = []
+        pluginmanager._init_plugins(modules).addCallback(initialized.append)
+        self.assertEqual(self.calls, ["database", "other"])
+        self.deferreds["database"].callback(None)
+        self.assertEqual(self.calls, ["database", "other", "user"])
+        self.assertEqual(initialized, [["user", "database", "other"]])
+
+    @mock.patch("logging.error")
+    def test_failed_dependency(self, error):
+        modules = {"user": self.module("user", ("database",)),
+                   "database": self.module("database", error=ValueError()),
+                   "other": self.module("other")}
+        initialized = []
+        pluginmanager._init_plugins(modules).addCallback(initialized.append)
+        self.assertEqual(self.calls, ["database", "other"])
+        self.assertEqual(initialized, [["other"]])
+        self.assertEqual(error.call_count, 2)
+        error.assert_called_with("Not initializing %s because initializing "
+                                 "%s failed", "user", "database")
+
+    def test_missing_dependency(self):
+        modules = {"user": self.module("user", ("database",))}
+        self.assertRaises(ValueError, pluginmanager._init_plugins, modules)
+        self.assertEqual(self.calls, [])
+
+    def test_cycle(self):
+        modules = {"a": self.module("a", ("b",)),
+                   "b": self.module("b", ("c",)),
+                   "c": self.module("c", ("a",))}
+        with self.assertRaises(ValueError) as context:
+            pluginmanager._init_plugins(modules)
+        self.assertEqual(str(context.exception),
+                         "The plugins a -> b -> c -> a depend on each other")
+
+    @mock.patch("lala.pluginmanager._save_manifest")
+    @mock.patch("lala.pluginmanager._load_manifest")
+    @mock.patch("lala.pluginmanager._manifest_entry_is_fresh")
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    @mock.patch("lala.pluginmanager._register_lazy")
+    @mock.patch("lala.pluginmanager._import_plugin")
+    def test_setup_imports_lazy_dependencies(self, import_plugin,
+                                             register_lazy, enabled, fresh,
+                                             load_manifest, save_manifest):
+        config._set("base", "lazy_plugins", "true")
+        enabled.return_value = ["user", "database", "other", "lazy"]
+        fresh.return_value = True
+        entry = {"commands": [], "regexes": [], "join_callbacks": []}
+        load_manifest.return_value = {
+            "database": entry, "other": entry,
+            "lazy": dict(entry, dependencies=["other"])}
+        import_plugin.side_effect = lambda name: self.module(
+            name, ("database",) if name == "user" else ())
+        with mock.patch("lala.pluginmanager._describe_plugin",
+                        return_value=entry):
+            ready = pluginmanager.setup()
+        # other is required by a lazy plugin, database by user
+        self.assertEqual([call[0][0] for call in import_plugin.call_args_list],
+                         ["user", "other", "database", "base"])
+        register_lazy.assert_called_once_with("lazy", load_manifest()["lazy"])
+        self.assertEqual(self.calls, ["database", "user", "other", "base"])
+        fired = []
+        ready.addCallback(fired.append)
+        self.assertEqual(fired, [None])
+
+    @mock.patch("lala.pluginmanager._teardown")
+    @mock.patch("lala.pluginmanager._import_plugin")
+    def test_reload_plugin_waits_for_init(self, import_plugin, teardown):
+        import_plugin.return_value = self.module("calendar", deferred=True)
+        self.addCleanup(pluginmanager._replace_module, "calendar", None)
+        reloaded = []
+        pluginmanager._reload_plugin("calendar").addCallback(reloaded.append)
+        self.assertEqual(reloaded, [])
+        self.deferreds["calendar"].callback("initialized")
+        self.assertEqual(reloaded, ["initialized"])
+
+    @mock.patch("lala.pluginmanager._teardown")
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    @mock.patch("lala.pluginmanager._import_plugin")
+    def test_reload_waits_for_init(self, import_plugin, enabled, teardown):
+        enabled.return_value = ["calendar"]
+        util.command(f)
+        old = pluginmanager._callbacks["f"]
+        modules = {"calendar": self.module("calendar", deferred=True),
+                   "base": self.module("base")}
+
+        def import_module(name, *args):
+            util.command(command="new_%s" % name)(f)
+            return modules[name]
+
+        import_plugin.side_effect = import_module
+        reloaded = []
+        pluginmanager._reload().addCallback(reloaded.append)
+        self.assertEqual(self.calls, ["calendar", "base"])
+        # Commands keep running against the current tables until then
+        self.assertIs(pluginmanager._callbacks["f"], old)
+        self.assertNotIn("new_calendar", pluginmanager._callbacks)
+        self.deferreds["calendar"].callback(None)
+        self.assertEqual(reloaded, [None])
+        self.assertNotIn("f", pluginmanager._callbacks)
+        self.assertIn("new_calendar", pluginmanager._callbacks)
+        self.assertIn("new_base", pluginmanager._callbacks)
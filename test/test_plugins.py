@@ -1,8 +1,19 @@
 # coding: utf-8
+import datetime
+import gzip
 import lala.config
+import lala.logqueue
 import lala.pluginmanager
+import lala.profiling
+import lala.segments
+import lala.startup
 import lala.util
+import os
 import random
+import shutil
+import tempfile
+import threading
+import time
 
 from . import _helpers
 from ._helpers import mock, LalaTestCase
@@ -11,6 +22,8 @@ from hypothesis.strategies import integers
 from importlib import import_module
 from six import text_type
 from six.moves import configparser, range
+from twisted.internet.defer import maybeDeferred, succeed
+from twisted.internet.task import Clock
 from twisted.python.failure import Failure
 
 
@@ -43,6 +56,16 @@ class PluginTestCase(LalaTestCase):
         msg_patcher.start()
         self.addCleanup(msg_patcher.stop)
 
+        # Run threaded callbacks right away so their results can be checked
+        thread_patcher = mock.patch('lala.threadpool.run_in_thread',
+                                    side_effect=maybeDeferred)
+        thread_patcher.start()
+        self.addCleanup(thread_patcher.stop)
+
+        limiters_patcher = mock.patch.dict("lala.ratelimit._limiters")
+        limiters_patcher.start()
+        self.addCleanup(limiters_patcher.stop)
+
     def handle_message(self, msg):
         """Instruct the plugin manager to handle ``msg``
 
@@ -118,7 +141,9 @@ class TestBase(PluginTestCase):
         cfg_patcher = mock.patch("lala.config._CFG")
         cfg_patcher.start()
         self.addCleanup(cfg_patcher.stop)
-        lala.config._CFG.get.return_value = "user,user2"
+        lala.config._CFG.get.side_effect = lambda section, key: {
+            "command_timeout": "0",
+            "memory_top": "10"}.get(key, "user,user2")
 
         enable_patcher = mock.patch("lala.pluginmanager.enable")
         enable_patcher.start()
@@ -183,6 +208,95 @@ class TestBase(PluginTestCase):
         self.handle_message("!server")
         self.mod.msg.assert_called_once_with(self.user, "irc.nowhere.invalid")
 
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    @mock.patch("lala.pluginmanager._reload_plugin")
+    def test_pluginupdate_single_plugin(self, reload_plugin, enabled):
+        enabled.return_value = ["quotes"]
+        reload_plugin.return_value = succeed(None)
+        self.handle_message("!pluginupdate quotes")
+        reload_plugin.assert_called_once_with("quotes")
+        self.assert_only_message("quotes has been reloaded.")
+
+    @mock.patch("lala.pluginmanager._get_enabled_plugins")
+    @mock.patch("lala.pluginmanager._reload_plugin")
+    def test_pluginupdate_disabled_plugin(self, reload_plugin, enabled):
+        enabled.return_value = ["quotes"]
+        self.handle_message("!pluginupdate roulette")
+        self.assertFalse(reload_plugin.called)
+        self.assert_only_message("roulette is not an enabled plugin")
+
+    @mock.patch("lala.profiling.start")
+    def test_profile_start(self, start):
+        self.handle_message("!profile start 10 cprofile")
+        self.assertEqual(start.call_args[0][:2], ("cprofile", 10))
+        self.assert_only_message("Profiling with cprofile for at most 10 "
+                                 "seconds")
+
+        # The summary is sent in a query
+        on_stop = start.call_args[0][2]
+        self.mod.msg.reset_mock()
+        on_stop("/tmp/profile.pstats", ["f: 1.0 ms"])
+        self.mod.msg.assert_called_with(self.user, ["f: 1.0 ms"])
+
+    @mock.patch("lala.profiling.stop")
+    def test_profile_stop_without_session(self, stop):
+        stop.side_effect = lala.profiling.ProfilingError("No session")
+        self.handle_message("!profile stop")
+        self.assert_only_message("No session")
+
+    @mock.patch("lala.memory.report")
+    @mock.patch("lala.memory.start_tracking")
+    def test_memory(self, start_tracking, report):
+        self.handle_message("!memory start")
+        self.assertTrue(start_tracking.called)
+        self.assert_only_message("Tracking memory, use memory to see its "
+                                 "growth")
+
+        # The report is sent in a query
+        report.return_value = ["quotes: 1.0 MiB"]
+        self.mod.msg.reset_mock()
+        self.handle_message("!memory")
+        self.mod.msg.assert_called_once_with(self.user, ["quotes: 1.0 MiB"])
+
+    @mock.patch("lala.memory.stop_tracking")
+    def test_memory_stop_without_tracking(self, stop_tracking):
+        stop_tracking.side_effect = lala.memory.MemoryTrackingError(
+            "Memory is not tracked")
+        self.handle_message("!memory stop")
+        self.assert_only_message("Memory is not tracked")
+
+    @mock.patch("lala.ratelimit.drop_statistics")
+    def test_ratelimits(self, drop_statistics):
+        drop_statistics.return_value = {"ofortune": {"user": 1, "command": 2}}
+        self.handle_message("!ratelimits")
+        self.assert_only_message(
+            ["ofortune: 2 by the command limit, 1 by the user limit"])
+
+    @mock.patch("lala.pluginmanager.jobs")
+    def test_jobs(self, jobs):
+        job = mock.Mock(id=3, trigger="iweather", user="user2",
+                        channel="#channel")
+        job.age.return_value = 12.5
+        jobs.return_value = [job]
+        self.handle_message("!jobs")
+        self.assert_only_message(
+            ["3: iweather by user2 in #channel, running for 12s"])
+
+    @mock.patch("lala.pluginmanager.cancel_job")
+    def test_jobs_cancel(self, cancel_job):
+        cancel_job.return_value = False
+        self.handle_message("!jobs cancel 3")
+        cancel_job.assert_called_once_with(3)
+        self.assert_only_message("There is no job 3")
+
+    @mock.patch("lala.pluginmanager.concurrency_statistics")
+    def test_concurrency(self, statistics):
+        statistics.return_value = {"searchquote": {"limit": 2,
+                                                   "in_flight": 2,
+                                                   "queued": 1}}
+        self.handle_message("!concurrency")
+        self.assert_only_message(["searchquote: 2 of 2 running, 1 queued"])
+
     def tearDown(self):
         super(TestBase, self).tearDown()
         self.mod.msg.reset_mock()
@@ -192,6 +306,91 @@ class TestBase(PluginTestCase):
         lala.config._CFG.set.reset_mock()
 
 
+class TestPrometheus(LalaTestCase):
+    def setUp(self):
+        super(TestPrometheus, self).setUp()
+        self.mod = import_module("lala.plugins.prometheus")
+        # init registers them
+        for collector in self.mod._COLLECTORS:
+            self.mod.REGISTRY.register(collector)
+            self.addCleanup(self.mod.REGISTRY.unregister, collector)
+
+    def sample(self, name, **labels):
+        return self.mod.REGISTRY.get_sample_value(name, labels)
+
+    def test_lag_probe(self):
+        clock = Clock()
+        probe = self.mod._LagProbe(1, clock)
+        before = self.sample("reactor_lag_seconds_count") or 0
+        probe.start()
+        clock.advance(1)
+        self.assertEqual(self.sample("reactor_lag_seconds_count"), before + 1)
+        # A blocked reactor runs the call late
+        clock.advance(1.5)
+        self.assertEqual(self.sample("reactor_lag_seconds_count"), before + 2)
+        self.assertEqual(probe.scheduled, 3)
+        probe.stop()
+        self.assertFalse(probe.call.running)
+
+    @mock.patch("lala.threadpool.all_statistics")
+    def test_health(self, all_statistics):
+        all_statistics.return_value = {"quotes": {"size": 5,
+                                                  "busy": 2,
+                                                  "idle": 1,
+                                                  "queued": 4,
+                                                  "utilization": 0.4},
+                                       "reactor": {"size": 10,
+                                                   "busy": 0,
+                                                   "idle": 0,
+                                                   "queued": None,
+                                                   "utilization": 0.0}}
+        lala.util._BOT._queue = ["a", "b"]
+        self.assertEqual(self.sample("thread_pool_threads", pool="quotes",
+                                     state="busy"), 2)
+        self.assertEqual(self.sample("thread_pool_queued_callbacks",
+                                     pool="quotes"), 4)
+        self.assertIsNone(self.sample("thread_pool_queued_callbacks",
+                                      pool="reactor"))
+        self.assertEqual(self.sample("irc_send_queue_lines"), 2)
+        self.assertIsNone(self.sample("plugin_memory_bytes", plugin="quotes"))
+
+    @mock.patch("lala.memory.tracking", return_value=True)
+    @mock.patch("lala.memory.plugin_statistics")
+    def test_memory(self, plugin_statistics, tracking):
+        plugin_statistics.return_value = {"quotes": 2048, "other": 10}
+        self.assertEqual(self.sample("plugin_memory_bytes", plugin="quotes"),
+                         2048)
+        self.assertIsNotNone(self.sample("traced_memory_bytes"))
+
+    @mock.patch("lala.startup.total")
+    @mock.patch("lala.startup.timeline")
+    def test_startup(self, timeline, total):
+        timeline.return_value = []
+        self.assertIsNone(self.sample("startup_phase_start_seconds",
+                                      phase="config", detail=""))
+        config = lala.startup.Phase("config", None, 0.5, 0)
+        config.end = 1.5
+        init = lala.startup.Phase("init", "quotes", 2, 0)
+        timeline.return_value = [config, init]
+        total.return_value = None
+        self.assertEqual(self.sample("startup_phase_start_seconds",
+                                     phase="config", detail=""), 0.5)
+        self.assertEqual(self.sample("startup_phase_seconds",
+                                     phase="config", detail=""), 1)
+        self.assertIsNone(self.sample("startup_phase_seconds",
+                                      phase="init", detail="quotes"))
+        self.assertIsNone(self.sample("startup_seconds"))
+        total.return_value = 3
+        self.assertEqual(self.sample("startup_seconds"), 3)
+
+    def test_observe_callback(self):
+        labels = {"kind": "command", "plugin": "test", "trigger": "cmd"}
+        self.mod.observe_callback("command", "test", "cmd", 0.1, 0.5, True)
+        self.assertEqual(self.sample("callback_duration_seconds_sum",
+                                     **labels), 0.5)
+        self.assertEqual(self.sample("callback_errors_total", **labels), 1)
+
+
 class TestHTTPTitle(PluginTestCase):
     plugin = "httptitle"
 
@@ -434,6 +633,240 @@ class TestLast(PluginTestCase):
         self.mod.msg.assert_called_with('user', messages, log=False)
 
 
+class TestLog(PluginTestCase):
+    plugin = "log"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.logfile = os.path.join(self.directory, "chat.log")
+        self.folder = os.path.join(self.directory, "logs")
+        archive_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, archive_directory)
+        self.archive_file = os.path.join(archive_directory, "archive.db")
+        super(TestLog, self).setUp()
+        self.addCleanup(self.wait_for_compression)
+        self.addCleanup(lala.logqueue.stop)
+        self.addCleanup(self.mod.teardown)
+
+    def writeConfigFile(self, _file):
+        _file.write("[log]\nlog_file = %s\nlog_folder = %s\n"
+                    "max_log_days = 2\narchive_file = %s\n"
+                    % (self.logfile, self.folder, self.archive_file))
+
+    def write(self, name, lines, compress=False):
+        path = os.path.join(self.directory, name)
+        with (gzip.open if compress else open)(path, "wt") as fp:
+            fp.writelines("%s\n" % line for line in lines)
+        return path
+
+    def wait_for_compression(self):
+        for thread in threading.enumerate():
+            if thread.name == "lala-log-gzip":
+                thread.join()
+
+    def test_chatlog(self):
+        self.handle_message("hello")
+        lala.logqueue.flush()
+        with open(self.logfile) as fp:
+            self.assertTrue(fp.read().endswith(" user: hello\n"))
+        lines = lala.segments.last(self.folder, self.channel, 10)
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" user: hello"))
+
+    def test_last_channel(self):
+        self.handle_message("hello")
+        self.handle_message("world")
+        self.channel = "#other"
+        self.handle_message("elsewhere")
+        self.handle_message("!last 1 #channel")
+        lines = self.mod.msg.call_args[0][1]
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" user: world"))
+
+    def test_last_count(self):
+        for i in range(3):
+            self.handle_message("line %i" % i)
+        self.handle_message("!last 2")
+        lines = self.mod.msg.call_args[0][1]
+        self.assertEqual([line.split(" ", 2)[2] for line in lines],
+                         ["user: line 1\n", "user: line 2\n"])
+
+    def test_last_since(self):
+        writer = lala.segments.Writer(self.folder)
+        today = datetime.date.today()
+        for hour in (9, 10, 11):
+            writer.write(self.channel, time.mktime(datetime.datetime.combine(
+                today, datetime.time(hour)).timetuple()), "user: %i" % hour)
+        writer.close()
+        self.handle_message("!last since 10:00")
+        self.mod.msg.assert_called_with(
+            self.user, ["%sT10:00:00 user: 10" % today.isoformat(),
+                        "%sT11:00:00 user: 11" % today.isoformat()],
+            log=False)
+        self.handle_message("!last since %s 11:00 #CHANNEL" %
+                            today.isoformat())
+        self.assertEqual(len(self.mod.msg.call_args[0][1]), 1)
+        self.handle_message("!last since %s #channel" % today.isoformat())
+        self.assertEqual(len(self.mod.msg.call_args[0][1]), 3)
+
+    def test_last_since_usage(self):
+        for text in ("!last since", "!last since noon", "!last since 1 2 3"):
+            self.handle_message(text)
+            self.assertTrue(self.mod.msg.call_args[0][1].startswith("Usage"))
+
+    def test_last_reads_rotated_files(self):
+        self.write("chat.log", ["today 1", "today 2"])
+        self.write("chat.log.2012-12-09.gz", ["yesterday 1", "yesterday 2"],
+                   compress=True)
+        self.write("chat.log.2012-12-08", ["before 1", "before 2"])
+        # Being compressed right now
+        self.write("chat.log.2012-12-08.gz.tmp", ["broken"])
+        self.assertEqual(self.mod._last_lines(self.logfile, 5),
+                         ["before 2\n", "yesterday 1\n", "yesterday 2\n",
+                          "today 1\n", "today 2\n"])
+        self.assertEqual(self.mod._last_lines(self.logfile, 1),
+                         ["today 2\n"])
+        self.assertEqual(self.mod._last_lines(self.logfile, 10)[0],
+                         "before 1\n")
+
+    def test_last_command(self):
+        self.write("chat.log.2012-12-09.gz", ["yesterday"], compress=True)
+        self.handle_message("hello")
+        self.handle_message("!last")
+        lines = self.mod.msg.call_args[0][1]
+        self.assertEqual(lines[0], "yesterday\n")
+        self.assertTrue(lines[1].endswith(" user: hello\n"))
+
+    @mock.patch("logging.info")
+    def test_rollover_compresses(self, info):
+        self.handle_message("hello")
+        lala.logqueue.flush()
+        for stamp in ("2012-12-07", "2012-12-08"):
+            self.write("chat.log." + stamp + ".gz", [stamp], compress=True)
+        # A day's file being compressed doesn't count twice
+        self.write("chat.log.2012-12-08", ["2012-12-08"])
+        handler, = [target for handler in self.mod.chatlogger.handlers
+                    for target in getattr(handler, "handlers", ())
+                    if isinstance(target, self.mod._CompressingHandler)]
+        handler.doRollover()
+        self.wait_for_compression()
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            sorted(["chat.log", "chat.log.2012-12-08",
+                    "chat.log.2012-12-08.gz", "logs", os.path.basename(
+                        self.mod._rotated(self.logfile)[0])]))
+        rotated = self.mod._rotated(self.logfile)[0]
+        self.assertTrue(rotated.endswith(".gz"))
+        with gzip.open(rotated, "rt") as fp:
+            self.assertTrue(fp.read().endswith(" user: hello\n"))
+        message, path = info.call_args[0][:2]
+        self.assertTrue(message.startswith("Compressed %s in %.2f s"))
+        self.assertEqual(path + ".gz", rotated)
+
+    @mock.patch("logging.info")
+    def test_init_compresses_leftovers(self, info):
+        path = self.write("chat.log.2012-12-09", ["yesterday"] * 100)
+        self.mod.teardown()
+        self.mod.init()
+        self.wait_for_compression()
+        self.assertFalse(os.path.exists(path))
+        with gzip.open(path + ".gz", "rt") as fp:
+            self.assertEqual(fp.read(), "yesterday\n" * 100)
+        size, compressed, ratio = info.call_args[0][3:]
+        self.assertEqual(size, 1000)
+        self.assertEqual(ratio, size / compressed)
+
+    @mock.patch("logging.exception")
+    def test_compress_fails(self, exception):
+        path = os.path.join(self.directory, "chat.log.2012-12-09")
+        self.mod._compress(path)
+        self.assertTrue(exception.called)
+        self.assertEqual(os.listdir(self.directory), ["chat.log"])
+
+    def grep(self, text):
+        self.handle_message("!grep " + text)
+        return self.mod.msg.call_args[0][1]
+
+    def test_grep(self):
+        self.handle_message("hello world")
+        self.handle_message("something else")
+        self.channel = "#other"
+        self.handle_message("hello elsewhere")
+        self.user = "other"
+        self.handle_message("hello from other")
+        lines = self.grep("hello #channel")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith(" #channel <user> hello world"))
+        self.assertEqual([line.split(" ", 2)[2] for line in self.grep("hello")],
+                         ["#other <user> hello elsewhere",
+                          "#other <other> hello from other"])
+        self.assertEqual(len(self.grep("hello *")), 3)
+        self.assertEqual(len(self.grep("hello * USER")), 2)
+        self.assertEqual(self.grep("goodbye"), "No messages found")
+
+    def test_grep_results(self):
+        for i in range(15):
+            self.handle_message("line %i" % i)
+        lines = self.grep("line")
+        self.assertEqual(len(lines), 10)
+        self.assertTrue(lines[-1].endswith("line 14"))
+
+    def test_grep_usage(self):
+        for text in ("", "*", "* #channel", "** * nick"):
+            self.assertTrue(self.grep(text).startswith("Usage"), text)
+
+    @mock.patch("lala.plugins.log._archive", None)
+    def test_grep_disabled(self):
+        self.assertEqual(self.grep("hello"), "The archive is disabled")
+
+    def test_reload(self):
+        # Reloading replaces the tables, the next tests use the current ones
+        tables = mock.patch.multiple(
+            "lala.pluginmanager",
+            _callbacks=lala.pluginmanager._callbacks,
+            _regexes=lala.pluginmanager._regexes,
+            _join_callbacks=lala.pluginmanager._join_callbacks)
+        tables.start()
+        self.addCleanup(tables.stop)
+        self.addCleanup(lala.pluginmanager._replace_module, "log", self.mod)
+        lala.pluginmanager._reload_plugin("log")
+        reloaded = import_module("lala.plugins.log")
+        self.addCleanup(reloaded.teardown)
+        self.assertIsNot(reloaded, self.mod)
+        self.assertEqual(len([handler for handler in
+                              reloaded.chatlogger.handlers
+                              if hasattr(handler, "handlers")]), 1)
+
+        self.handle_message("hello")
+        lala.logqueue.flush()
+        with open(self.logfile) as fp:
+            self.assertEqual(fp.read().count(" user: hello\n"), 1)
+        self.assertEqual(len(lala.segments.last(self.folder, self.channel,
+                                                10)), 1)
+        self.assertEqual(len(reloaded._archive.search(["hello"])), 1)
+
+    @mock.patch("logging.info")
+    def test_archive_prunes(self, info):
+        handler, = [target for handler in self.mod.chatlogger.handlers
+                    for target in getattr(handler, "handlers", ())
+                    if isinstance(target, self.mod._ArchiveHandler)]
+        handler.flush()
+        old = time.time() - 4 * 86400
+        self.mod._archive.add([(old, self.channel, "user", "hello old")])
+        # Only once an hour
+        handler.flush()
+        self.assertEqual(len(self.grep("hello")), 1)
+        handler.pruned = None
+        self.handle_message("hello new")
+        lines = self.grep("hello")
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("hello new"))
+        info.assert_any_call(
+            "Removed %i messages from before %s from the archive", 1,
+            datetime.date.today() - datetime.timedelta(days=2))
+
+
 class TestCalendar(PluginTestCase):
     plugin = "calendar"
 
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import threading
+
+from ._helpers import mock, LalaTestCase
+from lala import config, profiling
+from twisted.internet.task import Clock
+
+
+def busy():
+    return sum(range(1000))
+
+
+class TestProfiling(LalaTestCase):
+    def setUp(self):
+        super(TestProfiling, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        config._set("base", "profile_dir", self.directory)
+        config._set("base", "profile_top", "3")
+        reactor_patcher = mock.patch("lala.profiling.reactor", new=Clock())
+        self.clock = reactor_patcher.start()
+        self.addCleanup(reactor_patcher.stop)
+        self.results = []
+
+    def tearDown(self):
+        if profiling.running():
+            profiling.stop()
+        super(TestProfiling, self).tearDown()
+
+    def on_stop(self, path, summary):
+        self.results.append((path, summary))
+
+    def test_cprofile(self):
+        profiling.start("cprofile", 10, self.on_stop)
+        busy()
+        profiling.stop()
+        self.assertFalse(profiling.running())
+        [(path, summary)] = self.results
+        self.assertTrue(path.endswith(".pstats"))
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(len(summary), 3)
+
+    def test_sampling_stops_after_timeout(self):
+        profiling.start("sampling", 10, self.on_stop)
+        self.clock.advance(10)
+        self.assertFalse(profiling.running())
+        [(path, summary)] = self.results
+        self.assertEqual(os.path.dirname(path), self.directory)
+        self.assertTrue(path.endswith(".collapsed"))
+
+    def test_profile_dir_expanded(self):
+        config._set("base", "profile_dir", "~/profiles")
+        with mock.patch.dict(os.environ, {"HOME": self.directory}):
+            profiling.start("sampling", 10, self.on_stop)
+            profiling.stop()
+        [(path, summary)] = self.results
+        self.assertEqual(os.path.dirname(path),
+                         os.path.join(self.directory, "profiles"))
+
+    def test_only_one_session(self):
+        profiling.start("sampling", 10, self.on_stop)
+        self.assertRaises(profiling.ProfilingError, profiling.start,
+                          "cprofile", 10, self.on_stop)
+
+    def test_stop_without_session(self):
+        self.assertRaises(profiling.ProfilingError, profiling.stop)
+
+    def test_max_seconds(self):
+        profiling.start("sampling", 10 ** 6, self.on_stop)
+        self.assertEqual(self.clock.getDelayedCalls()[0].getTime(),
+                         profiling.MAX_SECONDS)
+
+
+class TestSamplingSession(LalaTestCase):
+    def test_sample(self):
+        session = profiling.SamplingSession()
+        session.thread_id = threading.get_ident()
+        session.sample()
+        session.sample()
+        [(stack, samples)] = session.stacks.items()
+        self.assertEqual(samples, 2)
+        self.assertTrue(stack.endswith("lala.profiling:sample"))
+        self.assertIn("test.test_profiling:test_sample", stack)
+        self.assertEqual(session.summary(1),
+                         ["lala.profiling:sample: 100.0% of 2 samples"])
+
+    def test_write(self):
+        session = profiling.SamplingSession()
+        session.stacks["a;b"] = 3
+        session.stacks["a;c"] = 1
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        session.write(path)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "a;b 3\na;c 1\n")
@@ -0,0 +1,59 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from ._helpers import LalaTestCase
+from ._quotesdata import build, nick
+
+
+class TestBuild(LalaTestCase):
+    def setUp(self):
+        super(TestBuild, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def build(self, name="quotes.sqlite3", **kwargs):
+        path = os.path.join(self.directory, name)
+        counts = build(path, **kwargs)
+        connection = sqlite3.connect(path)
+        self.addCleanup(connection.close)
+        return counts, connection
+
+    def test_counts(self):
+        counts, _ = self.build(quotes=1000, authors=7, voters=20, votes=3000)
+        self.assertEqual(counts["quote"], 1000)
+        self.assertEqual(counts["author"], 7)
+        self.assertEqual(counts["voter"], 20)
+        # Repeated votes are dropped
+        self.assertLessEqual(counts["vote"], 3000)
+        self.assertGreater(counts["vote"], 2000)
+
+    def test_defaults(self):
+        counts, _ = self.build(quotes=2000)
+        self.assertEqual(counts["author"], 5)
+        self.assertEqual(counts["voter"], 10)
+        self.assertLessEqual(counts["vote"], 10000)
+
+    def test_consistent(self):
+        _, connection = self.build(quotes=500)
+        connection.execute("PRAGMA foreign_keys = ON;")
+        self.assertEqual(connection.execute(
+            "PRAGMA foreign_key_check;").fetchall(), [])
+        self.assertGreater(connection.execute(
+            "SELECT count(*) FROM quote WHERE quote LIKE ?;",
+            ["%<" + nick(0) + ">%"]).fetchone()[0], 0)
+        # The first authors add most quotes
+        counts = [count for count, in connection.execute(
+            "SELECT count(*) FROM quote GROUP BY author ORDER BY author;")]
+        self.assertEqual(counts[0], max(counts))
+
+    def test_seed(self):
+        _, first = self.build("first", quotes=100, seed=1)
+        _, second = self.build("second", quotes=100, seed=1)
+        _, other = self.build("other", quotes=100, seed=2)
+        query = "SELECT quote, author FROM quote ORDER BY id;"
+        self.assertEqual(first.execute(query).fetchall(),
+                         second.execute(query).fetchall())
+        self.assertNotEqual(first.execute(query).fetchall(),
+                            other.execute(query).fetchall())
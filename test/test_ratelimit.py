@@ -0,0 +1,115 @@
+from ._helpers import mock, FakeClock, LalaTestCase
+from hypothesis import given
+from hypothesis.strategies import integers
+from lala import config, pluginmanager, ratelimit, util
+
+
+class TestRateLimiter(LalaTestCase):
+    def setUp(self):
+        super(TestRateLimiter, self).setUp()
+        self.clock = FakeClock()
+        self.limiter = ratelimit.RateLimiter(2, 10, clock=self.clock)
+
+    def test_burst(self):
+        self.assertTrue(self.limiter.allow("user"))
+        self.assertTrue(self.limiter.allow("user"))
+        self.assertFalse(self.limiter.allow("user"))
+        self.assertTrue(self.limiter.allow("user2"))
+
+    def test_refill(self):
+        for _ in range(2):
+            self.limiter.allow("user")
+        self.clock.now = 4
+        self.assertFalse(self.limiter.allow("user"))
+        self.clock.now = 5
+        self.assertTrue(self.limiter.allow("user"))
+        self.assertFalse(self.limiter.allow("user"))
+
+    def test_warn_once(self):
+        for _ in range(3):
+            self.limiter.allow("user")
+        self.assertTrue(self.limiter.warn("user"))
+        self.assertFalse(self.limiter.warn("user"))
+        self.clock.now = 5
+        self.assertTrue(self.limiter.allow("user"))
+        self.assertFalse(self.limiter.allow("user"))
+        self.assertTrue(self.limiter.warn("user"))
+
+    @given(integers(min_value=1, max_value=50))
+    def test_idle_buckets_are_evicted(self, users):
+        limiter = ratelimit.RateLimiter(2, 10, clock=self.clock)
+        for user in range(users):
+            limiter.allow(user)
+        self.assertEqual(len(limiter), users)
+        self.clock.now += 10
+        limiter.allow("user")
+        self.assertEqual(len(limiter), 1)
+
+    def test_parse_limit(self):
+        self.assertEqual(ratelimit.parse_limit("5/60"), (5, 60.0))
+        self.assertIsNone(ratelimit.parse_limit(""))
+        self.assertRaises(ValueError, ratelimit.parse_limit, "0/60")
+
+
+class TestAllow(LalaTestCase):
+    def setUp(self):
+        super(TestAllow, self).setUp()
+        ratelimit._limiters.clear()
+        ratelimit._drops.clear()
+        pluginmanager._callbacks.clear()
+        self.called = []
+        util.command(command="cmd", rate_limit="1/60")(
+            lambda user, channel, text: self.called.append(user))
+
+    def test_command_limit(self):
+        for _ in range(3):
+            pluginmanager._handle_message("user", "#channel", "!cmd")
+        pluginmanager._handle_message("user2", "#channel", "!cmd")
+        self.assertEqual(self.called, ["user", "user2"])
+        util._BOT.msg.assert_called_once_with(
+            "#channel", "user: you're using commands too often, please slow "
+            "down", True)
+        self.assertEqual(ratelimit.drop_statistics(),
+                         {"cmd": {"command": 2}})
+
+    def test_command_limit_override(self):
+        config._set("base", "command_rate_limits", "other:1/60, cmd:2/60")
+        for _ in range(3):
+            pluginmanager._handle_message("user", "#channel", "!cmd")
+        self.assertEqual(self.called, ["user", "user"])
+
+    def test_channel_limit(self):
+        config._set("base", "channel_rate_limit", "1/60")
+        config._set("base", "command_rate_limits", "cmd:")
+        pluginmanager._handle_message("user", "#channel", "!cmd")
+        pluginmanager._handle_message("user2", "#channel", "!cmd")
+        pluginmanager._handle_message("user2", "#channel2", "!cmd")
+        self.assertEqual(self.called, ["user", "user2"])
+        self.assertEqual(ratelimit.drop_statistics(),
+                         {"cmd": {"channel": 1}})
+
+    def test_aliases_share_limit(self):
+        util.command(command="limited", aliases=["alias"], rate_limit="1/60")(
+            lambda user, channel, text: self.called.append(text))
+        pluginmanager._handle_message("user", "#channel", "!limited one")
+        pluginmanager._handle_message("user", "#channel", "!alias two")
+        self.assertEqual(self.called, ["one"])
+        self.assertEqual(ratelimit.drop_statistics(),
+                         {"limited": {"command": 1}})
+
+    def test_dropped_calls_take_no_tokens(self):
+        config._set("base", "user_rate_limit", "2/60")
+        for _ in range(2):
+            pluginmanager._handle_message("user", "#channel", "!cmd")
+        # The command limit dropped the second call, the user has a token left
+        util.command(command="other")(
+            lambda user, channel, text: self.called.append("other"))
+        pluginmanager._handle_message("user", "#channel", "!other")
+        self.assertEqual(self.called, ["user", "other"])
+
+    @mock.patch("lala.ratelimit.logging")
+    def test_invalid_limit(self, logging):
+        config._set("base", "user_rate_limit", "lots")
+        pluginmanager._handle_message("user", "#channel", "!cmd")
+        self.assertEqual(self.called, ["user"])
+        self.assertTrue(logging.error.called)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+
+from ._helpers import mock, LalaTestCase
+from lala import config, replay
+from six.moves import configparser
+from twisted.internet.task import Clock
+
+
+class TestSandbox(LalaTestCase):
+    def setUp(self):
+        super(TestSandbox, self).setUp()
+        self.production = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.production)
+        self.sandbox = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.sandbox)
+        self.database = os.path.join(self.production, "quotes.sqlite3")
+        with open(self.database, "w") as fp:
+            fp.write("quotes")
+        self.source = os.path.join(self.production, "config")
+        with open(self.source, "w") as fp:
+            fp.write("[base]\n"
+                     "plugins = quotes,prometheus\n"
+                     "nick = bot\n"
+                     "nickserv_password = secret\n"
+                     "capture_file = %s/capture\n"
+                     "log_file = %s/lala.log\n"
+                     "[quotes]\n"
+                     "database_path = %s\n"
+                     "[prometheus]\n"
+                     "port = 9100\n"
+                     % (self.production, self.production, self.database))
+
+    def sandboxed(self, plugins=None):
+        cfg = configparser.RawConfigParser()
+        cfg.read(replay.sandbox_config(self.source, self.sandbox, plugins))
+        return cfg
+
+    def test_sandbox_config(self):
+        cfg = self.sandboxed()
+        self.assertEqual(cfg.get("base", "nick"), "bot")
+        self.assertEqual(cfg.get("base", "capture_file"), "")
+        self.assertFalse(cfg.has_option("base", "nickserv_password"))
+        self.assertEqual(cfg.get("prometheus", "port"), "0")
+        for option in ("log_file", "profile_dir", "plugin_manifest"):
+            self.assertTrue(cfg.get("base", option).startswith(self.sandbox))
+            # Plugins fall back to the defaults
+            self.assertTrue(cfg.get("quotes", option).startswith(
+                self.sandbox))
+
+        database = cfg.get("quotes", "database_path")
+        self.assertTrue(database.startswith(self.sandbox))
+        with open(database) as fp:
+            self.assertEqual(fp.read(), "quotes")
+
+    def test_plugins(self):
+        cfg = self.sandboxed("decide")
+        self.assertEqual(cfg.get("base", "plugins"), "decide")
+
+    def test_sandbox_defaults(self):
+        config._initialize(replay.sandbox_config(self.source, self.sandbox))
+        with mock.patch("lala.config._set_default_options",
+                        new=config._set_default_options):
+            replay.sandbox_defaults(self.sandbox)
+            config._set_default_options("fortune", {
+                "fortune_path": self.database,
+                "fortune_files": "fortunes"})
+            config._set_default_options("websocket", {"port": 9000})
+        self.assertTrue(config._get("fortune", "fortune_path").startswith(
+            self.sandbox))
+        self.assertEqual(config._get("fortune", "fortune_files"), "fortunes")
+        self.assertEqual(config._get("websocket", "port"), "0")
+
+
+class TestReplayer(LalaTestCase):
+    def setUp(self):
+        super(TestReplayer, self).setUp()
+        self.clock = Clock()
+        self.bot = mock.Mock()
+        self.lines = [(0.0, b"one"), (0.5, b"two"), (2.0, b"three")]
+
+    def fed(self):
+        return [call[0][0] for call in self.bot.lineReceived.call_args_list]
+
+    def test_original_speed(self):
+        replayer = replay.Replayer(self.bot, self.lines, speed=1,
+                                   clock=self.clock)
+        done = []
+        replayer.start().addCallback(done.append)
+        self.clock.advance(0)
+        self.assertEqual(self.fed(), [b"one"])
+        self.clock.advance(0.5)
+        self.assertEqual(self.fed(), [b"one", b"two"])
+        self.clock.advance(1.5)
+        self.assertEqual(self.fed(), [b"one", b"two", b"three"])
+        self.assertEqual(done, [replayer])
+        self.assertEqual(replayer.fed, 3)
+
+    def test_speed(self):
+        replayer = replay.Replayer(self.bot, self.lines, speed=4,
+                                   clock=self.clock)
+        replayer.start()
+        self.clock.advance(0)
+        self.clock.advance(0.125)
+        self.assertEqual(self.fed(), [b"one", b"two"])
+        self.clock.advance(0.375)
+        self.assertEqual(replayer.fed, 3)
+
+    def test_lag(self):
+        replayer = replay.Replayer(self.bot, self.lines, speed=1,
+                                   clock=self.clock)
+        replayer.start()
+        # The reactor was blocked
+        self.clock.advance(1)
+        self.assertEqual(self.fed(), [b"one", b"two"])
+        self.assertEqual(replayer.max_lag, 1)
+
+    def test_fast(self):
+        lines = [(i, b"line %i" % i) for i in range(250)]
+        replayer = replay.Replayer(self.bot, lines, batch=100,
+                                   clock=self.clock)
+        done = []
+        replayer.start().addCallback(done.append)
+        # Other calls get to run between two batches
+        observed = []
+        self.clock.callLater(0, lambda: observed.append(replayer.fed))
+        self.clock.advance(0)
+        self.assertEqual(observed, [100])
+        self.assertEqual(replayer.fed, 250)
+        self.assertEqual(done, [replayer])
@@ -0,0 +1,306 @@
+import datetime
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+from ._helpers import mock, LalaTestCase
+from lala import segments
+
+
+def timestamp(day, hour, minute=0, second=0):
+    return time.mktime(datetime.datetime(2026, 10, day, hour, minute,
+                                         second).timetuple())
+
+
+class SegmentsTestCase(LalaTestCase):
+    def setUp(self):
+        super(SegmentsTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        block_patcher = mock.patch("lala.segments.BLOCK_SIZE", 100)
+        block_patcher.start()
+        self.addCleanup(block_patcher.stop)
+
+    def write(self, lines, channel="#lala"):
+        """Writes (timestamp, line) tuples."""
+        writer = segments.Writer(self.folder)
+        for when, line in lines:
+            writer.write(channel, when, line)
+        writer.close()
+
+    def fill(self, day, count, channel="#lala"):
+        """Writes a line every minute from midnight on."""
+        self.write([(timestamp(day, 0) + i * 60, "user: line %i" % i)
+                    for i in range(count)], channel)
+
+    def directory(self, channel="#lala"):
+        return segments.channel_directory(self.folder, channel)
+
+
+class TestWriter(SegmentsTestCase):
+    def test_write(self):
+        self.write([(timestamp(18, 14, 3, 12), "user: hello"),
+                    (timestamp(19, 0, 0, 1), "other: good morning")])
+        with open(os.path.join(self.directory(), "2026-10-18.log")) as fp:
+            self.assertEqual(fp.read(), "2026-10-18T14:03:12 user: hello\n")
+        self.assertEqual([day for day, _ in segments.segments(self.folder,
+                                                              "#LALA")],
+                         ["2026-10-18", "2026-10-19"])
+
+    def test_index(self):
+        self.fill(18, 20)
+        path = os.path.join(self.directory(), "2026-10-18.log")
+        index = segments._Index(path)
+        self.addCleanup(index.close)
+        entries = [index[i] for i in range(len(index))]
+        # Lines are 33 bytes up to line 9 and 34 afterwards, a block is
+        # full after 100 bytes
+        self.assertEqual([offset for _, offset in entries],
+                         [0, 132, 264, 364, 466, 568])
+        self.assertEqual(entries[1][0], timestamp(18, 0, 4))
+
+    def test_reopen(self):
+        self.fill(18, 2)
+        self.write([(timestamp(18, 1), "user: later")])
+        self.assertEqual(segments.last(self.folder, "#lala", 10)[-1],
+                         "2026-10-18T01:00:00 user: later")
+        index = segments._Index(os.path.join(self.directory(),
+                                             "2026-10-18.log"))
+        self.addCleanup(index.close)
+        # The block continues
+        self.assertEqual(len(index), 1)
+
+    def test_clock_goes_backwards(self):
+        self.write([(timestamp(18, 1), "user: %s" % ("x" * 100)),
+                    (timestamp(18, 0, 59), "user: earlier")])
+        index = segments._Index(os.path.join(self.directory(),
+                                             "2026-10-18.log"))
+        self.addCleanup(index.close)
+        self.assertEqual([index[i][0] for i in range(len(index))],
+                         [timestamp(18, 1), timestamp(18, 1)])
+
+    def test_finished(self):
+        finished = []
+        writer = segments.Writer(self.folder, finished.append)
+        writer.write("#lala", timestamp(18, 23), "user: late")
+        writer.write("#other", timestamp(18, 23), "user: late")
+        writer.write("#lala", timestamp(19, 0), "user: early")
+        writer.close()
+        self.assertEqual(finished, [os.path.join(self.directory(),
+                                                 "2026-10-18.log")])
+        self.assertEqual(
+            segments.finished(self.folder, "2026-10-19"),
+            [os.path.join(self.directory(), "2026-10-18.log"),
+             os.path.join(self.directory("#other"), "2026-10-18.log")])
+
+    def test_channel_directory(self):
+        self.assertEqual(segments.channel_directory("logs", "#Lala"),
+                         os.path.join("logs", "#lala"))
+        self.assertEqual(segments.channel_directory("logs", "../etc"),
+                         os.path.join("logs", "%2E.%2Fetc"))
+
+
+class TestRead(SegmentsTestCase):
+    def test_since(self):
+        self.fill(18, 120)
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(18, 1, 30), 3),
+                         ["2026-10-18T01:30:00 user: line 90",
+                          "2026-10-18T01:31:00 user: line 91",
+                          "2026-10-18T01:32:00 user: line 92"])
+        self.assertEqual(len(segments.since(self.folder, "#lala",
+                                            timestamp(18, 1, 30), 100)), 30)
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(18, 3), 10), [])
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(17, 3), 1),
+                         ["2026-10-18T00:00:00 user: line 0"])
+        self.assertEqual(segments.since(self.folder, "#unknown",
+                                        timestamp(17, 3), 1), [])
+
+    def test_since_searches_index(self):
+        self.fill(18, 1000)
+        with mock.patch.object(segments._Index, "__getitem__",
+                               autospec=True,
+                               side_effect=segments._Index.__getitem__) as get:
+            lines = segments.since(self.folder, "#lala",
+                                   timestamp(18, 10), 1)
+        self.assertEqual(lines, ["2026-10-18T10:00:00 user: line 600"])
+        # 334 entries
+        self.assertLessEqual(get.call_count, 10)
+
+    def test_since_spans_days(self):
+        self.fill(18, 3)
+        self.fill(19, 2)
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(18, 0, 2), 10),
+                         ["2026-10-18T00:02:00 user: line 2",
+                          "2026-10-19T00:00:00 user: line 0",
+                          "2026-10-19T00:01:00 user: line 1"])
+
+    def test_last(self):
+        self.fill(18, 10)
+        self.fill(19, 10)
+        self.assertEqual(segments.last(self.folder, "#lala", 2),
+                         ["2026-10-19T00:08:00 user: line 8",
+                          "2026-10-19T00:09:00 user: line 9"])
+        lines = segments.last(self.folder, "#lala", 12)
+        self.assertEqual(len(lines), 12)
+        self.assertEqual(lines[0], "2026-10-18T00:08:00 user: line 8")
+        self.assertEqual(len(segments.last(self.folder, "#lala", 50)), 20)
+        self.assertEqual(segments.last(self.folder, "#lala", 0), [])
+
+
+class TestCompress(SegmentsTestCase):
+    def setUp(self):
+        super(TestCompress, self).setUp()
+        member_patcher = mock.patch("lala.segments.COMPRESSED_BLOCK_SIZE",
+                                    300)
+        member_patcher.start()
+        self.addCleanup(member_patcher.stop)
+        self.path = os.path.join(self.directory(), "2026-10-18.log")
+
+    @mock.patch("logging.info")
+    def test_compress(self, info):
+        self.fill(18, 100)
+        self.fill(19, 1)
+        with open(self.path) as fp:
+            content = fp.read()
+        since = segments.since(self.folder, "#lala", timestamp(18, 1), 5)
+        last = segments.last(self.folder, "#lala", 30)
+        index = segments._Index(self.path)
+        blocks = len(index)
+        index.close()
+
+        size, compressed = segments.compress(self.path)
+        self.assertEqual(size, len(content))
+        self.assertEqual(sorted(os.listdir(self.directory())),
+                         ["2026-10-18.log.gz", "2026-10-18.log.gz.idx",
+                          "2026-10-19.log", "2026-10-19.log.idx"])
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(18, 1), 5), since)
+        self.assertEqual(segments.last(self.folder, "#lala", 30), last)
+        # It's a regular gzip file
+        with gzip.open(self.path + ".gz", "rt") as fp:
+            self.assertEqual(fp.read(), content)
+        index = segments._Index(self.path + ".gz")
+        self.addCleanup(index.close)
+        # Members of three blocks
+        self.assertEqual(len(index), -(-blocks // 3))
+        self.assertTrue(info.called)
+
+    @mock.patch("logging.info")
+    def test_read_while_compressing(self, info):
+        self.fill(18, 10)
+        with open(self.path, "rb") as fp:
+            content = fp.read()
+        shutil.copy(self.path + ".idx", self.path + ".keep")
+        segments.compress(self.path)
+        # As if the original hadn't been removed yet
+        with open(self.path, "wb") as fp:
+            fp.write(content)
+        os.rename(self.path + ".keep", self.path + ".idx")
+        self.assertEqual(segments.segments(self.folder, "#lala"),
+                         [("2026-10-18", self.path)])
+
+    @mock.patch("logging.info")
+    def test_compressed_while_reading(self, info):
+        self.fill(18, 100)
+        since = segments.since(self.folder, "#lala", timestamp(18, 1), 5)
+        last = segments.last(self.folder, "#lala", 30)
+        listed = segments.segments(self.folder, "#lala")
+        segments.compress(self.path)
+        # The directory was listed before the segment was compressed
+        with mock.patch("lala.segments.segments", return_value=listed):
+            self.assertEqual(segments.since(self.folder, "#lala",
+                                            timestamp(18, 1), 5), since)
+            self.assertEqual(segments.last(self.folder, "#lala", 30), last)
+            # Or expired
+            segments.expire(self.folder, 1, datetime.date(2026, 10, 20))
+            self.assertEqual(segments.since(self.folder, "#lala",
+                                            timestamp(18, 1), 5), [])
+            self.assertEqual(segments.last(self.folder, "#lala", 30), [])
+
+    @mock.patch("logging.info")
+    def test_compress_partial_index(self, info):
+        self.fill(18, 30)
+        with open(self.path) as fp:
+            content = fp.read()
+        # As if the first entries hadn't been flushed before a crash
+        with open(self.path + ".idx", "rb") as fp:
+            fp.seek(2 * segments._ENTRY.size)
+            entries = fp.read()
+        with open(self.path + ".idx", "wb") as fp:
+            fp.write(entries)
+        segments.compress(self.path)
+        with gzip.open(self.path + ".gz", "rt") as fp:
+            self.assertEqual(fp.read(), content)
+        self.assertEqual(segments.last(self.folder, "#lala", 30),
+                         content.splitlines())
+        self.assertEqual(segments.since(self.folder, "#lala",
+                                        timestamp(18, 0), 30),
+                         content.splitlines())
+
+    @mock.patch("logging.info")
+    def test_compress_missing_index(self, info):
+        self.fill(18, 30)
+        with open(self.path) as fp:
+            content = fp.read()
+        os.remove(self.path + ".idx")
+        segments.compress(self.path)
+        self.assertEqual(sorted(os.listdir(self.directory())),
+                         ["2026-10-18.log.gz", "2026-10-18.log.gz.idx"])
+        with gzip.open(self.path + ".gz", "rt") as fp:
+            self.assertEqual(fp.read(), content)
+        self.assertEqual(segments.last(self.folder, "#lala", 30),
+                         content.splitlines())
+
+    @mock.patch("logging.info")
+    def test_compress_reproducible(self, info):
+        self.fill(18, 30)
+        shutil.copy(self.path, self.path + ".keep")
+        shutil.copy(self.path + ".idx", self.path + ".idx.keep")
+        segments.compress(self.path)
+        with open(self.path + ".gz", "rb") as fp:
+            first = fp.read()
+        os.rename(self.path + ".keep", self.path)
+        os.rename(self.path + ".idx.keep", self.path + ".idx")
+        with mock.patch("time.time", return_value=timestamp(20, 0)):
+            segments.compress(self.path)
+        with open(self.path + ".gz", "rb") as fp:
+            self.assertEqual(fp.read(), first)
+        self.assertEqual(gzip.decompress(first).count(b"\n"), 30)
+
+    def test_compress_short_read(self):
+        self.fill(18, 10)
+        # Fewer bytes can be read than the segment had
+        with mock.patch("os.path.getsize", return_value=10 ** 6):
+            self.assertRaises(OSError, segments.compress, self.path)
+        self.assertEqual(sorted(os.listdir(self.directory())),
+                         ["2026-10-18.log", "2026-10-18.log.idx"])
+
+    def test_compress_fails(self):
+        self.fill(18, 10)
+        with mock.patch("lala.segments._member", side_effect=OSError()):
+            self.assertRaises(OSError, segments.compress, self.path)
+        self.assertEqual(sorted(os.listdir(self.directory())),
+                         ["2026-10-18.log", "2026-10-18.log.idx"])
+
+
+class TestExpire(SegmentsTestCase):
+    def test_expire(self):
+        for day in (16, 17, 18):
+            self.fill(day, 1)
+        self.fill(16, 1, "#other")
+        segments.expire(self.folder, 1, datetime.date(2026, 10, 18))
+        self.assertEqual([day for day, _ in segments.segments(self.folder,
+                                                              "#lala")],
+                         ["2026-10-17", "2026-10-18"])
+        self.assertEqual(os.listdir(self.directory("#other")), [])
+
+    def test_keep(self):
+        self.fill(16, 1)
+        segments.expire(self.folder, 0, datetime.date(2026, 10, 18))
+        self.assertEqual(len(segments.segments(self.folder, "#lala")), 1)
@@ -0,0 +1,133 @@
+import lala.startup
+
+from ._helpers import mock, LalaTestCase
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+
+
+class StartupTestCase(LalaTestCase):
+    def setUp(self):
+        super(StartupTestCase, self).setUp()
+        self.clock = Clock()
+        self.clock.advance(100)
+        now_patcher = mock.patch("lala.startup._now", new=self.clock.seconds)
+        now_patcher.start()
+        self.addCleanup(now_patcher.stop)
+        trace_patcher = mock.patch("lala.startup._trace", new=None)
+        trace_patcher.start()
+        self.addCleanup(trace_patcher.stop)
+
+    def phases(self):
+        return [(phase.label, phase.start, phase.end, phase.depth)
+                for phase in lala.startup.timeline()]
+
+
+class TestStartup(StartupTestCase):
+    def test_not_tracing(self):
+        self.assertIsNone(lala.startup.begin("config"))
+        self.assertFalse(lala.startup.end("config"))
+        with lala.startup.phase("config"):
+            pass
+        self.assertEqual(lala.startup.timed("init", "quotes", lambda: 1), 1)
+        self.assertEqual(lala.startup.timeline(), [])
+        self.assertIsNone(lala.startup.total())
+        self.assertEqual(lala.startup.breakdown(),
+                         ["The startup hasn't been traced"])
+
+    def test_phases(self):
+        lala.startup.start()
+        self.clock.advance(1)
+        with lala.startup.phase("plugins"):
+            with lala.startup.phase("import", "quotes"):
+                self.clock.advance(2)
+        lala.startup.begin("join", "#Lala")
+        self.clock.advance(3)
+        self.assertEqual(lala.startup.running("join"), ["#Lala"])
+        # Servers may answer in lower case
+        self.assertTrue(lala.startup.end("join", "#lala"))
+        self.assertFalse(lala.startup.end("join", "#lala"))
+        self.assertEqual(self.phases(), [("plugins", 1, 3, 0),
+                                         ("import quotes", 1, 3, 1),
+                                         ("join #Lala", 3, 6, 0)])
+
+    def test_timed(self):
+        lala.startup.start()
+        d = Deferred()
+
+        def init():
+            lala.startup.begin("dns", "irc.example.com")
+            return d
+
+        self.assertIs(lala.startup.timed("init", "quotes", init), d)
+        lala.startup.timed("init", "log", lambda: succeed(None))
+        self.clock.advance(2)
+        d.callback(None)
+        self.assertEqual(self.phases(), [("init quotes", 0, 2, 0),
+                                         ("dns irc.example.com", 0, None, 1),
+                                         ("init log", 0, 0, 0)])
+
+    def test_timed_raises(self):
+        lala.startup.start()
+
+        def init():
+            self.clock.advance(1)
+            raise ValueError()
+
+        self.assertRaises(ValueError, lala.startup.timed, "init", "quotes",
+                          init)
+        self.assertEqual(self.phases(), [("init quotes", 0, 1, 0)])
+        # Later phases aren't nested in it
+        lala.startup.begin("connect")
+        self.assertEqual(lala.startup.timeline()[-1].depth, 0)
+
+    @mock.patch("logging.info")
+    def test_finish(self, info):
+        lala.startup.start()
+        with lala.startup.phase("config"):
+            self.clock.advance(0.25)
+        lala.startup.begin("join", "#lala")
+        self.clock.advance(1)
+        lala.startup.finish()
+        self.assertEqual(lala.startup.total(), 1.25)
+        self.assertFalse(lala.startup.tracing())
+        info.assert_called_once_with(
+            "The startup took 1.250 s:\n"
+            "     +0.000 s    0.250 s  config\n"
+            "     +0.250 s    running  join #lala")
+        # Nothing is recorded afterwards
+        self.assertIsNone(lala.startup.begin("connect"))
+        self.assertEqual(len(lala.startup.timeline()), 2)
+
+    def test_unfinished(self):
+        lala.startup.start()
+        self.assertEqual(lala.startup.breakdown(),
+                         ["The startup hasn't finished yet:"])
+
+
+class TestResolver(StartupTestCase):
+    def test_lookups(self):
+        lookup = Deferred()
+        reactor = mock.Mock()
+        original = reactor.resolver
+        original.getHostByName.return_value = lookup
+        lala.startup.start()
+        lala.startup.trace_resolver(reactor)
+        self.assertIsNot(reactor.resolver, original)
+
+        results = []
+        reactor.resolver.getHostByName("irc.example.com").addCallback(
+            results.append)
+        self.clock.advance(0.5)
+        lookup.callback("127.0.0.1")
+        self.assertEqual(results, ["127.0.0.1"])
+        self.assertEqual(self.phases(), [("dns irc.example.com", 0, 0.5, 0)])
+
+        with mock.patch("logging.info"):
+            lala.startup.finish()
+        self.assertIs(reactor.resolver, original)
+
+    def test_not_tracing(self):
+        reactor = mock.Mock()
+        original = reactor.resolver
+        lala.startup.trace_resolver(reactor)
+        self.assertIs(reactor.resolver, original)
@@ -0,0 +1,71 @@
+import threading
+
+from ._helpers import mock, LalaTestCase
+from lala import threadpool, util
+from twisted.python.threadpool import ThreadPool
+
+
+class TestThreadPool(LalaTestCase):
+    def tearDown(self):
+        threadpool._stop()
+        super(TestThreadPool, self).tearDown()
+
+    def test_statistics_not_started(self):
+        stats = threadpool.statistics()
+        self.assertEqual(stats["size"], 4)
+        self.assertEqual(stats["busy"], 0)
+        self.assertEqual(stats["queued"], 0)
+        self.assertEqual(stats["utilization"], 0.0)
+
+    @mock.patch("lala.threadpool.reactor")
+    def test_statistics(self, reactor):
+        started = threading.Semaphore(0)
+        release = threading.Event()
+
+        def block():
+            started.release()
+            release.wait(5)
+
+        pool = threadpool._get_pool()
+        for _ in range(pool.max + 1):
+            threadpool.run_in_thread(block)
+        for _ in range(pool.max):
+            started.acquire(timeout=5)
+        try:
+            stats = threadpool.statistics()
+            self.assertEqual(stats["busy"], pool.max)
+            self.assertEqual(stats["queued"], 1)
+            self.assertEqual(stats["utilization"], 1.0)
+        finally:
+            release.set()
+
+    @mock.patch("lala.util.reactor")
+    def test_msg_from_thread(self, reactor):
+        with mock.patch("twisted.python.threadable.ioThread", -1):
+            util.msg("#channel", "message")
+        reactor.callFromThread.assert_called_once_with(util.msg, "#channel",
+                                                       "message", True)
+        self.assertFalse(util._BOT.msg.called)
+
+    def test_all_statistics(self):
+        pool = mock.Mock(max=2, working=[1], waiters=[])
+        threadpool.watch("test", pool)
+        self.addCleanup(threadpool.unwatch, "test")
+        stats = threadpool.all_statistics()
+        self.assertEqual(stats["test"], {"size": 2,
+                                         "busy": 1,
+                                         "idle": 0,
+                                         "queued": None,
+                                         "utilization": 0.5})
+        self.assertEqual(stats["plugins"], threadpool.statistics())
+        threadpool.unwatch("test")
+        self.assertNotIn("test", threadpool.all_statistics())
+
+    def test_watched_pool_untouched(self):
+        pool = ThreadPool(minthreads=0, maxthreads=1)
+        submit = pool.callInThreadWithCallback
+        threadpool.watch("test", pool)
+        self.addCleanup(threadpool.unwatch, "test")
+        threadpool.all_statistics()
+        self.assertEqual(pool.callInThreadWithCallback, submit)
+        self.assertNotIn("callInThreadWithCallback", vars(pool))
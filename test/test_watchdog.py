@@ -0,0 +1,58 @@
+import threading
+
+from ._helpers import mock, FakeClock, LalaTestCase
+from lala import pluginmanager, util, watchdog
+
+
+class TestWatchdog(LalaTestCase):
+    def setUp(self):
+        super(TestWatchdog, self).setUp()
+        pluginmanager._callbacks.clear()
+        self.clock = FakeClock()
+        self.watchdog = watchdog.Watchdog(0.1, clock=self.clock)
+        self.watchdog.reactor_thread = threading.get_ident()
+        self.watchdog.last_tick = 0.0
+
+    def test_no_stall(self):
+        self.clock.now = 0.15
+        self.assertFalse(self.watchdog.check())
+        self.assertEqual(self.watchdog.stalls, {})
+
+    @mock.patch("lala.watchdog.logging")
+    def test_stall_reported_once(self, logging):
+        self.clock.now = 0.2
+        self.assertTrue(self.watchdog.check())
+        self.assertFalse(self.watchdog.check())
+        self.assertEqual(self.watchdog.stalls, {(None, None): 1})
+        message, late, during, stack = logging.warning.call_args[0]
+        self.assertAlmostEqual(late, 150)
+        self.assertIn("test_stall_reported_once", stack)
+
+        self.watchdog.tick()
+        self.clock.now = 0.5
+        self.assertTrue(self.watchdog.check())
+        self.assertEqual(self.watchdog.stalls, {(None, None): 2})
+
+    @mock.patch("lala.watchdog.logging")
+    def test_stall_in_command(self, logging):
+        def blocking(user, channel, text):
+            self.clock.now = 1
+            self.watchdog.check()
+
+        util.command(command="blocking")(blocking)
+        pluginmanager._handle_message("user", "#channel", "!blocking")
+        self.assertEqual(self.watchdog.stalls,
+                         {("test_watchdog", "blocking"): 1})
+        self.assertIn("while calling the command blocking of test_watchdog",
+                      logging.warning.call_args[0][2])
+        self.assertIsNone(pluginmanager._dispatching)
+
+    def test_innermost_plugin_frame(self):
+        frame = mock.Mock(f_globals={"__name__": "lala.plugins.log"},
+                          f_back=None)
+        frame.f_code.co_name = "last"
+        outer = mock.Mock(f_globals={"__name__": "lala.bot"}, f_back=frame)
+        self.assertEqual(watchdog._innermost_plugin_frame(outer),
+                         ("log", "last"))
+        self.assertEqual(watchdog._innermost_plugin_frame(None),
+                         (None, None))
@@ -0,0 +1,219 @@
+import json
+import sys
+
+from ._helpers import mock, LalaTestCase
+from lala import pluginmanager, util, workers
+from twisted.internet.address import UNIXAddress
+from twisted.internet.defer import Deferred, TimeoutError, succeed
+from twisted.internet.error import ConnectionDone
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+
+def f(user, channel, text):
+    util.msg(channel, "%s: %s" % (user, text))
+
+
+def failing(user, channel, text):
+    raise ValueError("failing")
+
+
+def regex_f(user, channel, text, match):
+    util.msg(channel, match.group(1))
+
+
+class FakeWorker(object):
+    def __init__(self):
+        self.pending = 0
+        self.calls = []
+        self.kill = mock.Mock()
+
+    def callRemote(self, command, **kwargs):  # noqa: N802
+        d = Deferred()
+        self.calls.append((command, kwargs, d))
+        return d
+
+
+class TestWorkerProtocol(LalaTestCase):
+    def setUp(self):
+        super(TestWorkerProtocol, self).setUp()
+        pluginmanager._callbacks.clear()
+        pluginmanager._regexes.clear()
+        self.protocol = workers.WorkerProtocol()
+
+    def test_load_plugins(self):
+        self.addCleanup(sys.modules.pop, "lala.plugins.calendar", None)
+        results = []
+        with mock.patch("lala.config._initialize"):
+            self.protocol.load_plugins(config=self.configfile,
+                                       plugins=["calendar"]).addCallback(
+                results.append)
+        descriptions = json.loads(results[0]["descriptions"])
+        self.assertEqual(descriptions["calendar"]["commands"][0]["trigger"],
+                         "weeknum")
+        self.assertIsInstance(util._BOT, workers._BotProxy)
+
+    @mock.patch("lala.pluginmanager._describe_plugin", return_value={})
+    @mock.patch("lala.pluginmanager.load_plugin")
+    def test_load_plugins_waits_for_init(self, load_plugin, describe):
+        initialized = Deferred()
+        load_plugin.return_value = initialized
+        results = []
+        with mock.patch("lala.config._initialize"):
+            self.protocol.load_plugins(config="", plugins=["a"]).addBoth(
+                results.append)
+        self.assertEqual(results, [])
+        initialized.callback(None)
+        self.assertEqual(results, [{"descriptions": '{"a": {}}'}])
+
+    @mock.patch("lala.workers.logging")
+    @mock.patch("lala.pluginmanager._describe_plugin", return_value={})
+    @mock.patch("lala.pluginmanager.load_plugin")
+    def test_load_plugins_init_fails(self, load_plugin, describe, logging):
+        initialized = Deferred()
+        load_plugin.return_value = initialized
+        results = []
+        with mock.patch("lala.config._initialize"):
+            self.protocol.load_plugins(config="", plugins=["a"]).addBoth(
+                results.append)
+        initialized.errback(ValueError("broken"))
+        self.assertTrue(results[0].check(workers.WorkerError))
+        self.assertEqual(results[0].getErrorMessage(),
+                         "Initializing a failed: broken")
+
+    def test_dispatch_command(self):
+        util.command(f)
+        results = []
+        self.protocol.dispatch(plugin="test_workers", kind="command", key="f",
+                               user="user", channel="#channel",
+                               message="text").addCallback(results.append)
+        self.assertEqual(results, [{}])
+        util._BOT.msg.assert_called_once_with("#channel", "user: text", True)
+
+    def test_dispatch_coroutine(self):
+        async def coro(user, channel, text):
+            util.msg(channel, text)
+
+        util.command(command="coro")(coro)
+        results = []
+        self.protocol.dispatch(plugin="test_workers", kind="command",
+                               key="coro", user="user", channel="#channel",
+                               message="text").addCallback(results.append)
+        self.assertEqual(results, [{}])
+        util._BOT.msg.assert_called_once_with("#channel", "text", True)
+
+    def test_dispatch_regex(self):
+        util.regex("(t.st)")(regex_f)
+        self.protocol.dispatch(plugin="test_workers", kind="regex",
+                               key="(t.st)", user="user", channel="#channel",
+                               message="a test")
+        util._BOT.msg.assert_called_once_with("#channel", "test", True)
+
+    def test_dispatch_failure(self):
+        util.command(failing)
+        failures = []
+        self.protocol.dispatch(plugin="test_workers", kind="command",
+                               key="failing", user="user", channel="#channel",
+                               message="").addErrback(failures.append)
+        self.assertTrue(failures[0].check(workers.WorkerError))
+
+    def test_bot_proxy(self):
+        self.protocol.callRemote = mock.Mock()
+        proxy = workers._BotProxy(self.protocol)
+        proxy.msg("#channel", "message", False)
+        self.protocol.callRemote.assert_called_once_with(
+            workers.SendMessage, target="#channel", message="message",
+            log=False)
+
+
+class TestWorkerPool(LalaTestCase):
+    def setUp(self):
+        super(TestWorkerPool, self).setUp()
+        self.clock = Clock()
+        self.pool = workers.WorkerPool(["plugin"], 2, 10, "", self.clock)
+        self.pool.workers = [FakeWorker(), FakeWorker()]
+
+    def test_dispatch_least_busy(self):
+        self.pool.workers[0].pending = 1
+        self.pool.dispatch("plugin", "command", "cmd", "user", "#channel", "")
+        self.assertEqual(len(self.pool.workers[0].calls), 0)
+        self.assertEqual(len(self.pool.workers[1].calls), 1)
+        self.assertEqual(self.pool.workers[1].pending, 1)
+
+    def test_dispatch_result(self):
+        results = []
+        d = self.pool.dispatch("plugin", "command", "cmd", "user", "#channel")
+        d.addCallback(results.append)
+        worker = self.pool.workers[0]
+        worker.calls[0][2].callback({})
+        self.assertEqual(results, [None])
+        self.assertEqual(worker.pending, 0)
+
+    def test_dispatch_timeout_kills_worker(self):
+        failures = []
+        d = self.pool.dispatch("plugin", "command", "cmd", "user", "#channel")
+        d.addErrback(failures.append)
+        self.clock.advance(10)
+        self.assertTrue(failures[0].check(TimeoutError))
+        worker = self.pool.workers[0]
+        worker.kill.assert_called_once_with()
+        # The worker exiting fails the call
+        worker.calls[0][2].errback(Exception())
+        self.assertEqual(worker.pending, 0)
+
+    def test_dispatch_without_workers(self):
+        self.pool.workers = []
+        failures = []
+        self.pool.dispatch("plugin", "command", "cmd", "user",
+                           "#channel").addErrback(failures.append)
+        self.assertTrue(failures[0].check(workers.WorkerError))
+
+    def test_worker_lost_restarts(self):
+        worker = self.pool.workers[0]
+        with mock.patch.object(self.pool, "_spawn") as spawn:
+            spawn.return_value = succeed(None)
+            self.pool._worker_lost(worker)
+            self.assertNotIn(worker, self.pool.workers)
+            self.clock.advance(workers.RESTART_DELAY)
+            spawn.assert_called_once_with()
+
+
+class TestWorkerConnection(LalaTestCase):
+    def test_addresses(self):
+        # Like process transports, it has no addresses
+        transport = mock.Mock()
+        transport.getPeer.side_effect = NotImplementedError
+        transport.getHost.side_effect = NotImplementedError
+        worker = workers._WorkerConnection(mock.Mock())
+        worker.makeConnection(transport)
+        self.assertEqual(worker.transport.getPeer(), UNIXAddress(None))
+        self.assertEqual(worker.transport.getHost(), UNIXAddress(None))
+        worker.kill()
+        transport.signalProcess.assert_called_once_with("KILL")
+        worker.connectionLost(Failure(ConnectionDone()))
+        self.assertTrue(worker.lost.called)
+
+
+class TestStart(LalaTestCase):
+    def setUp(self):
+        super(TestStart, self).setUp()
+        pluginmanager._callbacks.clear()
+        self.addCleanup(setattr, workers, "_POOL", None)
+
+    @mock.patch("lala.workers.WorkerPool")
+    def test_start_registers_proxies(self, pool_class):
+        util.command(f)
+        pool = pool_class.return_value
+        description = {"commands": [{"trigger": "remote", "aliases": [],
+                                     "admin_only": False, "doc": "Remote"}],
+                       "regexes": [], "join_callbacks": []}
+        pool.start.return_value = succeed({"plugin": description})
+        workers.start(["plugin"])
+
+        self.assertIn("f", pluginmanager._callbacks)
+        self.assertEqual(pluginmanager._callbacks["remote"].plugin, "plugin")
+        self.assertEqual(pluginmanager._callbacks["remote"].func.__doc__,
+                         "Remote")
+        pluginmanager._handle_message("user", "#channel", "!remote text")
+        pool.dispatch.assert_called_once_with("plugin", "command", "remote",
+                                              "user", "#channel", "text")